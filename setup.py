@@ -37,7 +37,8 @@ setup(
             ],
         'workitems': [
                 'application/x-ruote-workitem = taskqueue.workitem:RuoteWorkitem',
-                'application/x-basic-workitem = taskqueue.workitem:BasicWorkitem'
+                'application/x-basic-workitem = taskqueue.workitem:BasicWorkitem',
+                'application/x-msgpack-workitem = taskqueue.msgpackworkitem:MsgpackWorkitem'
             ]
     },
     test_suite = "tests",
@@ -0,0 +1,160 @@
+"""Helpers for AMQP message properties and connections."""
+
+import socket
+import random
+
+from time import time
+from hashlib import sha1
+
+from pika.exceptions import AMQPConnectionError
+
+from taskqueue.confparser import OPT_RECONNECT_DELAY, OPT_RECONNECT_MAX_DELAY
+
+#: Exceptions raised when connection to AMQP broker fails or gets lost
+CONNECTION_ERRORS = (AMQPConnectionError, socket.error)
+
+#: Default initial delay in seconds between reconnection attempts
+DEFAULT_RECONNECT_DELAY = 0.5
+
+#: Default maximum delay in seconds between reconnection attempts
+DEFAULT_RECONNECT_MAX_DELAY = 30
+
+#: Header carrying type of worker a message should be routed to
+HEADER_WORKER_TYPE = 'x-worker-type'
+
+#: Header carrying reference to message body offloaded to blob store
+HEADER_BLOB_REF = 'x-blob-ref'
+
+#: Header carrying deadline of task in milliseconds since epoch
+HEADER_DEADLINE = 'x-deadline'
+
+#: Number of characters of message digests
+DIGEST_SIZE = 16
+
+def get_header(properties, name, default=None):
+    """Return value of custom header of AMQP message.
+
+    :param properties: AMQP message properties
+    :type properties: pika.spec.BasicProperties
+    :param name: header name
+    :type name: string
+    :param default: value returned if the header is not set
+    """
+
+    headers = getattr(properties, 'headers', None)
+    if not isinstance(headers, dict):
+        return default
+    return headers.get(name, default)
+
+def get_digest(properties, body):
+    """Return short digest identifying AMQP message.
+
+    Messages offloaded to blob store are identified by their blob reference.
+
+    :param properties: AMQP message properties
+    :type properties: pika.spec.BasicProperties
+    :param body: message body
+    :type body: string
+    :rtype: string
+    """
+
+    ref = get_header(properties, HEADER_BLOB_REF)
+    return sha1(body if ref is None else ref).hexdigest()[:DIGEST_SIZE]
+
+def get_deadline(properties):
+    """Return deadline of AMQP message.
+
+    The deadline is taken from the header `x-deadline` or computed from the
+    properties `timestamp` and `expiration`.
+
+    :param properties: AMQP message properties
+    :type properties: pika.spec.BasicProperties
+    :returns: deadline in seconds since epoch or None if the message
+              doesn't expire
+    :rtype: float
+    """
+
+    try:
+        deadline = get_header(properties, HEADER_DEADLINE)
+        if deadline is not None:
+            return float(deadline) / 1000
+        expiration = getattr(properties, 'expiration', None)
+        timestamp = getattr(properties, 'timestamp', None)
+        if expiration is None or timestamp is None:
+            return None
+        return timestamp + float(expiration) / 1000
+    except (TypeError, ValueError):
+        return None
+
+def is_expired(properties):
+    """Check if deadline of AMQP message has passed.
+
+    :param properties: AMQP message properties
+    :type properties: pika.spec.BasicProperties
+    :rtype: boolean
+    """
+
+    deadline = get_deadline(properties)
+    return deadline is not None and deadline < time()
+
+class Backoff(object):
+    """Exponential backoff with full jitter.
+
+    The delay before every next attempt is chosen randomly between zero and
+    an exponentially growing cap. Random delays spread the reconnection
+    attempts of many processes losing the broker at once.
+    """
+
+    def __init__(self, delay=DEFAULT_RECONNECT_DELAY,
+                 max_delay=DEFAULT_RECONNECT_MAX_DELAY):
+        """Constructor.
+
+        :param delay: initial cap of delays in seconds
+        :type delay: float
+        :param max_delay: maximum cap of delays in seconds
+        :type max_delay: float
+        """
+
+        self.delay = delay
+        self.max_delay = max_delay
+        self.attempts = 0
+        self.started = None
+
+    def next_delay(self):
+        """Return delay in seconds before next attempt."""
+
+        if self.attempts == 0:
+            self.started = time()
+        # the exponent is capped, as long failures overflow float delays
+        cap = min(self.max_delay, self.delay * 2 ** min(self.attempts, 62))
+        self.attempts += 1
+        return random.uniform(0, cap)
+
+    def reset(self):
+        """Reset backoff after successful attempt.
+
+        :returns: number of failed attempts and seconds spent since the first
+                  of them
+        :rtype: tuple
+        """
+
+        if self.attempts == 0:
+            return 0, 0.0
+        result = (self.attempts, time() - self.started)
+        self.attempts = 0
+        self.started = None
+        return result
+
+def get_backoff(settings):
+    """Create backoff configured with options `reconnect_delay` and
+    `reconnect_max_delay`.
+
+    :param settings: configuration options
+    :type settings: dictionary
+    :rtype: Backoff
+    """
+
+    return Backoff(float(settings.get(OPT_RECONNECT_DELAY,
+                                      DEFAULT_RECONNECT_DELAY)),
+                   float(settings.get(OPT_RECONNECT_MAX_DELAY,
+                                      DEFAULT_RECONNECT_MAX_DELAY)))
@@ -0,0 +1,206 @@
+"""
+The module `taskqueue.asyncworker` contains the abstract class
+:class:`AsyncBaseWorker` for workers handling many network bound tasks in
+one process.
+
+Asynchronous workers run on the I/O loop of `pika.SelectConnection`. Their
+method `handle_task()` gets a workitem along with a callback and returns
+immediately. Once the task is done the worker calls the callback with the
+new state of the workitem or with an exception the task failed with::
+
+    class Worker(AsyncBaseWorker):
+
+        def handle_task(self, workitem, done):
+            self.connection.add_timeout(5, lambda: done(workitem))
+
+The callback must be called from the I/O loop, i.e. from callbacks
+registered with `self.connection` or `self.connection.ioloop`. Up to
+`prefetch` tasks are handled simultaneously.
+
+With `priority_lanes` the worker consumes every lane of its queue, but
+unlike synchronous workers it doesn't prefer higher lanes: tasks are handled
+in the order the broker delivers them.
+
+Asynchronous workers are registered under the group `worker.plugins` and
+started by the worker pool in the same way as workers derived from
+:class:`taskqueue.worker.BaseWorker`.
+"""
+
+import logging
+import pika
+import signal
+import traceback
+
+from collections import deque
+from functools import partial
+
+from taskqueue.worker import BaseWorker
+from taskqueue.confparser import OPT_PREFETCH, OPT_PRIORITY_LANES, \
+                                 OPT_MAX_TASKS_PER_CHILD, OPT_MAX_RSS_MB
+from taskqueue.priority import get_queue_arguments, get_lane_queue
+
+LOG = logging.getLogger(__name__)
+
+#: Default maximum number of tasks handled simultaneously
+DEFAULT_PREFETCH = 100
+
+class AsyncBaseWorker(BaseWorker):
+    """Base class for asynchronous workers."""
+
+    def __init__(self):
+        """Constructor."""
+
+        super(AsyncBaseWorker, self).__init__()
+        self.queues = []
+        self.consumer_tags = []
+        self.tasks = {}
+        self.waiting = deque()
+
+    def __call__(self, props, conn_params, queue):
+        """Worker process entry point."""
+
+        self.configure(props)
+        self.prefetch = int(self.settings.get(OPT_PREFETCH, DEFAULT_PREFETCH))
+        lanes = int(self.settings.get(OPT_PRIORITY_LANES, 1))
+        self.queues = [get_lane_queue(queue, lane)
+                       for lane in range(max(lanes, 1))]
+        self.connection = pika.SelectConnection(conn_params,
+                                                self.on_connected)
+        self.max_tasks = int(self.settings.get(OPT_MAX_TASKS_PER_CHILD, 0))
+        self.max_rss = float(self.settings.get(OPT_MAX_RSS_MB, 0))
+        signal.signal(signal.SIGTERM, self.cleanup)
+        signal.signal(signal.SIGUSR2, self.drain)
+        LOG.debug("created new process with props %r" % props)
+        if self.drain_requested:
+            # asked to drain before the handler was set, no task is running
+            LOG.info("drain worker process before consuming tasks")
+            return
+        self.connection.ioloop.start()
+
+    def on_connected(self, connection):
+        """Open channel."""
+        connection.channel(self.on_channel_open)
+
+    def on_channel_open(self, channel):
+        """Declare queues for opened channel."""
+
+        self.channel = channel
+        channel.basic_qos(prefetch_count=self.prefetch)
+        arguments = get_queue_arguments(self.settings)
+        for name in self.queues:
+            channel.queue_declare(self.on_queue_declared, queue=name,
+                                  durable=True, exclusive=False,
+                                  auto_delete=False, arguments=arguments)
+
+    def on_queue_declared(self, frame):
+        """Start consuming from declared queue."""
+
+        self.consumer_tags.append(self.channel.basic_consume(
+            self.handle_delivery, queue=frame.method.queue))
+        self.consuming = True
+
+    def handle_task(self, workitem, done):
+        """Start task.
+
+        This method is supposed to be overriden in AsyncBaseWorker
+        subclasses.
+
+        :param workitem: workflow work item
+        :type workitem: Workitem
+        :param done: callback to be called with new state of the work item
+                     or with an exception once the task is done
+        :type done: callable
+        """
+        raise NotImplementedError
+
+    def handle_delivery(self, channel, method, header, body):
+        """Handle AMQP message.
+
+        :param channel: AMQP channel
+        :type channel: pika.channel.Channel
+        :param method: message's method
+        :type method: pika.frame.Method
+        :param header: message header
+        :type header: pika.frame.Header
+        :param body: message body
+        :type body: string
+        """
+
+        LOG.debug("Method: %r", method)
+        LOG.debug("Header: %r", header)
+        if self.drop_expired(channel, method, header):
+            return False
+        workitem = self.load_workitem(channel, method, header, body)
+        if workitem is None:
+            return False
+
+        if not self.is_acceptable(workitem):
+            workitem.set_error("Worker doesn't support this type of "
+                               "workitems")
+            self.finish_task(channel, method, header, workitem)
+        elif len(self.tasks) < self.prefetch:
+            self.start_task(channel, method, header, workitem)
+        else:
+            self.waiting.append((channel, method, header, workitem))
+        return True
+
+    def start_task(self, channel, method, header, workitem):
+        """Pass workitem to `handle_task()`."""
+
+        self.tasks[method.delivery_tag] = workitem
+        self.share_active(len(self.tasks))
+        done = partial(self.task_done, channel, method, header, workitem)
+        try:
+            self.handle_task(workitem, done)
+        except Exception as err:
+            workitem.set_error(str(err))
+            workitem.set_trace(traceback.format_exc())
+            done(workitem)
+
+    def task_done(self, channel, method, header, workitem, result):
+        """Report results of finished task and start a waiting one.
+
+        :param result: new state of work item or exception
+        :type result: Workitem|Exception
+        """
+
+        if self.tasks.pop(method.delivery_tag, None) is None:
+            LOG.warning("task %r is reported as done twice" % workitem)
+            return
+        self.share_active(len(self.tasks))
+
+        if isinstance(result, Exception):
+            workitem.set_error(str(result))
+            workitem.set_trace("".join(
+                traceback.format_exception_only(type(result), result)))
+            result = workitem
+        self.finish_task(channel, method, header, result)
+
+        if self.waiting and self.consuming:
+            self.start_task(*self.waiting.popleft())
+        elif not self.tasks and not self.consuming:
+            self.connection.close()
+        self.count_tasks(1)
+
+    def drain(self, signum, frame):
+        """Stop consuming tasks and let the worker process exit once the
+        running tasks are finished and reported."""
+
+        if self.draining:
+            return
+        LOG.info("drain worker process after %d tasks" % self.tasks_done)
+        self.draining = True
+        self.cleanup(signum, frame)
+
+    def cleanup(self, signum, frame):
+        """Stop consuming and close connection once running tasks are
+        finished. Waiting tasks are redelivered to other workers."""
+
+        LOG.debug("target cleanup")
+        self.consuming = False
+        self.waiting.clear()
+        for consumer_tag in self.consumer_tags:
+            self.channel.basic_cancel(consumer_tag=consumer_tag)
+        self.consumer_tags = []
+        if not self.tasks:
+            self.connection.close()
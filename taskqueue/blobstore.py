@@ -0,0 +1,223 @@
+"""
+Claim-check store for oversized message bodies.
+
+Bodies exceeding a size threshold are written to a content-addressed store
+in a directory shared by dispatchers and workers, and AMQP messages carry
+only a reference to the stored body in the header `x-blob-ref`.
+
+The store keeps every distinct body once under `objects/<sha1>`. Each
+reference is a hard link `refs/<sha1>.<uuid>` to the object, so the link
+count of an object is the number of its references plus one. Bodies are read
+through references, thus removing an object never breaks a reader holding
+a reference. A reference is released by the consumer of its message once the
+message is acknowledged, the object is removed along with its last
+reference. References never released (e.g. if a message got lost) are
+removed by :meth:`BlobStore.collect`.
+"""
+
+import logging
+import os
+import re
+import errno
+import stat
+
+from time import time
+from hashlib import sha1
+from uuid import uuid4
+from tempfile import mkstemp
+
+from taskqueue.confparser import OPT_BLOB_STORE, OPT_BLOB_THRESHOLD
+
+LOG = logging.getLogger(__name__)
+
+#: Bodies smaller than this number of bytes are not offloaded by default
+DEFAULT_THRESHOLD = 1048576
+
+REF_RE = re.compile(r"^([0-9a-f]{40})\.[0-9a-f]{32}$")
+
+class BlobStoreError(Exception):
+    pass
+
+class BlobStore(object):
+    """Content-addressed store of message bodies."""
+
+    def __init__(self, path, threshold=DEFAULT_THRESHOLD):
+        """Constructor.
+
+        :param path: path to store directory
+        :type path: string
+        :param threshold: minimum size of offloaded bodies
+        :type threshold: integer
+        """
+
+        self.path = path
+        self.threshold = threshold
+        self.objects_dir = os.path.join(path, "objects")
+        self.refs_dir = os.path.join(path, "refs")
+        for dirname in (self.objects_dir, self.refs_dir):
+            try:
+                os.makedirs(dirname)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+
+    def __repr__(self):
+        return "<BlobStore(%r)>" % self.path
+
+    def _ref_path(self, ref):
+        """Return path to reference file."""
+
+        if not isinstance(ref, basestring) or REF_RE.match(ref) is None:
+            raise BlobStoreError("Invalid blob reference %r" % (ref,))
+        return os.path.join(self.refs_dir, ref)
+
+    def _write_object(self, digest, data):
+        """Write object atomically."""
+
+        fd, tmppath = mkstemp(dir=self.objects_dir, prefix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                tmp.write(data)
+                tmp.flush()
+                os.fsync(tmp.fileno())
+            os.chmod(tmppath, 0644)
+            os.rename(tmppath, os.path.join(self.objects_dir, digest))
+        except (IOError, OSError):
+            os.unlink(tmppath)
+            raise
+
+    def put(self, data):
+        """Store data and return new reference to it.
+
+        :param data: data to store
+        :type data: string
+        :returns: blob reference
+        :rtype: string
+        """
+
+        digest = sha1(data).hexdigest()
+        objpath = os.path.join(self.objects_dir, digest)
+        ref = "%s.%s" % (digest, uuid4().hex)
+        refpath = os.path.join(self.refs_dir, ref)
+        while True:
+            try:
+                os.link(objpath, refpath)
+                return ref
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise BlobStoreError("Can't store blob: %s" % err)
+            # the object doesn't exist or has just been released
+            try:
+                self._write_object(digest, data)
+            except (IOError, OSError) as err:
+                raise BlobStoreError("Can't store blob: %s" % err)
+
+    def get(self, ref):
+        """Return data stored under reference.
+
+        :param ref: blob reference
+        :type ref: string
+        :rtype: string
+        """
+
+        try:
+            with open(self._ref_path(ref), "rb") as blob:
+                return blob.read()
+        except (IOError, OSError) as err:
+            raise BlobStoreError("Can't read blob %s: %s" % (ref, err))
+
+    def release(self, ref):
+        """Release reference and remove data if it's not referenced anymore.
+
+        :param ref: blob reference
+        :type ref: string
+        """
+
+        refpath = self._ref_path(ref)
+        try:
+            os.unlink(refpath)
+        except OSError as err:
+            LOG.warning("Can't release blob %s: %s" % (ref, err))
+            return
+        self._remove_unreferenced(REF_RE.match(ref).group(1))
+
+    def _remove_unreferenced(self, digest):
+        """Remove object if it has no references."""
+
+        objpath = os.path.join(self.objects_dir, digest)
+        try:
+            if os.stat(objpath).st_nlink == 1:
+                os.unlink(objpath)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                LOG.warning("Can't remove blob %s: %s" % (digest, err))
+
+    def collect(self, max_age):
+        """Remove references older than given age and unreferenced objects.
+
+        :param max_age: maximum age of references in seconds
+        :type max_age: float
+        :returns: number of removed references
+        :rtype: integer
+        """
+
+        deadline = time() - max_age
+        removed = 0
+        for ref in os.listdir(self.refs_dir):
+            refpath = os.path.join(self.refs_dir, ref)
+            # ctime is shared by all links to the same object, so references
+            # to popular bodies expire later than they could
+            try:
+                if os.lstat(refpath).st_ctime < deadline:
+                    os.unlink(refpath)
+                    removed += 1
+            except OSError:
+                continue
+        for name in os.listdir(self.objects_dir):
+            objpath = os.path.join(self.objects_dir, name)
+            try:
+                info = os.lstat(objpath)
+            except OSError:
+                continue
+            if name.startswith(".tmp"):
+                # leftovers of crashed writers
+                if stat.S_ISREG(info.st_mode) and info.st_mtime < deadline:
+                    try:
+                        os.unlink(objpath)
+                    except OSError:
+                        pass
+            elif info.st_nlink == 1:
+                self._remove_unreferenced(name)
+        if removed:
+            LOG.info("removed %d expired blob references" % removed)
+        return removed
+
+    def offload(self, body):
+        """Store body if it's big enough.
+
+        :param body: message body
+        :type body: string
+        :returns: pair of message body and blob reference which is None if
+                  the body is not stored
+        :rtype: tuple
+        """
+
+        if len(body) < self.threshold:
+            return body, None
+        return "", self.put(body)
+
+def get_blobstore(settings):
+    """Create blob store configured with options `blob_store` and
+    `blob_threshold`.
+
+    :param settings: configuration options
+    :type settings: dictionary
+    :returns: blob store or None if it's not configured
+    :rtype: BlobStore
+    """
+
+    path = settings.get(OPT_BLOB_STORE, None)
+    if not path:
+        return None
+    return BlobStore(path, int(settings.get(OPT_BLOB_THRESHOLD,
+                                            DEFAULT_THRESHOLD)))
@@ -0,0 +1,157 @@
+"""
+Circuit breaker for crashing worker types.
+
+The breaker of a worker type counts crashes of its processes. Once
+`breaker_threshold` crashes happen within `breaker_window` seconds the
+breaker opens and the type gets parked: crashed processes are not restarted.
+After `breaker_timeout` seconds the breaker becomes half-open and one probe
+process is started. If the probe survives `min_uptime` seconds the breaker
+closes and the parked processes are restarted, otherwise the breaker opens
+again for twice as long, up to `breaker_max_timeout` seconds.
+"""
+
+import logging
+
+from collections import deque
+
+from taskqueue.confparser import OPT_BREAKER_THRESHOLD, OPT_BREAKER_WINDOW, \
+                                 OPT_BREAKER_TIMEOUT, OPT_BREAKER_MAX_TIMEOUT
+
+LOG = logging.getLogger(__name__)
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half-open'
+
+#: Default number of crashes opening breaker
+DEFAULT_THRESHOLD = 5
+
+#: Default period of counted crashes in seconds
+DEFAULT_WINDOW = 60
+
+#: Default initial period of open state in seconds
+DEFAULT_TIMEOUT = 30
+
+#: Default maximum period of open state in seconds
+DEFAULT_MAX_TIMEOUT = 600
+
+class CircuitBreaker(object):
+    """Circuit breaker of worker type."""
+
+    def __init__(self, name, threshold=DEFAULT_THRESHOLD,
+                 window=DEFAULT_WINDOW, timeout=DEFAULT_TIMEOUT,
+                 max_timeout=DEFAULT_MAX_TIMEOUT):
+        """Constructor.
+
+        :param name: name of guarded worker type
+        :type name: string
+        :param threshold: number of crashes opening the breaker, the breaker
+                          never opens if it's zero
+        :type threshold: integer
+        :param window: period of counted crashes in seconds
+        :type window: float
+        :param timeout: initial period of open state in seconds
+        :type timeout: float
+        :param max_timeout: maximum period of open state in seconds
+        :type max_timeout: float
+        """
+
+        self.name = name
+        self.threshold = threshold
+        self.window = window
+        self.timeout = timeout
+        self.max_timeout = max_timeout
+        self.state = STATE_CLOSED
+        self.crashes = deque()
+        self.open_timeout = timeout
+        self.opened_at = None
+        self.trips = 0
+
+    def __repr__(self):
+        return "<CircuitBreaker(%r, %s)>" % (self.name, self.state)
+
+    def _set_state(self, state):
+        LOG.warning("breaker of %r: %s -> %s" % (self.name, self.state, state))
+        self.state = state
+
+    def record_crash(self, now):
+        """Count crash of process.
+
+        :param now: time of crash
+        :type now: float
+        """
+
+        if self.state == STATE_HALF_OPEN:
+            # failed probe
+            self.open_timeout = min(self.open_timeout * 2, self.max_timeout)
+            self._open(now)
+            return
+        self.crashes.append(now)
+        while self.crashes and self.crashes[0] < now - self.window:
+            self.crashes.popleft()
+        if self.state == STATE_CLOSED and self.threshold and \
+           len(self.crashes) >= self.threshold:
+            self._open(now)
+
+    def _open(self, now):
+        self._set_state(STATE_OPEN)
+        self.opened_at = now
+        self.trips += 1
+        self.crashes.clear()
+
+    def record_success(self):
+        """Close breaker after process survived startup."""
+
+        if self.state == STATE_HALF_OPEN:
+            self._set_state(STATE_CLOSED)
+            self.open_timeout = self.timeout
+            self.opened_at = None
+
+    def allow(self, now):
+        """Check if process can be started.
+
+        An open breaker lets one probe process start after its timeout.
+
+        :param now: current time
+        :type now: float
+        :rtype: boolean
+        """
+
+        if self.state == STATE_CLOSED:
+            return True
+        if self.state == STATE_OPEN and \
+           now >= self.opened_at + self.open_timeout:
+            self._set_state(STATE_HALF_OPEN)
+            return True
+        return False
+
+    def describe(self, now):
+        """Return description of breaker state.
+
+        :param now: current time
+        :type now: float
+        :rtype: string
+        """
+
+        if self.state == STATE_OPEN:
+            return "%s, probe in %.0f s" % (
+                self.state, self.opened_at + self.open_timeout - now)
+        return "%s, %d recent crashes" % (self.state, len(self.crashes))
+
+def get_breaker(name, settings):
+    """Create circuit breaker configured with options `breaker_threshold`,
+    `breaker_window`, `breaker_timeout` and `breaker_max_timeout`.
+
+    :param name: name of guarded worker type
+    :type name: string
+    :param settings: configuration options
+    :type settings: dictionary
+    :rtype: CircuitBreaker
+    """
+
+    return CircuitBreaker(
+        name,
+        int(settings.get(OPT_BREAKER_THRESHOLD, DEFAULT_THRESHOLD)),
+        float(settings.get(OPT_BREAKER_WINDOW, DEFAULT_WINDOW)),
+        float(settings.get(OPT_BREAKER_TIMEOUT, DEFAULT_TIMEOUT)),
+        float(settings.get(OPT_BREAKER_MAX_TIMEOUT, DEFAULT_MAX_TIMEOUT)))
@@ -0,0 +1,149 @@
+"""
+Coalescing of identical tasks running simultaneously on one host.
+
+Tasks are identified by the worker type and the workitem fields listed in
+the option `coalesce_key` in the same way as results are identified by
+:mod:`taskqueue.resultcache`. Worker processes of a type coordinate through
+lock files in the directory `coalesce_dir`: the first process handling a
+task locks the file `<key>.lock`, processes receiving duplicates of the task
+wait for the lock. Once the task is done its fields are written to the file
+`<key>.result` and the waiting processes report copies of the result instead
+of handling the task again. If the task fails, the next waiting process
+handles it itself.
+
+Tasks lacking any of the key fields are never coalesced.
+
+The directory keeps one lock and one result file per distinct key, so it's
+better to place it on a file system cleaned on reboot, e.g. under `/run`.
+"""
+
+import logging
+import os
+import errno
+import fcntl
+
+from time import time
+from tempfile import mkstemp
+
+from taskqueue import jsoncodec
+from taskqueue.resultcache import get_key, get_key_fields, restore_fields
+from taskqueue.confparser import OPT_COALESCE_DIR, OPT_COALESCE_KEY
+
+LOG = logging.getLogger(__name__)
+
+class Coalescer(object):
+    """Coalescer of tasks running in processes of one worker type."""
+
+    def __init__(self, path, key_fields):
+        """Constructor.
+
+        :param path: path to directory shared by worker processes
+        :type path: string
+        :param key_fields: names of fields tasks are identified by
+        :type key_fields: list
+        """
+
+        self.path = path
+        self.key_fields = [field.split('.') for field in key_fields]
+        self.coalesced = 0
+        try:
+            os.makedirs(path)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+
+    def __repr__(self):
+        return "<Coalescer(%r)>" % self.path
+
+    def get_key(self, workitem):
+        """Return key of task.
+
+        :param workitem: workflow work item
+        :type workitem: Workitem
+        :returns: key or None if the task can't be coalesced
+        :rtype: string
+        """
+        return get_key(workitem, self.key_fields)
+
+    def run(self, key, workitem, handler):
+        """Run task unless its duplicate is running already.
+
+        :param key: task key or None to run the task unconditionally
+        :type key: string
+        :param workitem: workflow work item
+        :type workitem: Workitem
+        :param handler: callable handling the task, e.g. `handle_task()`
+        :type handler: callable
+        :returns: resulting work item
+        :rtype: Workitem
+        """
+
+        if key is None:
+            return handler(workitem)
+        started = time()
+        with open(os.path.join(self.path, key + ".lock"), "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as err:
+                if err.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                LOG.info("waiting for duplicate of %r" % workitem)
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                fields = self._read_result(key, started)
+                if fields is not None:
+                    restore_fields(workitem, fields)
+                    self.coalesced += 1
+                    return workitem
+            result = handler(workitem)
+            self._write_result(key, result)
+            return result
+
+    def _read_result(self, key, since):
+        """Return fields of result written after given time."""
+
+        try:
+            with open(os.path.join(self.path, key + ".result")) as result:
+                finished, fields = jsoncodec.loads(result.read())
+        except (IOError, ValueError):
+            return None
+        if finished < since:
+            return None
+        return fields
+
+    def _write_result(self, key, workitem):
+        """Write result atomically."""
+
+        try:
+            data = jsoncodec.dumps([time(), workitem.fields])
+        except AttributeError:
+            return
+        fd, tmppath = mkstemp(dir=self.path, prefix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as tmp:
+                tmp.write(data)
+            os.rename(tmppath, os.path.join(self.path, key + ".result"))
+        except (IOError, OSError) as err:
+            LOG.warning("Can't write result of task %s: %s" % (key, err))
+            try:
+                os.unlink(tmppath)
+            except OSError:
+                pass
+
+def get_coalescer(settings):
+    """Create coalescer configured with options `coalesce_dir` and
+    `coalesce_key`.
+
+    :param settings: configuration options
+    :type settings: dictionary
+    :returns: coalescer or None if it's not configured
+    :rtype: Coalescer
+    """
+
+    path = settings.get(OPT_COALESCE_DIR, None)
+    if not path:
+        return None
+    key_fields = get_key_fields(settings.get(OPT_COALESCE_KEY, ''))
+    if not key_fields:
+        LOG.warning("coalesce_key is not set. Tasks won't be coalesced")
+        return None
+    return Coalescer(path, key_fields)
@@ -0,0 +1,108 @@
+"""
+Compression of AMQP message bodies.
+
+Compressed bodies are marked with the AMQP property `content_encoding`.
+Bodies with encodings not listed in :data:`CODECS` are left untouched as
+the property may be used by clients to denote character sets as well.
+"""
+
+import logging
+import zlib
+import bz2
+
+from taskqueue.confparser import OPT_COMPRESSION, OPT_COMPRESSION_THRESHOLD
+
+LOG = logging.getLogger(__name__)
+
+#: Bodies smaller than this number of bytes are not compressed by default
+DEFAULT_THRESHOLD = 65536
+
+def _gzip_compress(body):
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+def _gzip_decompress(body):
+    return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+
+#: Supported content encodings and their (compress, decompress) functions
+CODECS = {
+    'zlib':  (zlib.compress, zlib.decompress),
+    'gzip':  (_gzip_compress, _gzip_decompress),
+    'bzip2': (bz2.compress, bz2.decompress)
+}
+
+class CompressionError(Exception):
+    pass
+
+def decompress(body, encoding):
+    """Decompress message body.
+
+    :param body: message body
+    :type body: string
+    :param encoding: content encoding of message
+    :type encoding: string
+    :returns: decompressed body or the body itself if the encoding is not
+              a compression
+    :rtype: string
+    """
+
+    try:
+        codec = CODECS.get(encoding)
+    except TypeError:
+        codec = None
+    if codec is None:
+        return body
+
+    try:
+        return codec[1](body)
+    except (zlib.error, IOError, ValueError) as err:
+        raise CompressionError("Can't decompress body with '%s': %s" %
+                               (encoding, err))
+
+class Compressor(object):
+    """Compressor of message bodies exceeding size threshold."""
+
+    def __init__(self, encoding=None, threshold=DEFAULT_THRESHOLD):
+        """Constructor.
+
+        :param encoding: content encoding of compressed bodies, bodies are
+                         not compressed if None
+        :type encoding: string
+        :param threshold: minimum size of compressed bodies
+        :type threshold: integer
+        """
+
+        if encoding is not None and encoding not in CODECS:
+            LOG.warning("unsupported compression '%s'. Bodies won't be "
+                        "compressed" % encoding)
+            encoding = None
+        self.encoding = encoding
+        self.threshold = threshold
+
+    def compress(self, body):
+        """Compress body if it's big enough.
+
+        :param body: message body
+        :type body: string
+        :returns: pair of body and its content encoding which is None if
+                  the body is not compressed
+        :rtype: tuple
+        """
+
+        if self.encoding is None or len(body) < self.threshold:
+            return body, None
+        return CODECS[self.encoding][0](body), self.encoding
+
+def get_compressor(settings):
+    """Create compressor configured with options `compression` and
+    `compression_threshold`.
+
+    :param settings: configuration options
+    :type settings: dictionary
+    :rtype: Compressor
+    """
+
+    return Compressor(settings.get(OPT_COMPRESSION, None),
+                      int(settings.get(OPT_COMPRESSION_THRESHOLD,
+                                       DEFAULT_THRESHOLD)))
@@ -16,6 +16,54 @@ OPT_RESULTS_ROUTING_KEY = "results_routing_key"
 OPT_SUBGROUPS           = 'subgroups'
 OPT_INSTANCES           = 'instances'
 OPT_WORKERS             = 'workers'
+OPT_PREFETCH_COUNT      = 'prefetch_count'
+OPT_BATCH_SIZE          = 'batch_size'
+OPT_BATCH_TIMEOUT       = 'batch_timeout'
+OPT_ENGINE              = 'engine'
+OPT_CHANNELS            = 'channels'
+OPT_PROCESSES           = 'processes'
+OPT_JSON_CODEC          = 'json_codec'
+OPT_COMPRESSION         = 'compression'
+OPT_COMPRESSION_THRESHOLD = 'compression_threshold'
+OPT_BLOB_STORE          = 'blob_store'
+OPT_BLOB_THRESHOLD      = 'blob_threshold'
+OPT_BLOB_TTL            = 'blob_ttl'
+OPT_CONCURRENCY         = 'concurrency'
+OPT_PREFETCH            = 'prefetch'
+OPT_TASK_BATCH_SIZE     = 'task_batch_size'
+OPT_TASK_BATCH_TIMEOUT  = 'task_batch_timeout'
+OPT_PRELOAD             = 'preload'
+OPT_RESULTS_BATCH_SIZE  = 'results_batch_size'
+OPT_RESULTS_BATCH_TIMEOUT = 'results_batch_timeout'
+OPT_RECONNECT_DELAY     = 'reconnect_delay'
+OPT_RECONNECT_MAX_DELAY = 'reconnect_max_delay'
+OPT_RESULT_CACHE        = 'result_cache'
+OPT_RESULT_CACHE_KEY    = 'result_cache_key'
+OPT_RESULT_CACHE_TTL    = 'result_cache_ttl'
+OPT_RESULT_CACHE_SIZE   = 'result_cache_size'
+OPT_COALESCE_DIR        = 'coalesce_dir'
+OPT_COALESCE_KEY        = 'coalesce_key'
+OPT_TASK_TIMEOUT        = 'task_timeout'
+OPT_MAX_PRIORITY        = 'max_priority'
+OPT_PRIORITY_FIELD      = 'priority_field'
+OPT_PRIORITY_LANES      = 'priority_lanes'
+OPT_LANE_MODE           = 'lane_mode'
+OPT_LANE_WEIGHTS        = 'lane_weights'
+OPT_RESTART_DELAY       = 'restart_delay'
+OPT_RESTART_MAX_DELAY   = 'restart_max_delay'
+OPT_MIN_UPTIME          = 'min_uptime'
+OPT_BREAKER_THRESHOLD   = 'breaker_threshold'
+OPT_BREAKER_WINDOW      = 'breaker_window'
+OPT_BREAKER_TIMEOUT     = 'breaker_timeout'
+OPT_BREAKER_MAX_TIMEOUT = 'breaker_max_timeout'
+OPT_MIN_INSTANCES       = 'min_instances'
+OPT_MAX_INSTANCES       = 'max_instances'
+OPT_SCALE_INTERVAL      = 'scale_interval'
+OPT_SCALE_UP_RATIO      = 'scale_up_ratio'
+OPT_SCALE_DOWN_RATIO    = 'scale_down_ratio'
+OPT_SCALE_DOWN_DELAY    = 'scale_down_delay'
+OPT_MAX_TASKS_PER_CHILD = 'max_tasks_per_child'
+OPT_MAX_RSS_MB          = 'max_rss_mb'
 
 
 class ConfigParser(SafeConfigParser):
@@ -3,15 +3,49 @@ Taskqueue dispatcher daemon
 """
 
 import sys
+import os
 import logging
 import pika
 
+from time import time, sleep
+from functools import partial
+from multiprocessing import Process, Queue
+from Queue import Empty
+
 from taskqueue.daemonlib import Daemon
-from taskqueue.workitem import get_workitem, WorkitemError, DEFAULT_CONTENT_TYPE
-from taskqueue.confparser import SECTION_TASKQUEUE
+from taskqueue.workitem import peek_worker_type, get_workitem, \
+                               WorkitemError, DEFAULT_CONTENT_TYPE
+from taskqueue.amqputils import get_header, get_backoff, get_deadline, \
+                                is_expired, HEADER_WORKER_TYPE, \
+                                HEADER_BLOB_REF, HEADER_DEADLINE, \
+                                CONNECTION_ERRORS
+from taskqueue.publisher import BatchPublisher, ConfirmPublisher
+from taskqueue.jsoncodec import set_codec, CODEC_AUTO
+from taskqueue.compression import get_compressor, CODECS
+from taskqueue.blobstore import get_blobstore, BlobStoreError
+from taskqueue.priority import get_priority_resolver, get_lane_queue
+from taskqueue.confparser import SECTION_TASKQUEUE, OPT_PREFETCH_COUNT, \
+                                 OPT_BATCH_SIZE, OPT_BATCH_TIMEOUT, \
+                                 OPT_ENGINE, OPT_CHANNELS, OPT_PROCESSES, \
+                                 OPT_JSON_CODEC, OPT_BLOB_TTL, \
+                                 OPT_PRIORITY_LANES
 
 LOG = logging.getLogger(__name__)
 
+#: Engine consuming deliveries one by one over `pika.BlockingConnection`
+ENGINE_BLOCKING = 'blocking'
+#: Engine consuming over several channels of `pika.SelectConnection`
+ENGINE_SELECT = 'select'
+
+#: Interval in seconds consumer processes report their counters with
+REPORT_INTERVAL = 10
+
+#: Interval in seconds expired blob references are collected with
+COLLECT_INTERVAL = 600
+
+#: Default lifetime in seconds of blob references
+DEFAULT_BLOB_TTL = 86400
+
 class Dispatcher(Daemon):
     """Dispatcher daemon"""
 
@@ -22,55 +56,353 @@ class Dispatcher(Daemon):
 
         self.channel = None
         self.connection = None
+        self.publishers = {}
+        self._properties = {}
+        self.consumers = {}
+        self.stats = {}
+        self.stats_queue = None
+        self.consumer_index = None
+        self.forwarded = 0
+        self.expired = 0
+        self.reconnects = 0
+        self.reconnect_time = 0.0
+        self.stopping = False
+        self.connection_lost = False
         if not config.has_section(SECTION_TASKQUEUE):
             config.add_section(SECTION_TASKQUEUE)
         super(Dispatcher, self).__init__(config)
+        self.settings = dict(self.config.items(SECTION_TASKQUEUE))
+        self.prefetch_count = int(self.settings.get(OPT_PREFETCH_COUNT, 0))
+        self.batch_size = int(self.settings.get(OPT_BATCH_SIZE, 1))
+        self.batch_timeout = \
+                float(self.settings.get(OPT_BATCH_TIMEOUT, 100)) / 1000
+        if self.batch_size > self.prefetch_count > 0:
+            LOG.warning("prefetch_count is less than batch_size: batches "
+                        "will be committed upon timeout only")
+        self.engine = self.settings.get(OPT_ENGINE, ENGINE_BLOCKING)
+        if self.engine not in (ENGINE_BLOCKING, ENGINE_SELECT):
+            raise SystemExit("Unknown dispatcher engine '%s'" % self.engine)
+        self.channels = int(self.settings.get(OPT_CHANNELS, 1))
+        self.processes = int(self.settings.get(OPT_PROCESSES, 1))
+        set_codec(self.settings.get(OPT_JSON_CODEC, CODEC_AUTO))
+        self.compressor = get_compressor(self.settings)
+        self.blobstore = get_blobstore(self.settings)
+        self.blob_ttl = float(self.settings.get(OPT_BLOB_TTL,
+                                                DEFAULT_BLOB_TTL))
+        self.backoff = get_backoff(self.settings)
+        self.priorities = get_priority_resolver(self.settings)
+        self.lanes = int(self.settings.get(OPT_PRIORITY_LANES, 1)) > 1
+
+    def get_worker_type(self, header, body):
+        """Return type of worker the message should be routed to.
+
+        The header `x-worker-type` takes precedence over the message body.
+        """
+
+        worker = get_header(header, HEADER_WORKER_TYPE)
+        if worker is None:
+            settings = self.settings
+            worker = peek_worker_type(header, body,
+                                      settings.get('workitem_type_map', None),
+                                      settings.get('default_workitem_type',
+                                                   DEFAULT_CONTENT_TYPE),
+                                      self.blobstore)
+        return worker
+
+    def get_publisher(self, channel):
+        """Return publisher for channel."""
+
+        try:
+            return self.publishers[channel]
+        except KeyError:
+            if self.engine == ENGINE_SELECT:
+                publisher = ConfirmPublisher(channel)
+            else:
+                publisher = BatchPublisher(channel, self.batch_size,
+                                           self.batch_timeout)
+            self.publishers[channel] = publisher
+            return publisher
+
+    def get_properties(self, content_type, content_encoding=None,
+                       priority=None):
+        """Return properties of forwarded messages."""
+
+        key = (content_type, content_encoding, priority)
+        try:
+            return self._properties[key]
+        except KeyError:
+            properties = pika.BasicProperties(
+                delivery_mode=2,
+                content_type=content_type,
+                content_encoding=content_encoding,
+                priority=priority
+            )
+            self._properties[key] = properties
+            return properties
+
+    def get_priority(self, header, body):
+        """Return priority of task or None if priorities are disabled."""
+
+        if self.priorities is None:
+            return None
+
+        def load_workitem():
+            try:
+                return get_workitem(header, body,
+                                    self.settings.get('workitem_type_map',
+                                                      None),
+                                    self.settings.get('default_workitem_type',
+                                                      DEFAULT_CONTENT_TYPE),
+                                    self.blobstore)
+            except WorkitemError as err:
+                LOG.warning("Can't read priority of task: %s" % err)
+                return None
+        return self.priorities.get_priority(header, load_workitem)
 
     def handle_delivery(self, channel, method, header, body):
         """Handle delivery from WFE."""
-        LOG.debug("Method: %r" % method)
-        LOG.debug("Header: %r" % header)
-        LOG.debug("Body: %r" % body)
-        settings = dict(self.config.items(SECTION_TASKQUEUE))
+        LOG.debug("Method: %r", method)
+        LOG.debug("Header: %r", header)
+
+        publisher = self.get_publisher(channel)
+        if is_expired(header):
+            LOG.warning("drop expired task %r" % method.delivery_tag)
+            publisher.ack(method.delivery_tag)
+            self.expired += 1
+            return
 
         try:
-            workitem = get_workitem(header, body,
-                                    settings.get('workitem_type_map', None),
-                                    settings.get('default_workitem_type',
-                                                 DEFAULT_CONTENT_TYPE))
+            worker = self.get_worker_type(header, body)
         except WorkitemError as err:
             # Report error and accept message
             LOG.error("%s" % err)
-            channel.basic_ack(method.delivery_tag)
+            publisher.ack(method.delivery_tag)
             return
+        priority = self.get_priority(header, body)
 
-        worker = workitem.worker_type
-        channel.basic_publish(exchange='',
-                              routing_key='worker_%s' % worker,
-                              body=body,
-                              properties=pika.BasicProperties(
-                                  delivery_mode=2,
-                                  content_type=header.content_type
-                              ))
-
-        channel.basic_ack(method.delivery_tag)
+        # compressed and offloaded bodies are forwarded as is
+        encoding = header.content_encoding
+        ref = get_header(header, HEADER_BLOB_REF)
+        if ref is None:
+            if encoding not in CODECS:
+                body, compression = self.compressor.compress(body)
+                encoding = compression or encoding
+            if self.blobstore is not None:
+                try:
+                    body, ref = self.blobstore.offload(body)
+                except BlobStoreError as err:
+                    LOG.warning("%s. Forward body inline" % err)
+        # workers get absolute deadlines as the broker restarts expiration
+        # periods of messages routed to worker queues
+        deadline = get_deadline(header)
+        if ref is None and deadline is None:
+            properties = self.get_properties(header.content_type, encoding,
+                                             priority)
+        else:
+            headers = {HEADER_WORKER_TYPE: worker}
+            if ref is not None:
+                headers[HEADER_BLOB_REF] = ref
+            if deadline is not None:
+                headers[HEADER_DEADLINE] = long(deadline * 1000)
+            properties = pika.BasicProperties(
+                delivery_mode=2,
+                content_type=header.content_type,
+                content_encoding=encoding,
+                headers=headers,
+                priority=priority
+            )
+        queue = 'worker_%s' % worker
+        if self.lanes:
+            queue = get_lane_queue(queue, priority)
+        publisher.publish(method.delivery_tag, queue, body, properties)
+        self.forwarded += 1
 
     def run(self):
         """Event cycle."""
 
+        if self.processes > 1:
+            self.supervise()
+        else:
+            self.consume()
+
+    def supervise(self):
+        """Run consumer processes and restart crashed ones."""
+
+        self.stats_queue = Queue()
+        for index in range(self.processes):
+            self.start_consumer(index)
+
+        while True:
+            try:
+                self.update_stats(*self.stats_queue.get(timeout=1))
+            except Empty:
+                pass
+            for index, proc in self.consumers.items():
+                if not proc.is_alive():
+                    LOG.error("consumer process %r crashed unexpectedly" %
+                              proc)
+                    proc.join()
+                    self.start_consumer(index)
+
+    def start_consumer(self, index):
+        """Start consumer process."""
+
+        proc = Process(target=self.run_consumer, args=(index,))
+        proc.start()
+        self.consumers[index] = proc
+
+    def run_consumer(self, index):
+        """Consumer process entry point."""
+
+        # consumers are not supervisors
+        self.consumers = {}
+        self.consumer_index = index
+        self.consume()
+
+    def update_stats(self, index, pid, forwarded, reconnects=0,
+                     reconnect_time=0.0):
+        """Record counters reported by consumer process."""
+
+        now = time()
+        _, last_pid, last_forwarded, last_time = \
+                self.stats.get(index, (index, None, 0, now))
+        if last_pid != pid:
+            last_forwarded = 0
+        rate = (forwarded - last_forwarded) / max(now - last_time, 1e-3)
+        self.stats[index] = (index, pid, forwarded, now)
+        LOG.info("consumer %d (pid %d) forwarded %d messages, %.1f msg/s" %
+                 (index, pid, forwarded, rate))
+        if reconnects:
+            LOG.info("consumer %d (pid %d) reconnected %d times, %.3f s in "
+                     "total" % (index, pid, reconnects, reconnect_time))
+
+    def report_stats(self):
+        """Report counters to supervisor."""
+
+        self.stats_queue.put((self.consumer_index, os.getpid(),
+                              self.forwarded, self.reconnects,
+                              self.reconnect_time))
+        self.connection.add_timeout(REPORT_INTERVAL, self.report_stats)
+
+    def collect_blobs(self):
+        """Remove expired blob references."""
+
+        self.blobstore.collect(self.blob_ttl)
+        self.connection.add_timeout(COLLECT_INTERVAL, self.collect_blobs)
+
+    def start_timers(self, connection):
+        """Schedule periodic tasks of consumer."""
+
+        if self.stats_queue is not None:
+            connection.add_timeout(REPORT_INTERVAL, self.report_stats)
+        # blobs are collected by one consumer only
+        if self.blobstore is not None and self.consumer_index in (None, 0):
+            connection.add_timeout(COLLECT_INTERVAL, self.collect_blobs)
+
+    def consume(self):
+        """Consume deliveries with configured engine.
+
+        Lost connections are restored after a random delay growing
+        exponentially with every failed attempt.
+        """
+
+        while True:
+            self.connection_lost = False
+            try:
+                if self.engine == ENGINE_SELECT:
+                    self.run_select()
+                else:
+                    self.run_blocking()
+                if not self.connection_lost:
+                    return
+                error = "connection closed"
+            except CONNECTION_ERRORS as err:
+                error = err
+            # uncommitted and unconfirmed deliveries get redelivered
+            self.publishers = {}
+            self.channel = None
+            delay = self.backoff.next_delay()
+            LOG.error("connection to AMQP broker failed: %s. Reconnect in "
+                      "%.2f s" % (error, delay))
+            sleep(delay)
+
+    def on_reconnected(self):
+        """Record reconnection metrics."""
+
+        attempts, elapsed = self.backoff.reset()
+        if attempts:
+            self.reconnects += 1
+            self.reconnect_time += elapsed
+            LOG.info("reconnected to AMQP broker in %.3f s after %d failed "
+                     "attempts" % (elapsed, attempts))
+
+    def on_connection_closed(self, *args):
+        """Mark connection as lost unless dispatcher is stopping."""
+        if not self.stopping:
+            self.connection_lost = True
+
+    def run_blocking(self):
+        """Consume deliveries over blocking connection."""
+
         LOG.debug("create connection")
         self.connection = pika.BlockingConnection(self.amqp_params)
         LOG.debug("dispatcher connected")
+        self.on_reconnected()
+        self.start_timers(self.connection)
         self.channel = self.connection.channel()
         self.channel.queue_declare(queue="taskqueue", durable=True,
                                    exclusive=False, auto_delete=False)
+        if self.prefetch_count > 0:
+            self.channel.basic_qos(prefetch_count=self.prefetch_count)
         self.channel.basic_consume(self.handle_delivery, queue="taskqueue")
         self.channel.start_consuming()
 
+    def run_select(self):
+        """Consume deliveries over asynchronous connection."""
+
+        LOG.debug("create connection")
+        self.connection = pika.SelectConnection(self.amqp_params,
+                                                self.on_connected)
+        self.connection.ioloop.start()
+
+    def on_connected(self, connection):
+        """Open consuming channels."""
+
+        LOG.debug("dispatcher connected")
+        self.on_reconnected()
+        connection.add_on_close_callback(self.on_connection_closed)
+        self.start_timers(connection)
+        for _ in range(self.channels):
+            connection.channel(self.on_channel_open)
+
+    def on_channel_open(self, channel):
+        """Declare queue for opened channel."""
+
+        channel.queue_declare(partial(self.on_queue_declared, channel),
+                              queue="taskqueue", durable=True,
+                              exclusive=False, auto_delete=False)
+
+    def on_queue_declared(self, channel, frame):
+        """Start consuming from declared queue."""
+
+        if self.prefetch_count > 0:
+            channel.basic_qos(prefetch_count=self.prefetch_count)
+        self.get_publisher(channel)
+        channel.basic_consume(self.handle_delivery, queue="taskqueue")
+        LOG.debug("consuming over channel %s", channel.channel_number)
+
     def cleanup(self, signum, frame):
         """Handler for termination signals."""
 
+        # uncommitted batches get rolled back by the broker and their source
+        # deliveries are redelivered later
         LOG.debug("cleanup")
-        self.channel.stop_consuming()
-        self.connection.close()
+        self.stopping = True
+        for proc in self.consumers.values():
+            LOG.debug("terminating %r" % proc.name)
+            proc.terminate()
+        if self.connection is not None:
+            if self.channel is not None:
+                self.channel.stop_consuming()
+            self.connection.close()
         sys.exit(0)
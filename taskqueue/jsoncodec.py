@@ -0,0 +1,96 @@
+"""
+JSON codecs used by workitems.
+
+The module picks the fastest JSON library installed on the host. By default
+the decoder of `simplejson` is used if it's compiled with C speedups,
+otherwise the standard module `json` is used. Documents are encoded with
+`json` in both cases as its encoder is faster and the output stays the same.
+The library can be chosen explicitly with the option `json_codec` of
+the section `taskqueue`. `ujson` is used only if configured explicitly because
+its output differs from the output of `json`: it's more compact and its floats
+are less precise.
+"""
+
+import logging
+import json
+
+LOG = logging.getLogger(__name__)
+
+CODEC_AUTO = 'auto'
+
+class Codec(object):
+    """JSON library wrapper."""
+
+    def __init__(self, name, loads, dumps):
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+
+    def __repr__(self):
+        return "<Codec(%r)>" % self.name
+
+def _stdlib_codec():
+    return Codec('json', json.loads, json.dumps)
+
+def _simplejson_codec():
+    import simplejson
+    if simplejson.encoder.c_make_encoder is None:
+        raise ImportError("simplejson is not compiled with speedups")
+    return Codec('simplejson', simplejson.loads, json.dumps)
+
+def _ujson_codec():
+    import ujson
+    return Codec('ujson', ujson.loads, ujson.dumps)
+
+#: Factories of supported codecs
+CODECS = {
+    'json':       _stdlib_codec,
+    'simplejson': _simplejson_codec,
+    'ujson':      _ujson_codec
+}
+
+#: Codecs tried in the given order when codec is chosen automatically
+AUTO_ORDER = ('simplejson', 'json')
+
+def get_codec(name=CODEC_AUTO):
+    """Return codec by its name.
+
+    If the requested codec isn't available the standard module `json` is
+    used.
+
+    :param name: codec name or 'auto'
+    :type name: string
+    :rtype: Codec
+    """
+
+    if name == CODEC_AUTO:
+        names = AUTO_ORDER
+    elif name in CODECS:
+        names = (name, 'json')
+    else:
+        LOG.warning("unknown JSON codec '%s'. Fall back to 'json'" % name)
+        names = ('json',)
+
+    for cname in names:
+        try:
+            return CODECS[cname]()
+        except ImportError as err:
+            LOG.info("JSON codec '%s' is not available: %s" % (cname, err))
+    return _stdlib_codec()
+
+_CODEC = get_codec()
+
+def set_codec(name):
+    """Set codec used by :func:`loads` and :func:`dumps`."""
+
+    global _CODEC
+    _CODEC = get_codec(name)
+    LOG.debug("using JSON codec %r" % _CODEC)
+
+def loads(blob):
+    """Decode JSON document."""
+    return _CODEC.loads(blob)
+
+def dumps(obj):
+    """Encode object to JSON document."""
+    return _CODEC.dumps(obj)
@@ -0,0 +1,76 @@
+"""
+Binary Ruote workitems.
+
+This module requires the library `msgpack`. The workitems have the same
+structure as :class:`taskqueue.workitem.RuoteWorkitem` but are serialized
+with MessagePack which is more compact and faster to decode than JSON.
+"""
+
+import msgpack
+
+from taskqueue import jsoncodec
+from taskqueue.workitem import Workitem, RuoteWorkitem, RuoteWorkitemError
+
+#: Content type of binary Ruote workitems
+MSGPACK_CONTENT_TYPE = 'application/x-msgpack-workitem'
+
+#: Content type of JSON Ruote workitems
+RUOTE_CONTENT_TYPE = 'application/x-ruote-workitem'
+
+class MsgpackWorkitem(RuoteWorkitem):
+    """Ruote workitem serialized with MessagePack."""
+
+    @classmethod
+    def from_ruote(cls, workitem, mime_type=MSGPACK_CONTENT_TYPE):
+        """Convert JSON Ruote workitem to binary one.
+
+        :param workitem: Ruote workitem
+        :type workitem: RuoteWorkitem
+        :rtype: MsgpackWorkitem
+        """
+
+        wi_out = cls(mime_type)
+        wi_out.loads(packb(jsoncodec.loads(workitem.dumps())))
+        return wi_out
+
+    def to_ruote(self, mime_type=RUOTE_CONTENT_TYPE):
+        """Convert workitem to JSON Ruote workitem.
+
+        :rtype: RuoteWorkitem
+        """
+
+        wi_out = RuoteWorkitem(mime_type)
+        wi_out.loads(jsoncodec.dumps(self._get_body()))
+        return wi_out
+
+    def loads(self, blob):
+        self._blob = None
+        self._exposed = False
+        self._updates = {}
+        try:
+            self._body = msgpack.unpackb(blob, raw=False)
+            self._worker_type = self._body["fields"]["params"]["worker_type"]
+        except (ValueError, KeyError, TypeError, msgpack.UnpackException):
+            raise RuoteWorkitemError("Can't parse workitem body")
+
+    def peek_worker_type(self, blob):
+        """Return worker type unpacking the whole blob.
+
+        The blob isn't JSON text, so it can't be scanned like the blobs of
+        :class:`taskqueue.workitem.RuoteWorkitem`.
+        """
+        return Workitem.peek_worker_type(self, blob)
+
+    def dumps(self):
+        return packb(self._get_body())
+
+    def _get_body(self):
+        """Return workitem body."""
+
+        if self._body is None:
+            raise RuoteWorkitemError("Workitem hasn't been loaded")
+        return self._body
+
+def packb(body):
+    """Serialize workitem body."""
+    return msgpack.packb(body, use_bin_type=False)
@@ -2,7 +2,7 @@ import logging
 import os
 
 from taskqueue.worker import BaseWorker
-from subprocess import Popen, PIPE, STDOUT, call
+from taskqueue.subproc import run_command
 from derek import Client
 
 LOG = logging.getLogger(__name__)
@@ -16,17 +16,15 @@ class Worker(BaseWorker):
         pname   = workitem.fields['pkgname']
         pver    = workitem.fields['pkgversion']
         workdir = workitem.fields['workdir']
-        call(["dpkg-source", "-x", "%s_%s.dsc" % (pname, pver)], cwd=workdir)
+        run_command(["dpkg-source", "-x", "%s_%s.dsc" % (pname, pver)],
+                    cwd=workdir)
         pdir = os.path.join(workdir, "%s-%s" %
                             (pname, pver))
-        process = Popen(["dpkg-buildpackage", "-rfakeroot"],
-                        cwd=pdir,
-                        stdout=PIPE, stderr=STDOUT)
-        while True:
-            line = process.stdout.readline()
-            LOG.debug(line.strip('\n'))
-            if line == '' and process.poll() is not None:
-                break
+        # the full build log is kept next to the package
+        with open(os.path.join(workdir, "%s_%s.buildlog" % (pname, pver)),
+                  "w") as buildlog:
+            run_command(["dpkg-buildpackage", "-rfakeroot"], cwd=pdir,
+                        log_interval=10, output_file=buildlog)
         # publish the built package
         client = Client("vasya", "qwerty")
         branch = client.branch("%s/%s/%s" % (workitem.fields['user'],
@@ -0,0 +1,207 @@
+"""
+Priorities of tasks.
+
+Dispatchers derive the priority of a task from the header `x-priority`, the
+AMQP property `priority` or the workitem field named by the option
+`priority_field`, in this order. Priorities are integers between zero (the
+default) and a maximum.
+
+If the option `max_priority` is set, workers declare their queues with the
+argument `x-max-priority` and the broker delivers tasks with higher
+priorities first.
+
+Brokers without priority queues are supported by priority lanes. If the
+option `priority_lanes` is greater than one, tasks with priority `N` are
+routed to the queue `worker_<type>_p<N>`, tasks with priority zero go to the
+usual queue `worker_<type>`. Workers poll the lanes with `basic_get` either
+strictly by priority or by weights of lanes given in the option
+`lane_weights`, so that lower lanes don't starve.
+"""
+
+import logging
+
+from taskqueue.amqputils import get_header
+from taskqueue.workitem import get_field
+from taskqueue.confparser import OPT_MAX_PRIORITY, OPT_PRIORITY_FIELD, \
+                                 OPT_PRIORITY_LANES, OPT_LANE_MODE, \
+                                 OPT_LANE_WEIGHTS
+
+LOG = logging.getLogger(__name__)
+
+#: Header carrying priority of task
+HEADER_PRIORITY = 'x-priority'
+
+LANE_MODE_STRICT = 'strict'
+LANE_MODE_WEIGHTED = 'weighted'
+
+def get_max_priority(settings):
+    """Return maximum priority of tasks configured with options
+    `max_priority` and `priority_lanes`.
+
+    :param settings: configuration options
+    :type settings: dictionary
+    :rtype: integer
+    """
+
+    lanes = int(settings.get(OPT_PRIORITY_LANES, 1))
+    if lanes > 1:
+        return lanes - 1
+    return int(settings.get(OPT_MAX_PRIORITY, 0))
+
+def get_queue_arguments(settings):
+    """Return arguments of worker queues.
+
+    :param settings: configuration options
+    :type settings: dictionary
+    :returns: queue arguments or None
+    :rtype: dictionary
+    """
+
+    max_priority = int(settings.get(OPT_MAX_PRIORITY, 0))
+    if max_priority > 0 and int(settings.get(OPT_PRIORITY_LANES, 1)) <= 1:
+        return {'x-max-priority': max_priority}
+    return None
+
+def get_lane_queue(queue, priority):
+    """Return name of queue of priority lane.
+
+    :param queue: name of worker queue
+    :type queue: string
+    :param priority: priority of lane
+    :type priority: integer
+    :rtype: string
+    """
+
+    if not priority:
+        return queue
+    return "%s_p%d" % (queue, priority)
+
+class PriorityResolver(object):
+    """Resolver of priorities of forwarded tasks."""
+
+    def __init__(self, max_priority, field=None):
+        """Constructor.
+
+        :param max_priority: maximum priority
+        :type max_priority: integer
+        :param field: path to workitem field with priority separated by dots
+        :type field: string
+        """
+
+        self.max_priority = max_priority
+        self.field = field and field.split('.')
+
+    def get_priority(self, header, load_workitem):
+        """Return priority of task.
+
+        :param header: AMQP message header
+        :type header: pika.frame.Header
+        :param load_workitem: callable returning workitem of the message,
+                              called only if the priority can't be taken
+                              from the header
+        :type load_workitem: callable
+        :returns: priority or None if the task has no priority
+        :rtype: integer
+        """
+
+        priority = get_header(header, HEADER_PRIORITY)
+        if priority is None:
+            priority = getattr(header, 'priority', None)
+        if priority is None and self.field:
+            priority = get_field(load_workitem(), self.field)
+        if priority is None:
+            return None
+        try:
+            priority = int(priority)
+        except (TypeError, ValueError):
+            LOG.warning("invalid priority %r" % (priority,))
+            return None
+        return max(0, min(priority, self.max_priority))
+
+def get_priority_resolver(settings):
+    """Create priority resolver configured with options `max_priority`,
+    `priority_lanes` and `priority_field`.
+
+    :param settings: configuration options
+    :type settings: dictionary
+    :returns: resolver or None if priorities are not enabled
+    :rtype: PriorityResolver
+    """
+
+    max_priority = get_max_priority(settings)
+    if max_priority <= 0:
+        return None
+    return PriorityResolver(max_priority,
+                            settings.get(OPT_PRIORITY_FIELD, None))
+
+class LaneScheduler(object):
+    """Scheduler choosing priority lanes to poll."""
+
+    def __init__(self, lanes, mode=LANE_MODE_STRICT, weights=None):
+        """Constructor.
+
+        :param lanes: number of lanes
+        :type lanes: integer
+        :param mode: `strict` or `weighted`
+        :type mode: string
+        :param weights: weights of lanes starting from the lowest priority,
+                        by default every lane weighs twice as much as the
+                        lower one
+        :type weights: list
+        """
+
+        if mode not in (LANE_MODE_STRICT, LANE_MODE_WEIGHTED):
+            LOG.warning("unknown lane mode '%s'. Lanes are polled strictly "
+                        "by priority" % mode)
+            mode = LANE_MODE_STRICT
+        if weights is None or len(weights) != lanes:
+            if weights is not None:
+                LOG.warning("lane_weights should have %d values" % lanes)
+            weights = [2 ** lane for lane in range(lanes)]
+        self.lanes = lanes
+        self.mode = mode
+        self.weights = weights
+        self._by_priority = range(lanes - 1, -1, -1)
+        self._current = [0] * lanes
+
+    def order(self):
+        """Return lanes in order they should be polled.
+
+        In weighted mode the first lane is chosen by smooth weighted
+        round-robin, the rest are ordered by priority.
+
+        :rtype: list
+        """
+
+        if self.mode == LANE_MODE_STRICT:
+            return self._by_priority
+        total = 0
+        chosen = 0
+        for lane, weight in enumerate(self.weights):
+            self._current[lane] += weight
+            total += weight
+            if self._current[lane] > self._current[chosen]:
+                chosen = lane
+        self._current[chosen] -= total
+        return [chosen] + [lane for lane in self._by_priority
+                           if lane != chosen]
+
+def get_lane_scheduler(settings):
+    """Create lane scheduler configured with options `priority_lanes`,
+    `lane_mode` and `lane_weights`.
+
+    :param settings: configuration options
+    :type settings: dictionary
+    :returns: scheduler or None if priority lanes are not enabled
+    :rtype: LaneScheduler
+    """
+
+    lanes = int(settings.get(OPT_PRIORITY_LANES, 1))
+    if lanes <= 1:
+        return None
+    weights = settings.get(OPT_LANE_WEIGHTS, None)
+    if weights:
+        weights = [int(weight) for weight in weights.split(',')]
+    return LaneScheduler(lanes,
+                         settings.get(OPT_LANE_MODE, LANE_MODE_STRICT),
+                         weights or None)
@@ -0,0 +1,197 @@
+"""Batched publishing of AMQP messages."""
+
+import logging
+
+from collections import deque
+
+LOG = logging.getLogger(__name__)
+
+class BatchPublisher(object):
+    """Publisher committing messages to AMQP broker in batches.
+
+    Every published message is bound to the delivery it's produced from.
+    When the batch is full or its timeout expires the source deliveries get
+    acknowledged and the channel transaction is committed. Thus the broker
+    takes the published messages and forgets the source deliveries
+    atomically: if the process crashes before commit the source deliveries
+    are redelivered and nothing is lost.
+
+    A publisher with batch size 1 commits every delivery in its own
+    transaction.
+    """
+
+    def __init__(self, channel, size=1, timeout=0, multiple=True,
+                 on_commit=None):
+        """Constructor.
+
+        :param channel: AMQP channel
+        :type channel: pika.channel.Channel
+        :param size: maximum number of deliveries in batch
+        :type size: integer
+        :param timeout: maximum time in seconds a batch is kept open
+        :type timeout: float
+        :param multiple: acknowledge deliveries with one `basic_ack` if True
+        :type multiple: boolean
+        :param on_commit: callback called with the list of delivery tags of
+                          every committed batch
+        :type on_commit: callable
+        """
+
+        self.channel = channel
+        self.size = size
+        self.timeout = timeout
+        self.multiple = multiple
+        self.on_commit = on_commit
+        self._tags = []
+        self._timeout_id = None
+        self.channel.tx_select()
+
+    def publish(self, delivery_tag, routing_key, body, properties):
+        """Publish message produced from given delivery.
+
+        :param delivery_tag: tag of source delivery
+        :type delivery_tag: integer
+        :param routing_key: routing key
+        :type routing_key: string
+        :param body: message body
+        :type body: string
+        :param properties: message properties
+        :type properties: pika.spec.BasicProperties
+        """
+
+        self.channel.basic_publish(exchange='', routing_key=routing_key,
+                                   body=body, properties=properties)
+        self.ack(delivery_tag)
+
+    def ack(self, delivery_tag):
+        """Acknowledge delivery as a part of batch.
+
+        :param delivery_tag: tag of source delivery
+        :type delivery_tag: integer
+        """
+
+        self._tags.append(delivery_tag)
+        if len(self._tags) >= self.size:
+            self.flush()
+        elif self._timeout_id is None and self.timeout > 0:
+            self._timeout_id = self.channel.connection.add_timeout(
+                self.timeout, self._on_timeout)
+
+    def flush(self):
+        """Commit current batch."""
+
+        if self._timeout_id is not None:
+            self.channel.connection.remove_timeout(self._timeout_id)
+            self._timeout_id = None
+
+        if not self._tags:
+            return
+
+        if self.multiple:
+            self.channel.basic_ack(delivery_tag=self._tags[-1], multiple=True)
+        else:
+            for tag in self._tags:
+                self.channel.basic_ack(delivery_tag=tag)
+        self.channel.tx_commit()
+        LOG.debug("committed batch of %d deliveries", len(self._tags))
+        tags, self._tags = self._tags, []
+        if self.on_commit is not None:
+            self.on_commit(tags)
+
+    def _on_timeout(self):
+        """Commit batch upon timeout."""
+        self._timeout_id = None
+        self.flush()
+
+class ConfirmPublisher(object):
+    """Publisher for asynchronous channels with publisher confirms.
+
+    Messages are published without waiting for the broker. A source delivery
+    gets acknowledged as soon as the broker confirms the message produced
+    from it and all the messages published before. If the broker rejects
+    a message its source delivery is requeued.
+    """
+
+    def __init__(self, channel):
+        """Constructor.
+
+        :param channel: AMQP channel of asynchronous connection
+        :type channel: pika.channel.Channel
+        """
+
+        self.channel = channel
+        self._seq = 0
+        # entries are lists [publish sequence number, delivery tag, status]
+        self._pending = deque()
+        self.channel.confirm_delivery(self.on_confirm)
+
+    @property
+    def in_flight(self):
+        """Number of source deliveries waiting for confirmation."""
+        return len(self._pending)
+
+    def publish(self, delivery_tag, routing_key, body, properties):
+        """Publish message produced from given delivery.
+
+        :param delivery_tag: tag of source delivery
+        :type delivery_tag: integer
+        :param routing_key: routing key
+        :type routing_key: string
+        :param body: message body
+        :type body: string
+        :param properties: message properties
+        :type properties: pika.spec.BasicProperties
+        """
+
+        self.channel.basic_publish(exchange='', routing_key=routing_key,
+                                   body=body, properties=properties)
+        self._seq += 1
+        self._pending.append([self._seq, delivery_tag, None])
+
+    def ack(self, delivery_tag):
+        """Acknowledge delivery after preceding ones are confirmed.
+
+        :param delivery_tag: tag of source delivery
+        :type delivery_tag: integer
+        """
+
+        self._pending.append([None, delivery_tag, True])
+        self._advance()
+
+    def flush(self):
+        """Do nothing as there is nothing to commit."""
+        pass
+
+    def on_confirm(self, frame):
+        """Handle Basic.Ack and Basic.Nack sent by broker."""
+
+        method = frame.method
+        status = method.NAME == 'Basic.Ack'
+        for entry in self._pending:
+            seq = entry[0]
+            if seq is None:
+                continue
+            if seq > method.delivery_tag:
+                break
+            if entry[2] is None and (seq == method.delivery_tag or
+                                     method.multiple):
+                entry[2] = status
+        self._advance()
+
+    def _advance(self):
+        """Settle source deliveries in the order they were received."""
+
+        last_acked = None
+        while self._pending and self._pending[0][2] is not None:
+            _, delivery_tag, status = self._pending.popleft()
+            if status:
+                last_acked = delivery_tag
+                continue
+            if last_acked is not None:
+                self.channel.basic_ack(delivery_tag=last_acked, multiple=True)
+                last_acked = None
+            LOG.warning("broker rejected message from delivery %s",
+                        delivery_tag)
+            self.channel.basic_nack(delivery_tag=delivery_tag, requeue=True)
+        if last_acked is not None:
+            self.channel.basic_ack(delivery_tag=last_acked, multiple=True)
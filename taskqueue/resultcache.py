@@ -0,0 +1,240 @@
+"""
+Persistent cache of task results.
+
+Workers may skip tasks identical to the ones handled before, e.g. Ruote
+workitems dispatched again. Results are looked up by a key built from the
+worker type and the workitem fields listed in the option `result_cache_key`.
+Nested fields are addressed with dots, e.g. `params.ref`.
+
+The cache is an SQLite database which can be shared by all the processes of
+a worker type. Only the fields of resulting workitems are stored, so the
+cache works with workitems having the attribute `fields` like
+:class:`taskqueue.workitem.RuoteWorkitem`. On hit the fields of the received
+workitem except `params` are replaced with the cached ones. Entries expire
+after `result_cache_ttl` seconds and the least recently used entries are
+evicted when the cache grows bigger than `result_cache_size` entries.
+
+Only results returned by `handle_task()` normally are cached. Workitems
+lacking any of the key fields are neither cached nor looked up, and tasks
+are handled as usual if the database can't be accessed.
+"""
+
+import logging
+import json
+import sqlite3
+import threading
+
+from time import time
+from hashlib import sha1
+
+from taskqueue import jsoncodec
+from taskqueue.workitem import get_field
+from taskqueue.confparser import OPT_RESULT_CACHE, OPT_RESULT_CACHE_KEY, \
+                                 OPT_RESULT_CACHE_TTL, OPT_RESULT_CACHE_SIZE
+
+LOG = logging.getLogger(__name__)
+
+#: Default lifetime of cached results in seconds
+DEFAULT_TTL = 86400
+
+#: Default maximum number of cached results
+DEFAULT_SIZE = 10000
+
+#: Fields of received workitems preserved when results are copied
+PRESERVED_FIELDS = ('params',)
+
+def get_key(workitem, key_fields):
+    """Return key identifying result of workitem.
+
+    :param workitem: workflow work item
+    :type workitem: Workitem
+    :param key_fields: paths to fields the key is built from, split by dots
+    :type key_fields: list
+    :returns: key or None if the workitem lacks any of the fields
+    :rtype: string
+    """
+
+    if not hasattr(workitem, 'fields'):
+        return None
+
+    values = [get_field(workitem, path) for path in key_fields]
+    if None in values:
+        # unrelated workitems would share the key
+        return None
+    return sha1(json.dumps([workitem.worker_type, values],
+                           sort_keys=True)).hexdigest()
+
+def restore_fields(workitem, fields):
+    """Replace fields of workitem with fields of another result.
+
+    :param workitem: workflow work item
+    :type workitem: Workitem
+    :param fields: fields of result
+    :type fields: dictionary
+    """
+
+    current = workitem.fields
+    for name in PRESERVED_FIELDS:
+        if name in current:
+            fields[name] = current[name]
+    current.clear()
+    current.update(fields)
+
+def get_key_fields(value):
+    """Parse comma-separated list of field paths.
+
+    :param value: option value
+    :type value: string
+    :rtype: list
+    """
+
+    return [field.strip() for field in value.split(',') if field.strip()]
+
+class ResultCache(object):
+    """SQLite-backed cache of workitem fields."""
+
+    def __init__(self, path, key_fields, ttl=DEFAULT_TTL, size=DEFAULT_SIZE):
+        """Constructor.
+
+        :param path: path to database file
+        :type path: string
+        :param key_fields: names of fields the cache key is built from
+        :type key_fields: list
+        :param ttl: lifetime of cached results in seconds
+        :type ttl: float
+        :param size: maximum number of cached results
+        :type size: integer
+        """
+
+        self.path = path
+        self.key_fields = [field.split('.') for field in key_fields]
+        self.ttl = ttl
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        # tasks may run in a thread pool
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS results ("
+                         "key TEXT PRIMARY KEY, fields TEXT, "
+                         "created REAL, accessed REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_accessed "
+                         "ON results (accessed)")
+
+    def __repr__(self):
+        return "<ResultCache(%r)>" % self.path
+
+    @property
+    def hit_ratio(self):
+        """Ratio of lookups found in cache."""
+
+        lookups = self.hits + self.misses
+        if not lookups:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def get_key(self, workitem):
+        """Return cache key of workitem.
+
+        :param workitem: workflow work item
+        :type workitem: Workitem
+        :returns: cache key or None if the workitem can't be cached
+        :rtype: string
+        """
+
+        return get_key(workitem, self.key_fields)
+
+    def restore(self, key, workitem):
+        """Update workitem with cached result.
+
+        :param key: cache key
+        :type key: string
+        :param workitem: workflow work item
+        :type workitem: Workitem
+        :returns: True on hit
+        :rtype: boolean
+        """
+
+        now = time()
+        with self._lock:
+            try:
+                row = self._db.execute("SELECT fields FROM results "
+                                       "WHERE key = ? AND created >= ?",
+                                       (key, now - self.ttl)).fetchone()
+                if row is not None:
+                    self._db.execute("UPDATE results SET accessed = ? "
+                                     "WHERE key = ?", (now, key))
+            except sqlite3.Error as err:
+                LOG.warning("Can't look up result %s: %s" % (key, err))
+                row = None
+            if row is None:
+                self.misses += 1
+                return False
+            self.hits += 1
+
+        restore_fields(workitem, jsoncodec.loads(row[0]))
+        LOG.debug("restored result of %r from cache" % workitem)
+        return True
+
+    def store(self, key, workitem):
+        """Store result of task.
+
+        :param key: cache key
+        :type key: string
+        :param workitem: resulting work item
+        :type workitem: Workitem
+        """
+
+        try:
+            fields = jsoncodec.dumps(workitem.fields)
+        except AttributeError:
+            return
+        now = time()
+        with self._lock:
+            try:
+                self._store(key, fields, now)
+            except sqlite3.Error as err:
+                LOG.warning("Can't store result %s: %s" % (key, err))
+
+    def _store(self, key, fields, now):
+        """Insert result and evict expired and excess ones."""
+
+        self._db.execute("INSERT OR REPLACE INTO results "
+                         "(key, fields, created, accessed) "
+                         "VALUES (?, ?, ?, ?)", (key, fields, now, now))
+        self._db.execute("DELETE FROM results WHERE created < ?",
+                         (now - self.ttl,))
+        count = self._db.execute("SELECT COUNT(*) FROM results")\
+                .fetchone()[0]
+        if count > self.size:
+            self._db.execute("DELETE FROM results WHERE key IN "
+                             "(SELECT key FROM results "
+                             "ORDER BY accessed LIMIT ?)",
+                             (count - self.size,))
+
+    def close(self):
+        """Close database."""
+        self._db.close()
+
+def get_result_cache(settings):
+    """Create result cache configured with options `result_cache`,
+    `result_cache_key`, `result_cache_ttl` and `result_cache_size`.
+
+    :param settings: configuration options
+    :type settings: dictionary
+    :returns: result cache or None if it's not configured
+    :rtype: ResultCache
+    """
+
+    path = settings.get(OPT_RESULT_CACHE, None)
+    if not path:
+        return None
+    key_fields = get_key_fields(settings.get(OPT_RESULT_CACHE_KEY, ''))
+    if not key_fields:
+        LOG.warning("result_cache_key is not set. Results won't be cached")
+        return None
+    return ResultCache(path, key_fields,
+                       float(settings.get(OPT_RESULT_CACHE_TTL, DEFAULT_TTL)),
+                       int(settings.get(OPT_RESULT_CACHE_SIZE, DEFAULT_SIZE)))
@@ -0,0 +1,161 @@
+"""
+Autoscaling of worker processes.
+
+If the option `max_instances` is set, the worker pool scales the number of
+processes of a worker type or subgroup between `min_instances` and
+`max_instances`. Every `scale_interval` seconds the pool samples the number
+of ready messages in the queues of the type with passive `queue.declare` and
+the number of its processes busy with tasks.
+
+The group scales up as soon as tasks wait in the queue while at least
+`scale_up_ratio` of its processes are busy. The number of processes at most
+doubles per sample. The group scales down only after its queue stays empty
+and at most `scale_down_ratio` of its processes stay busy for
+`scale_down_delay` seconds, then half of its idle processes are drained
+with SIGUSR2 like recycled ones. The gap between the ratios and the delay
+keep the group from flapping. Processes running tasks in a thread pool or
+asynchronously count as busy while they run any task.
+"""
+
+import logging
+
+from taskqueue.confparser import OPT_INSTANCES, OPT_MIN_INSTANCES, \
+                                 OPT_MAX_INSTANCES, OPT_SCALE_INTERVAL, \
+                                 OPT_SCALE_UP_RATIO, OPT_SCALE_DOWN_RATIO, \
+                                 OPT_SCALE_DOWN_DELAY
+
+LOG = logging.getLogger(__name__)
+
+#: Default number of seconds between samples of load
+DEFAULT_INTERVAL = 10
+
+#: Default share of busy processes needed to scale up
+DEFAULT_UP_RATIO = 0.75
+
+#: Default maximum share of busy processes allowing to scale down
+DEFAULT_DOWN_RATIO = 0.25
+
+#: Default number of seconds of low load before scaling down
+DEFAULT_DOWN_DELAY = 60
+
+def get_queue_depth(channel, queues):
+    """Return number of ready messages in queues.
+
+    :param channel: channel to AMQP broker
+    :type channel: pika.adapters.blocking_connection.BlockingChannel
+    :param queues: names of queues
+    :type queues: list
+    :rtype: integer
+    """
+
+    depth = 0
+    for queue in queues:
+        frame = channel.queue_declare(queue=queue, passive=True)
+        depth += frame.method.message_count
+    return depth
+
+class Scaler(object):
+    """Autoscaler of group of worker processes."""
+
+    def __init__(self, name, min_instances, max_instances,
+                 interval=DEFAULT_INTERVAL, up_ratio=DEFAULT_UP_RATIO,
+                 down_ratio=DEFAULT_DOWN_RATIO, down_delay=DEFAULT_DOWN_DELAY):
+        """Constructor.
+
+        :param name: name of scaled group
+        :type name: string
+        :param min_instances: minimum number of processes
+        :type min_instances: integer
+        :param max_instances: maximum number of processes
+        :type max_instances: integer
+        :param interval: number of seconds between samples of load
+        :type interval: float
+        :param up_ratio: share of busy processes needed to scale up
+        :type up_ratio: float
+        :param down_ratio: maximum share of busy processes allowing to scale
+                           down
+        :type down_ratio: float
+        :param down_delay: number of seconds of low load before scaling down
+        :type down_delay: float
+        """
+
+        self.name = name
+        self.min_instances = min_instances
+        self.max_instances = max(min_instances, max_instances)
+        self.interval = interval
+        self.up_ratio = up_ratio
+        self.down_ratio = down_ratio
+        self.down_delay = down_delay
+        self.sampled = None
+        self.idle_since = None
+        self.ups = 0
+        self.downs = 0
+
+    def __repr__(self):
+        return "<Scaler(%r, %d-%d)>" % (self.name, self.min_instances,
+                                       self.max_instances)
+
+    def is_due(self, now):
+        """Check if load should be sampled."""
+        return self.sampled is None or now >= self.sampled + self.interval
+
+    def get_target(self, now, running, busy, ready):
+        """Return wanted number of processes.
+
+        :param now: time of sample
+        :type now: float
+        :param running: number of processes
+        :type running: integer
+        :param busy: number of processes busy with tasks
+        :type busy: integer
+        :param ready: number of tasks waiting in queue
+        :type ready: integer
+        :rtype: integer
+        """
+
+        self.sampled = now
+        target = max(self.min_instances, min(running, self.max_instances))
+        if ready > 0 and busy >= self.up_ratio * running:
+            self.idle_since = None
+            target = min(self.max_instances,
+                         running + min(ready, max(1, running)))
+        elif ready == 0 and busy <= self.down_ratio * running:
+            if self.idle_since is None:
+                self.idle_since = now
+            elif now - self.idle_since >= self.down_delay:
+                # wait another delay before the next step down
+                self.idle_since = now
+                target = max(self.min_instances,
+                             running - max(1, (running - busy) // 2))
+        else:
+            self.idle_since = None
+
+        if target > running:
+            self.ups += 1
+        elif target < running:
+            self.downs += 1
+        return target
+
+def get_scaler(name, settings):
+    """Create autoscaler configured with options `min_instances`,
+    `max_instances`, `scale_interval`, `scale_up_ratio`,
+    `scale_down_ratio` and `scale_down_delay`.
+
+    :param name: name of scaled group
+    :type name: string
+    :param settings: configuration options
+    :type settings: dictionary
+    :returns: scaler or None if autoscaling is not enabled
+    :rtype: Scaler
+    """
+
+    if not settings.get(OPT_MAX_INSTANCES):
+        return None
+    return Scaler(
+        name,
+        int(settings.get(OPT_MIN_INSTANCES, settings.get(OPT_INSTANCES, 1))),
+        int(settings[OPT_MAX_INSTANCES]),
+        float(settings.get(OPT_SCALE_INTERVAL, DEFAULT_INTERVAL)),
+        float(settings.get(OPT_SCALE_UP_RATIO, DEFAULT_UP_RATIO)),
+        float(settings.get(OPT_SCALE_DOWN_RATIO, DEFAULT_DOWN_RATIO)),
+        float(settings.get(OPT_SCALE_DOWN_DELAY, DEFAULT_DOWN_DELAY)))
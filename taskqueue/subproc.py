@@ -0,0 +1,190 @@
+"""
+Running subprocesses from workers.
+
+:func:`run_command` runs a command with its stdout and stderr read through
+one non-blocking pipe in big chunks. Only the tail of the output is kept in
+a bounded ring buffer, the whole output may be written to a file. Lines of
+the output are logged at most once per `log_interval` seconds, so chatty
+commands don't flood logs. Commands running longer than `timeout` seconds
+are killed along with their children.
+
+If the command fails, :class:`CommandError` carries the tail of its output,
+which is attached to the reported workitem by the error message::
+
+    class Worker(BaseWorker):
+
+        def handle_task(self, workitem):
+            run_command(["make"], cwd=workitem.fields["workdir"],
+                        timeout=3600, log_interval=10)
+            return workitem
+"""
+
+import logging
+import os
+import errno
+import fcntl
+import select
+import signal
+
+from time import time, sleep
+from collections import deque
+from subprocess import Popen, PIPE, STDOUT
+
+LOG = logging.getLogger(__name__)
+
+#: Default size of kept output tail in bytes
+DEFAULT_TAIL_SIZE = 8192
+
+#: Size of chunks read from pipe
+CHUNK_SIZE = 65536
+
+#: Seconds given to timed out commands to exit after SIGTERM
+KILL_GRACE = 5
+
+class CommandError(Exception):
+    """Failure of command."""
+
+    def __init__(self, message, returncode=None, output=""):
+        super(CommandError, self).__init__(message)
+        self.returncode = returncode
+        self.output = output
+
+    def __str__(self):
+        message = super(CommandError, self).__str__()
+        if not self.output:
+            return message
+        return "%s. Last output:\n%s" % (message, self.output)
+
+class RingBuffer(object):
+    """Buffer keeping the last bytes written to it."""
+
+    def __init__(self, size=DEFAULT_TAIL_SIZE):
+        """Constructor.
+
+        :param size: number of kept bytes
+        :type size: integer
+        """
+
+        self.size = size
+        self.length = 0
+        self._chunks = deque()
+
+    def write(self, data):
+        """Append data to buffer."""
+
+        self._chunks.append(data)
+        self.length += len(data)
+        while self.length - len(self._chunks[0]) >= self.size:
+            self.length -= len(self._chunks.popleft())
+
+    def getvalue(self):
+        """Return the last `size` bytes written."""
+        return "".join(self._chunks)[-self.size:]
+
+def _kill(process):
+    """Kill process group of command."""
+
+    for signum, grace in ((signal.SIGTERM, KILL_GRACE), (signal.SIGKILL, 0)):
+        try:
+            os.killpg(process.pid, signum)
+        except OSError as err:
+            if err.errno != errno.ESRCH:
+                raise
+        deadline = time() + grace
+        while process.poll() is None and time() < deadline:
+            sleep(0.1)
+        if process.poll() is not None:
+            return
+    process.wait()
+
+def _time_out(process, args, timeout, tail):
+    """Kill timed out command and return error to raise."""
+
+    _kill(process)
+    return CommandError("Command %r timed out after %g seconds" %
+                        (args, timeout), process.returncode, tail.getvalue())
+
+def run_command(args, timeout=None, tail_size=DEFAULT_TAIL_SIZE,
+                log_interval=None, output_file=None, **kwargs):
+    """Run command and return the tail of its output.
+
+    :param args: command and its arguments
+    :type args: list
+    :param timeout: maximum run time in seconds, unlimited if None
+    :type timeout: float
+    :param tail_size: number of kept bytes of output
+    :type tail_size: integer
+    :param log_interval: minimum number of seconds between logged lines of
+                         output, output is not logged if None
+    :type log_interval: float
+    :param output_file: file the whole output is written to
+    :type output_file: file
+    :param kwargs: other arguments of `subprocess.Popen`, e.g. `cwd`
+    :returns: tail of output
+    :rtype: string
+    :raises CommandError: if the command fails or times out
+    """
+
+    LOG.debug("run %r" % (args,))
+    try:
+        # own process group lets kill children of timed out commands
+        process = Popen(args, stdout=PIPE, stderr=STDOUT,
+                        preexec_fn=os.setsid, close_fds=True, **kwargs)
+    except OSError as err:
+        raise CommandError("Can't run %r: %s" % (args, err))
+
+    fd = process.stdout.fileno()
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) |
+                os.O_NONBLOCK)
+    tail = RingBuffer(tail_size)
+    started = time()
+    logged = 0
+    try:
+        while True:
+            wait = None
+            if timeout is not None:
+                wait = started + timeout - time()
+                if wait <= 0:
+                    raise _time_out(process, args, timeout, tail)
+            try:
+                readable = select.select([fd], [], [], wait)[0]
+            except select.error as err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not readable:
+                continue
+            try:
+                data = os.read(fd, CHUNK_SIZE)
+            except OSError as err:
+                if err.errno in (errno.EAGAIN, errno.EINTR):
+                    continue
+                raise
+            if not data:
+                break
+            tail.write(data)
+            if output_file is not None:
+                output_file.write(data)
+            if log_interval is not None and time() - logged >= log_interval:
+                logged = time()
+                lines = data.rstrip("\n").rsplit("\n", 1)
+                LOG.debug("%r: %s" % (args[0], lines[-1]))
+        # the command may close its output and keep running
+        while timeout is not None and process.poll() is None:
+            wait = started + timeout - time()
+            if wait <= 0:
+                raise _time_out(process, args, timeout, tail)
+            sleep(min(wait, 0.1))
+    except BaseException:
+        # e.g. task timeout or worker shutdown
+        if process.poll() is None:
+            _kill(process)
+        raise
+    finally:
+        process.stdout.close()
+
+    returncode = process.wait()
+    if returncode != 0:
+        raise CommandError("Command %r failed with exit code %d" %
+                           (args, returncode), returncode, tail.getvalue())
+    return tail.getvalue()
@@ -6,6 +6,52 @@ Your custom functionality should be put into the method `handle_task()`.
 And if you want to modify the way how task results are reported or tracked
 then override the method `report_results()` of your worker subclass.
 
+If the option `concurrency` is greater than one `handle_task()` is called
+from a pool of threads, so one worker process can handle several tasks
+simultaneously. Results are still reported and acknowledged from the thread
+owning the AMQP connection.
+
+Workers able to amortize setup costs across many tasks may override the
+method `handle_batch()` instead. Such workers collect up to `task_batch_size`
+deliveries or wait for `task_batch_timeout` milliseconds, handle the collected
+workitems at once and acknowledge all the deliveries with one `basic_ack`.
+
+Results can be published in transactional batches of `results_batch_size`
+messages. Deliveries are acknowledged in the same transactions as their
+results, so a delivery is never acknowledged unless the broker has taken its
+results.
+
+Workers losing connection to the broker reconnect in the same process after
+a random delay growing exponentially up to `reconnect_max_delay` seconds.
+
+Results of tasks can be cached in the database `result_cache` shared by all
+processes of a worker type. Tasks whose workitems match a cached one in the
+fields listed in `result_cache_key` are not handled, the cached result is
+reported instead. See :mod:`taskqueue.resultcache`.
+
+Processes of a worker type may also coalesce duplicate tasks received while
+the original one is running: duplicates wait for the original task and report
+copies of its result. See :mod:`taskqueue.coalescer`.
+
+Tasks running longer than `task_timeout` seconds are interrupted and reported
+with an error, then the worker process exits to be replaced by the worker
+pool. The pool kills workers which don't get interrupted in time and marks
+their tasks, so the tasks are reported with an error once redelivered instead
+of hanging the next worker. Deliveries whose deadline has passed are
+acknowledged and dropped without parsing. See
+:func:`taskqueue.amqputils.get_deadline`.
+
+Worker processes are recycled after `max_tasks_per_child` tasks or once their
+resident memory exceeds `max_rss_mb` megabytes. The worker asks the worker
+pool for a replacement, the pool starts it and sends SIGUSR2 to the worker,
+which stops consuming, finishes and reports running tasks and exits. Workers
+run outside of the pool drain right away. Prefetched tasks which haven't
+started are redelivered.
+
+Worker queues are declared with the argument `x-max-priority` if the option
+`max_priority` is set. With `priority_lanes` workers poll one queue per
+priority instead. See :mod:`taskqueue.priority`.
+
 Taskqueue uses the `pkg_resources` library to discover registered
 plugins. So in order to make your plugins visible to your taskqueue
 installation you need to register your worker factories as entry points under
@@ -25,17 +71,64 @@ import logging
 import pika
 import signal
 import os
+import resource
 import traceback
 
 from pwd import getpwnam
-
-from taskqueue.confparser import OPT_RESULTS_ROUTING_KEY
+from time import sleep, time
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from Queue import Queue, Empty
+
+from taskqueue.confparser import OPT_RESULTS_ROUTING_KEY, OPT_JSON_CODEC, \
+                                 OPT_CONCURRENCY, OPT_PREFETCH, \
+                                 OPT_TASK_BATCH_SIZE, OPT_TASK_BATCH_TIMEOUT, \
+                                 OPT_RESULTS_BATCH_SIZE, \
+                                 OPT_RESULTS_BATCH_TIMEOUT, OPT_TASK_TIMEOUT, \
+                                 OPT_MAX_TASKS_PER_CHILD, OPT_MAX_RSS_MB
+from taskqueue.jsoncodec import set_codec, CODEC_AUTO
+from taskqueue.compression import Compressor, get_compressor
+from taskqueue.resultcache import get_result_cache
+from taskqueue.coalescer import get_coalescer
+from taskqueue.blobstore import get_blobstore, BlobStoreError
+from taskqueue.amqputils import get_header, get_backoff, is_expired, \
+                                get_digest, HEADER_BLOB_REF, \
+                                CONNECTION_ERRORS
+from taskqueue.publisher import BatchPublisher
+from taskqueue.priority import get_queue_arguments, get_lane_queue, \
+                               get_lane_scheduler
 from taskqueue.workitem import get_workitem, WorkitemError, DEFAULT_CONTENT_TYPE
 
 LOG = logging.getLogger(__name__)
 
 CFG_DEFAULT_RES_ROUTING = "results"
 
+#: Default maximum number of tasks handled by `handle_batch()` at once
+DEFAULT_TASK_BATCH_SIZE = 10
+
+#: Default time in milliseconds a batch of tasks is collected
+DEFAULT_TASK_BATCH_TIMEOUT = 100
+
+#: Default time in milliseconds a batch of results is kept uncommitted
+DEFAULT_RESULTS_BATCH_TIMEOUT = 100
+
+#: Size of memory pages in bytes
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+class TaskTimeout(Exception):
+    pass
+
+def get_rss():
+    """Return resident memory of current process in megabytes."""
+
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+        return pages * PAGE_SIZE / 1048576.0
+    except (IOError, ValueError, IndexError):
+        # the peak size in kilobytes is the best approximation left
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
 class BaseWorker(object):
     """Base class for workers."""
 
@@ -55,11 +148,70 @@ class BaseWorker(object):
         self.connection = None
         self.results_routing_key = CFG_DEFAULT_RES_ROUTING
         self.settings = {}
+        self.compressor = Compressor()
+        self.blobstore = None
+        self.result_cache = None
+        self.coalescer = None
+        self.concurrency = 1
+        self.prefetch = 1
+        self.pool = None
+        self.results = Queue()
+        self.pending = 0
+        self.consuming = False
+        self.batching = False
+        self.batch_size = 1
+        self.batch_timeout = 0
+        self.batch = []
+        self._batch_timeout_id = None
+        self.publisher = None
+        self._properties = {}
+        self._uncommitted = {}
+        self.backoff = None
+        self.stopping = False
+        self.reconnects = 0
+        self.reconnect_time = 0.0
+        self.connections = 0
+        self.task_timeout = 0
+        self.timed_out = False
+        self.busy_since = None
+        self.in_flight = None
+        self.killed_tasks = None
+        self.active_tasks = None
+        self.expired = 0
+        self.lanes = None
+        self.lane_queues = []
+        self.max_tasks = 0
+        self.max_rss = 0
+        self.tasks_done = 0
+        self.recycling = None
+        self.draining = False
+        self.drain_requested = False
+
+    def preload(self):
+        """Initialize state shared by all worker processes of the type.
+
+        The method is called once in the worker pool process if the option
+        `preload` is enabled. Worker processes are forked from the preloaded
+        worker then. Override the method to import heavy modules or load
+        read-only data in advance.
+        """
+        pass
 
-    def __call__(self, props, conn_params, queue):
-        """Worker process entry point."""
+    def configure(self, props):
+        """Apply settings common for all kinds of workers.
+
+        :param props: worker settings
+        :type props: dictionary
+        """
 
         self.settings.update(props)
+        set_codec(self.settings.get(OPT_JSON_CODEC, CODEC_AUTO))
+        self.compressor = get_compressor(self.settings)
+        self.blobstore = get_blobstore(self.settings)
+        self.result_cache = get_result_cache(self.settings)
+        self.coalescer = get_coalescer(self.settings)
+        if OPT_RESULTS_ROUTING_KEY in props.keys():
+            self.results_routing_key = props[OPT_RESULTS_ROUTING_KEY]
 
         if "user" in props.keys():
             LOG.debug("Try to switch to user '%s'" % props['user'])
@@ -73,17 +225,175 @@ class BaseWorker(object):
             else:
                 LOG.warning("Not enough permissions to switch user")
 
-        self.connection = pika.BlockingConnection(conn_params)
-        self.channel = self.connection.channel()
-        self.channel.queue_declare(queue=queue, durable=True,
-                                   exclusive=False, auto_delete=False)
-        self.channel.basic_qos(prefetch_count=1)
-        self.channel.basic_consume(self.handle_delivery, queue=queue)
+    def __call__(self, props, conn_params, queue):
+        """Worker process entry point."""
+
+        self.configure(props)
+        self.concurrency = int(self.settings.get(OPT_CONCURRENCY, 1))
+        self.batching = self.is_batching()
+        if self.batching:
+            # even batches of one task go to handle_batch()
+            self.batch_size = max(1, int(self.settings.get(
+                OPT_TASK_BATCH_SIZE, DEFAULT_TASK_BATCH_SIZE)))
+            self.batch_timeout = float(self.settings.get(
+                OPT_TASK_BATCH_TIMEOUT, DEFAULT_TASK_BATCH_TIMEOUT)) / 1000
+            if self.concurrency > 1:
+                LOG.warning("concurrency is ignored by workers handling "
+                            "tasks in batches")
+                self.concurrency = 1
+        self.prefetch = int(self.settings.get(OPT_PREFETCH,
+                                              max(self.concurrency,
+                                                  self.batch_size)))
+
+        if self.concurrency > 1:
+            self.pool = ThreadPool(self.concurrency)
+        self.task_timeout = float(self.settings.get(OPT_TASK_TIMEOUT, 0))
+        if self.task_timeout > 0:
+            if self.pool is None:
+                signal.signal(signal.SIGALRM, self.on_task_timeout)
+            else:
+                LOG.warning("task_timeout is ignored by workers running "
+                            "tasks in thread pool")
+        self.lanes = get_lane_scheduler(self.settings)
+        if self.lanes is not None:
+            self.lane_queues = [get_lane_queue(queue, lane)
+                                for lane in range(self.lanes.lanes)]
+        self.backoff = get_backoff(self.settings)
+        self.max_tasks = int(self.settings.get(OPT_MAX_TASKS_PER_CHILD, 0))
+        self.max_rss = float(self.settings.get(OPT_MAX_RSS_MB, 0))
         signal.signal(signal.SIGTERM, self.cleanup)
+        signal.signal(signal.SIGUSR2, self.drain)
         LOG.debug("created new process with props %r" % props)
-        if OPT_RESULTS_ROUTING_KEY in props.keys():
-            self.results_routing_key = props[OPT_RESULTS_ROUTING_KEY]
-        self.channel.start_consuming()
+        if self.drain_requested:
+            # asked to drain before the handler was set
+            self.drain(signal.SIGUSR2, None)
+
+        while not self.stopping:
+            try:
+                self.connect(conn_params, queue)
+                self.consume()
+                return
+            except CONNECTION_ERRORS as err:
+                if self.stopping:
+                    return
+                self.drop_tasks()
+                delay = self.backoff.next_delay()
+                LOG.error("connection to AMQP broker failed: %s. Reconnect "
+                          "in %.2f s" % (err, delay))
+                sleep(delay)
+
+    def connect(self, conn_params, queue):
+        """Connect to AMQP broker and start consuming from queue."""
+
+        self.connection = pika.BlockingConnection(conn_params)
+        self.connections += 1
+        self.channel = self.connection.channel()
+        arguments = get_queue_arguments(self.settings)
+        for name in self.lane_queues or [queue]:
+            self.channel.queue_declare(queue=name, durable=True,
+                                       exclusive=False, auto_delete=False,
+                                       arguments=arguments)
+        self.channel.basic_qos(prefetch_count=self.prefetch)
+        self.publisher = self.get_publisher()
+        if self.lanes is None:
+            self.channel.basic_consume(self.handle_delivery, queue=queue)
+        self.consuming = True
+
+        attempts, elapsed = self.backoff.reset()
+        if attempts:
+            self.reconnects += 1
+            self.reconnect_time += elapsed
+            LOG.info("reconnected to AMQP broker in %.3f s after %d failed "
+                     "attempts (%d reconnects, %.3f s in total)" %
+                     (elapsed, attempts, self.reconnects,
+                      self.reconnect_time))
+
+    def drop_tasks(self):
+        """Forget tasks received over lost connection.
+
+        The broker redelivers them as they are not acknowledged.
+        """
+
+        self.consuming = False
+        self.batch = []
+        self._batch_timeout_id = None
+        self._uncommitted = {}
+        self.untrack_tasks()
+
+    def get_publisher(self):
+        """Create publisher of results."""
+
+        if self.batching:
+            # every batch of tasks is committed at once
+            return BatchPublisher(self.channel, self.batch_size,
+                                  on_commit=self.on_commit)
+        size = int(self.settings.get(OPT_RESULTS_BATCH_SIZE, 1))
+        timeout = float(self.settings.get(
+            OPT_RESULTS_BATCH_TIMEOUT, DEFAULT_RESULTS_BATCH_TIMEOUT)) / 1000
+        if size > self.prefetch:
+            # a bigger batch would be committed upon timeout only
+            LOG.warning("results_batch_size %d exceeds prefetch, use %d"
+                        % (size, self.prefetch))
+            size = self.prefetch
+        # tasks run in thread pool finish out of order
+        return BatchPublisher(self.channel, size, timeout,
+                              multiple=self.pool is None,
+                              on_commit=self.on_commit)
+
+    def consume(self):
+        """Consume tasks until the worker is stopped."""
+
+        if self.lanes is not None:
+            self.consume_lanes()
+            return
+        if self.pool is None:
+            self.channel.start_consuming()
+            if self.draining:
+                self.finish_draining()
+            return
+
+        # tasks in flight are finished before the connection is closed
+        while self.consuming or self.pending:
+            self.connection.process_data_events()
+            self.process_results()
+        self.publisher.flush()
+        self.pool.close()
+        self.pool.join()
+        self.connection.close()
+
+    def consume_lanes(self):
+        """Poll priority lanes until the worker is stopped."""
+
+        while self.consuming or self.pending:
+            if self.consuming and self.pending < self.prefetch and \
+               self.poll_lanes():
+                continue
+            # wait for results and timers when lanes are empty or the
+            # thread pool is busy
+            self.connection.process_data_events()
+            self.process_results()
+        if self.pool is not None:
+            self.publisher.flush()
+            self.pool.close()
+            self.pool.join()
+            self.connection.close()
+        elif self.draining:
+            self.finish_draining()
+
+    def poll_lanes(self):
+        """Get one task from priority lanes and handle it.
+
+        :returns: True if a task has been received
+        :rtype: boolean
+        """
+
+        for lane in self.lanes.order():
+            method, header, body = self.channel.basic_get(
+                queue=self.lane_queues[lane])
+            if method is not None:
+                self.handle_delivery(self.channel, method, header, body)
+                return True
+        return False
 
     def is_acceptable(self, workitem):
         """Check if received workitem can be handled by worker.
@@ -118,6 +428,26 @@ class BaseWorker(object):
         """
         raise NotImplementedError
 
+    def handle_batch(self, workitems):
+        """Handle batch of tasks.
+
+        Override this method in BaseWorker subclasses to let the worker
+        handle tasks in batches. If the method raises an exception all the
+        workitems of the batch are reported with the error.
+
+        :param workitems: workflow work items
+        :type workitems: list
+        :returns: list of new states of the work items in the same order or
+                  exceptions for work items failed individually
+        :rtype: list
+        """
+        raise NotImplementedError
+
+    def is_batching(self):
+        """Return True if the worker handles tasks in batches."""
+        return getattr(self.handle_batch, 'im_func', None) is not \
+                BaseWorker.handle_batch.im_func
+
     def handle_delivery(self, channel, method, header, body):
         """Handle AMQP message.
 
@@ -131,33 +461,481 @@ class BaseWorker(object):
         :type body: string
         """
 
-        LOG.debug("Method: %r" % method)
-        LOG.debug("Header: %r" % header)
+        LOG.debug("Method: %r", method)
+        LOG.debug("Header: %r", header)
+        if self.drop_expired(channel, method, header):
+            return False
+        workitem = self.load_workitem(channel, method, header, body)
+        if workitem is None:
+            return False
+        if self.fail_killed(channel, method, header, body, workitem):
+            return True
+
+        if self.batching:
+            self.track_task(header, body)
+            self.add_to_batch(channel, method, header, workitem)
+        elif self.pool is None:
+            self.track_task(header, body)
+            self.finish_task(channel, method, header, self.run_task(workitem))
+            self.untrack_tasks()
+            if self.timed_out:
+                self.retire()
+            else:
+                self.count_tasks(1)
+        else:
+            self.pending += 1
+            self.share_active(self.pending)
+            self.pool.apply_async(self.run_pooled_task, (workitem,),
+                                  callback=partial(self.put_result,
+                                                   self.connections, channel,
+                                                   method, header))
+        return True
+
+    def drop_expired(self, channel, method, header):
+        """Acknowledge and drop delivery if its deadline has passed.
+
+        :returns: True if the delivery is dropped
+        :rtype: boolean
+        """
+
+        if not is_expired(header):
+            return False
+        LOG.warning("drop expired task %r" % method.delivery_tag)
+        self.expired += 1
+        channel.basic_ack(method.delivery_tag)
+        self.release_body(header)
+        return True
+
+    def fail_killed(self, channel, method, header, body, workitem):
+        """Report redelivered task with error if the worker pool has killed
+        a process hung on it.
+
+        :returns: True if the task is reported
+        :rtype: boolean
+        """
+
+        if not method.redelivered or self.killed_tasks is None or \
+           not self.killed_tasks.value:
+            return False
+        if get_digest(header, body) not in self.killed_tasks.value.split():
+            return False
+        LOG.error("fail task %r redelivered after killing worker process "
+                  "hung on it" % workitem)
+        workitem.set_error("Task timed out after %g seconds, worker process "
+                           "killed" % self.task_timeout)
+        self.finish_task(channel, method, header, workitem)
+        return True
+
+    def track_task(self, header, body):
+        """Share digest of task about to run with the worker pool, which
+        marks the task if it has to kill the process."""
+
+        if self.in_flight is None or self.task_timeout <= 0:
+            return
+        digests = self.in_flight.value
+        if digests:
+            digests += " "
+        try:
+            self.in_flight.value = digests + get_digest(header, body)
+        except ValueError:
+            LOG.warning("too many tasks in flight to track")
+
+    def untrack_tasks(self):
+        """Forget digests of finished tasks."""
+
+        if self.in_flight is not None:
+            self.in_flight.value = ""
+
+    def load_workitem(self, channel, method, header, body):
+        """Construct workitem from AMQP message.
+
+        Messages which can't be parsed are acknowledged and dropped.
+
+        :returns: workitem or None if the message can't be parsed
+        :rtype: Workitem
+        """
+
         try:
-            workitem = get_workitem(header, body,
-                                    self.settings.get('workitem_type_map',
-                                                      None),
-                                    self.settings.get('default_workitem_type',
-                                                      DEFAULT_CONTENT_TYPE))
+            return get_workitem(header, body,
+                                self.settings.get('workitem_type_map', None),
+                                self.settings.get('default_workitem_type',
+                                                  DEFAULT_CONTENT_TYPE),
+                                self.blobstore)
         except WorkitemError as err:
             LOG.error("Worker %s.%s can't handle delivery with header '%r' "
                       "and body:\n%s" % (self.__module__,
                                          self.__class__.__name__,
                                          header, body))
             channel.basic_ack(method.delivery_tag)
-            return False
+            self.release_body(header)
+            return None
+
+    def run_task(self, workitem):
+        """Run task and return resulting workitem.
+
+        :param workitem: workflow work item
+        :type workitem: Workitem
+        :rtype: Workitem
+        """
+
         wi_out = workitem
         if self.is_acceptable(workitem):
+            key = None
+            if self.result_cache is not None:
+                key = self.result_cache.get_key(workitem)
+                if key is not None and \
+                   self.result_cache.restore(key, workitem):
+                    return workitem
             try:
-                wi_out = self.handle_task(workitem)
+                self.start_timer()
+                try:
+                    wi_out = self.coalesce_task(workitem)
+                finally:
+                    self.stop_timer()
+                if key is not None:
+                    self.result_cache.store(key, wi_out)
             except Exception as err:
                 wi_out.set_error(str(err))
                 wi_out.set_trace(traceback.format_exc())
         else:
             wi_out.set_error("Worker doesn't support this type of workitems")
-        self.report_results(channel, wi_out)
-        channel.basic_ack(method.delivery_tag)
-        return True
+        return wi_out
+
+    def run_pooled_task(self, workitem):
+        """Run task in thread pool and return resulting workitem.
+
+        The thread pool calls back with results only, so failures outside
+        of `handle_task()` are reported as errors of the workitem too.
+
+        :param workitem: workflow work item
+        :type workitem: Workitem
+        :rtype: Workitem
+        """
+
+        try:
+            return self.run_task(workitem)
+        except Exception as err:
+            LOG.exception("task failed outside of handle_task()")
+            try:
+                workitem.set_error(str(err))
+                workitem.set_trace(traceback.format_exc())
+            except Exception:
+                LOG.exception("can't set error of workitem")
+            return workitem
+
+    def start_timer(self):
+        """Start measuring time of task run in the main thread."""
+
+        if self.pool is not None:
+            return
+        if self.busy_since is not None:
+            self.busy_since.value = time()
+        if self.task_timeout > 0:
+            signal.setitimer(signal.ITIMER_REAL, self.task_timeout)
+
+    def share_active(self, number):
+        """Share number of tasks running in thread pool or asynchronously
+        with the worker pool, which doesn't scale down busy processes.
+
+        :param number: number of running tasks
+        :type number: integer
+        """
+
+        if self.active_tasks is not None:
+            self.active_tasks.value = number
+
+    def stop_timer(self):
+        """Stop measuring time of task run in the main thread."""
+
+        if self.pool is not None:
+            return
+        if self.task_timeout > 0:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        if self.busy_since is not None:
+            self.busy_since.value = 0
+
+    def on_task_timeout(self, signum, frame):
+        """Interrupt timed out task."""
+
+        self.timed_out = True
+        raise TaskTimeout("Task timed out after %g seconds" %
+                          self.task_timeout)
+
+    def retire(self):
+        """Stop worker process after timed out task.
+
+        The task may have left threads, locks or child processes behind, so
+        the worker pool replaces the process with a fresh one.
+        """
+
+        LOG.error("stop worker process after timed out task")
+        self.cleanup(None, None)
+
+    def count_tasks(self, number):
+        """Count finished tasks and recycle the worker process once it has
+        handled `max_tasks_per_child` tasks or its resident memory exceeds
+        `max_rss_mb` megabytes.
+
+        :param number: number of finished tasks
+        :type number: integer
+        """
+
+        self.tasks_done += number
+        # stopped workers don't need replacements
+        if not self.consuming or (self.recycling is not None and
+                                  self.recycling.value):
+            return
+        reason = None
+        if self.max_tasks > 0 and self.tasks_done >= self.max_tasks:
+            reason = "%d tasks" % self.tasks_done
+        elif self.max_rss > 0:
+            rss = get_rss()
+            if rss > self.max_rss:
+                reason = "%.1f MB of resident memory" % rss
+        if reason is None:
+            return
+        if self.recycling is None:
+            LOG.info("recycle worker process after %s" % reason)
+            self.drain(None, None)
+        else:
+            # the pool starts a replacement and sends SIGUSR2
+            LOG.info("request replacement of worker process after %s" %
+                     reason)
+            self.recycling.value = 1
+
+    def drain(self, signum, frame):
+        """Stop consuming tasks and let the worker process exit once the
+        running tasks are finished and reported."""
+
+        if self.draining:
+            return
+        LOG.info("drain worker process after %d tasks" % self.tasks_done)
+        self.draining = True
+        self.stopping = True
+        self.consuming = False
+        if self.lanes is None and self.pool is None and \
+           self.connection is not None and self.connection.is_open:
+            # cancel the consumer from the I/O loop rather than from the
+            # signal handler interrupting a running task
+            self.connection.add_timeout(0, self.channel.stop_consuming)
+
+    def finish_draining(self):
+        """Report results of collected tasks and close connection of drained
+        worker."""
+
+        self.flush_batch()
+        self.publisher.flush()
+        self.connection.close()
+
+    def coalesce_task(self, workitem):
+        """Handle task or wait for its running duplicate and return copy of
+        its result if coalescing is enabled.
+
+        :param workitem: workflow work item
+        :type workitem: Workitem
+        :rtype: Workitem
+        """
+
+        if self.coalescer is not None:
+            key = self.coalescer.get_key(workitem)
+            if key is not None:
+                return self.coalescer.run(key, workitem, self.handle_task)
+        return self.handle_task(workitem)
+
+    def add_to_batch(self, channel, method, header, workitem):
+        """Add task to current batch and run the batch if it's full."""
+
+        self.batch.append((channel, method, header, workitem))
+        if len(self.batch) >= self.batch_size:
+            self.flush_batch()
+        elif self._batch_timeout_id is None:
+            self._batch_timeout_id = self.connection.add_timeout(
+                self.batch_timeout, self._on_batch_timeout)
+
+    def _on_batch_timeout(self):
+        """Run incomplete batch upon timeout."""
+        self._batch_timeout_id = None
+        self.flush_batch()
+
+    def run_batch(self, workitems):
+        """Run batch of tasks and return resulting workitems.
+
+        :param workitems: workflow work items
+        :type workitems: list
+        :rtype: list
+        """
+
+        wi_out = list(workitems)
+        accepted = []
+        for index, workitem in enumerate(workitems):
+            if self.is_acceptable(workitem):
+                accepted.append(index)
+            else:
+                workitem.set_error("Worker doesn't support this type of "
+                                   "workitems")
+        if not accepted:
+            return wi_out
+
+        try:
+            self.start_timer()
+            try:
+                results = self.handle_batch([workitems[index]
+                                             for index in accepted])
+            finally:
+                self.stop_timer()
+            if len(results) != len(accepted):
+                raise ValueError("handle_batch() returned %d results for %d "
+                                 "workitems" % (len(results), len(accepted)))
+        except Exception as err:
+            trace = traceback.format_exc()
+            for index in accepted:
+                workitems[index].set_error(str(err))
+                workitems[index].set_trace(trace)
+            return wi_out
+
+        for index, result in zip(accepted, results):
+            if isinstance(result, Exception):
+                workitems[index].set_error(str(result))
+                workitems[index].set_trace("".join(
+                    traceback.format_exception_only(type(result), result)))
+            else:
+                wi_out[index] = result
+        return wi_out
+
+    def flush_batch(self):
+        """Run current batch, report its results and acknowledge its
+        deliveries at once."""
+
+        if self._batch_timeout_id is not None:
+            self.connection.remove_timeout(self._batch_timeout_id)
+            self._batch_timeout_id = None
+        if not self.batch:
+            return
+
+        batch, self.batch = self.batch, []
+        wi_out = self.run_batch([task[3] for task in batch])
+        for (channel, _, _, _), workitem in zip(batch, wi_out):
+            self.report_results(channel, workitem)
+        self.ack_deliveries(batch[-1][0],
+                            [(method, header) for _, method, header, _
+                             in batch], multiple=True)
+        self.untrack_tasks()
+        LOG.debug("handled batch of %d tasks", len(batch))
+        if self.timed_out:
+            self.retire()
+        else:
+            self.count_tasks(len(batch))
+
+    def put_result(self, connection_number, channel, method, header,
+                   workitem):
+        """Pass result of task run in thread pool to connection thread."""
+        self.results.put((connection_number,
+                          (channel, method, header, workitem)))
+
+    def process_results(self):
+        """Finish tasks completed by thread pool."""
+
+        while True:
+            try:
+                connection_number, result = self.results.get_nowait()
+            except Empty:
+                return
+            self.pending -= 1
+            self.share_active(self.pending)
+            if connection_number != self.connections:
+                LOG.warning("drop results of task received over lost "
+                            "connection: %r" % result[3])
+                continue
+            self.finish_task(*result)
+            self.count_tasks(1)
+
+    def finish_task(self, channel, method, header, workitem):
+        """Report results of task and acknowledge its delivery.
+
+        :param channel: AMQP channel
+        :type channel: pika.channel.Channel
+        :param method: message's method
+        :type method: pika.frame.Method
+        :param header: message header
+        :type header: pika.frame.Header
+        :param workitem: resulting work item
+        :type workitem: Workitem
+        """
+
+        self.report_results(channel, workitem)
+        self.ack_deliveries(channel, [(method, header)])
+
+    def ack_deliveries(self, channel, deliveries, multiple=False):
+        """Acknowledge deliveries along with results reported for them.
+
+        Bodies of the deliveries offloaded to blob store are released after
+        the acknowledgements are committed.
+
+        :param channel: AMQP channel
+        :type channel: pika.channel.Channel
+        :param deliveries: list of (method, header) pairs of deliveries
+        :type deliveries: list
+        :param multiple: acknowledge and commit the deliveries at once
+        :type multiple: boolean
+        """
+
+        publisher = self.publisher
+        if publisher is None or publisher.channel is not channel:
+            if multiple:
+                channel.basic_ack(delivery_tag=deliveries[-1][0].delivery_tag,
+                                  multiple=True)
+            else:
+                for method, _ in deliveries:
+                    channel.basic_ack(method.delivery_tag)
+            for _, header in deliveries:
+                self.release_body(header)
+            return
+
+        for method, header in deliveries:
+            self._uncommitted[method.delivery_tag] = header
+            publisher.ack(method.delivery_tag)
+        if multiple:
+            publisher.flush()
+
+    def on_commit(self, delivery_tags):
+        """Release bodies of committed deliveries."""
+
+        for tag in delivery_tags:
+            self.release_body(self._uncommitted.pop(tag, None))
+
+    def release_body(self, header):
+        """Release message body offloaded to blob store.
+
+        :param header: message header
+        :type header: pika.frame.Header
+        """
+
+        ref = get_header(header, HEADER_BLOB_REF)
+        if ref is not None and self.blobstore is not None:
+            self.blobstore.release(ref)
+
+    def get_properties(self, content_type, content_encoding=None,
+                       headers=None):
+        """Return properties of result messages.
+
+        Properties without headers are cached.
+        """
+
+        if headers:
+            return pika.BasicProperties(delivery_mode=2,
+                                        content_type=content_type,
+                                        content_encoding=content_encoding,
+                                        headers=headers)
+        try:
+            return self._properties[(content_type, content_encoding)]
+        except KeyError:
+            properties = pika.BasicProperties(
+                delivery_mode=2,
+                content_type=content_type,
+                content_encoding=content_encoding
+            )
+            self._properties[(content_type, content_encoding)] = properties
+            return properties
 
     def report_results(self, channel, workitem):
         """Report task results back to AMQP.
@@ -170,17 +948,38 @@ class BaseWorker(object):
         :type workitem: Workitem
         """
 
+        body, encoding = self.compressor.compress(workitem.dumps())
+        headers = None
+        if self.blobstore is not None:
+            try:
+                body, ref = self.blobstore.offload(body)
+            except BlobStoreError as err:
+                LOG.warning("%s. Report body inline" % err)
+                ref = None
+            if ref is not None:
+                headers = {HEADER_BLOB_REF: ref}
         channel.basic_publish(exchange='',
                               routing_key=self.results_routing_key,
-                              body=workitem.dumps(),
-                              properties=pika.BasicProperties(
-                                  delivery_mode=2,
-                                  content_type=workitem.mime_type
-                              ))
+                              body=body,
+                              properties=self.get_properties(
+                                  workitem.mime_type, encoding, headers))
 
     def cleanup(self, signum, frame):
         """Cleanup worker process."""
 
         LOG.debug("target cleanup")
+        self.stopping = True
+        self.consuming = False
+        if self.result_cache is not None:
+            LOG.info("result cache: %d hits, %d misses" %
+                     (self.result_cache.hits, self.result_cache.misses))
+        if self.coalescer is not None:
+            LOG.info("coalesced %d tasks" % self.coalescer.coalesced)
+        if self.connection is None or not self.connection.is_open:
+            return
         self.channel.stop_consuming()
-        self.connection.close()
+        if self.pool is None:
+            # results of finished tasks are not lost with the connection
+            if self.publisher is not None:
+                self.publisher.flush()
+            self.connection.close()
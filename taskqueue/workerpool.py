@@ -1,18 +1,84 @@
 """Worker pool functionality."""
 
 import sys
+import os
+import gc
+import errno
+import fcntl
+import select
+import signal
+import heapq
 import logging
 import pkg_resources
 
-from time import sleep
-from multiprocessing import Process
+import pika
+
+from time import time
+from multiprocessing import Process, Value, Array
 from taskqueue.daemonlib import Daemon
 from taskqueue.confparser import SECTION_TASKQUEUE
 from taskqueue.confparser import PREFIX_GROUP
 from taskqueue.confparser import OPT_SUBGROUPS, OPT_INSTANCES, OPT_WORKERS
+from taskqueue.confparser import OPT_PRELOAD, OPT_TASK_TIMEOUT, \
+                                 OPT_RESTART_DELAY, OPT_RESTART_MAX_DELAY, \
+                                 OPT_MIN_UPTIME, OPT_PRIORITY_LANES
+from taskqueue.amqputils import Backoff, CONNECTION_ERRORS, DIGEST_SIZE
+from taskqueue.breaker import get_breaker, STATE_CLOSED
+from taskqueue.priority import get_lane_queue
+from taskqueue.scaler import get_scaler, get_queue_depth
 
 LOG = logging.getLogger(__name__)
 
+#: Values of boolean options meaning True
+TRUE_VALUES = ('1', 'yes', 'true', 'on')
+
+#: Seconds given to workers to interrupt timed out tasks before being killed
+KILL_GRACE = 10
+
+#: Number of characters of digests of tasks a worker process may run at once
+IN_FLIGHT_SIZE = 4096
+
+#: Number of tasks of killed worker processes remembered per worker type
+KILLED_TASKS = 64
+
+#: Seconds between checks of hung workers
+MONITOR_INTERVAL = 2
+
+#: Default initial cap of delays before restarts of crashed workers
+DEFAULT_RESTART_DELAY = 1
+
+#: Default maximum cap of delays before restarts of crashed workers
+DEFAULT_RESTART_MAX_DELAY = 60
+
+#: Default number of seconds a worker has to run not to be considered
+#: crashed on startup
+DEFAULT_MIN_UPTIME = 10
+
+def run_worker(target, *args):
+    """Entry point of worker processes."""
+
+    # signal handlers of the pool make no sense in workers
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+    # workers asked to drain before they set the handler drain once they do,
+    # the default action of SIGUSR2 would kill them
+    def request_drain(signum, frame):
+        target.drain_requested = True
+    if hasattr(target, 'drain_requested'):
+        signal.signal(signal.SIGUSR2, request_drain)
+    else:
+        signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+    target(*args)
+
+def is_busy(proc):
+    """Check if worker process is running tasks."""
+
+    for name in ('busy_since', 'active_tasks'):
+        value = getattr(proc, name, None)
+        if value is not None and value.value:
+            return True
+    return False
+
 class WorkerPool(Daemon):
     """Worker pool manager."""
 
@@ -21,8 +87,22 @@ class WorkerPool(Daemon):
     def __init__(self, config):
         """Initialize application."""
 
-        self.processes = []
+        self.processes = {}
         self.plugins = {}
+        self.templates = {}
+        self.exit_codes = {}
+        self.restarts = 0
+        self.restart_time = 0.0
+        self.breakers = {}
+        self.pending = []
+        self.parked = {}
+        self.scalers = []
+        self.retiring = set()
+        self.rolling = {}
+        self.killed_tasks = {}
+        self.connection = None
+        self.channel = None
+        self._wakeup = None
         self._enabled_plugins = '*'
         super(WorkerPool, self).__init__(config)
 
@@ -33,18 +113,98 @@ class WorkerPool(Daemon):
             return True
         return name in self._enabled_plugins
 
-    def create_worker(self, worker_type, props):
-        """Create one worker process."""
-        target = self.plugins[worker_type]()
-        proc = Process(target=target,
-                       args=(props, self.amqp_params,
+    def preload_worker(self, worker_type):
+        """Create template worker which worker processes are forked from.
+
+        The template gets preloaded in the pool process, so its imports and
+        read-only state are shared by forked worker processes and don't
+        have to be initialized again when crashed workers are restarted.
+        """
+
+        LOG.info("preload worker of type %r" % worker_type)
+        template = self.plugins[worker_type]()
+        preload = getattr(template, 'preload', None)
+        if preload is not None:
+            preload()
+        # keep preloaded objects away from collections in worker processes
+        # not to spoil copy-on-write pages by updating their GC headers
+        gc.collect()
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+        self.templates[worker_type] = template
+
+    def create_worker(self, worker_type, props, backoff=None):
+        """Create one worker process.
+
+        :param backoff: restart backoff of the crashed process replaced by
+                        the new one, by default a new backoff is created
+        :type backoff: taskqueue.amqputils.Backoff
+        """
+        if worker_type in self.templates:
+            target = self.templates[worker_type]
+        else:
+            target = self.plugins[worker_type]()
+        # start time of running task shared with the worker process
+        busy_since = Value('d', 0.0, lock=False)
+        if hasattr(target, 'busy_since'):
+            target.busy_since = busy_since
+        # set by the worker process asking for a replacement
+        recycling = Value('b', 0, lock=False)
+        if hasattr(target, 'recycling'):
+            target.recycling = recycling
+        # number of tasks run by thread pool or asynchronously
+        active_tasks = Value('i', 0, lock=False)
+        if hasattr(target, 'active_tasks'):
+            target.active_tasks = active_tasks
+        # digests of running tasks and of tasks the pool has killed workers
+        # of the type for
+        in_flight = Array('c', IN_FLIGHT_SIZE, lock=False)
+        if hasattr(target, 'in_flight'):
+            target.in_flight = in_flight
+        if worker_type not in self.killed_tasks:
+            self.killed_tasks[worker_type] = Array(
+                'c', KILLED_TASKS * (DIGEST_SIZE + 1), lock=False)
+        if hasattr(target, 'killed_tasks'):
+            target.killed_tasks = self.killed_tasks[worker_type]
+        proc = Process(target=run_worker,
+                       args=(target, props, self.amqp_params,
                              "worker_%s" % worker_type))
+        proc.busy_since = busy_since
+        proc.recycling = recycling
+        proc.in_flight = in_flight
+        proc.active_tasks = active_tasks
+        proc.started = time()
+        proc.probe = self.get_breaker(worker_type, props).state != \
+                STATE_CLOSED
+        # passed on to replacements while the process keeps crashing, so
+        # healthy processes of the type don't reset it
+        if backoff is None:
+            backoff = Backoff(
+                float(props.get(OPT_RESTART_DELAY, DEFAULT_RESTART_DELAY)),
+                float(props.get(OPT_RESTART_MAX_DELAY,
+                                DEFAULT_RESTART_MAX_DELAY)))
+        proc.backoff = backoff
         proc.start()
-        self.processes.append((worker_type, proc, props))
+        self.processes[proc.pid] = (worker_type, proc, props)
+
+    def create_workers(self, worker_type, props, name=None):
+        """Create worker processes.
+
+        :param worker_type: type of workers
+        :type worker_type: string
+        :param props: options of worker type or subgroup
+        :type props: dictionary
+        :param name: name of subgroup, defaults to worker type
+        :type name: string
+        """
 
-    def create_workers(self, worker_type, props):
-        """Create worker processes."""
-        for i in range(0, int(props[OPT_INSTANCES])):
+        instances = int(props[OPT_INSTANCES])
+        scaler = get_scaler(name or worker_type, props)
+        if scaler is not None:
+            instances = max(scaler.min_instances,
+                            min(instances, scaler.max_instances))
+            self.scalers.append((worker_type, props, scaler))
+        for i in range(0, instances):
             LOG.debug("creating new %d worker of type %r" % (i, worker_type))
             self.create_worker(worker_type, props)
 
@@ -85,37 +245,398 @@ class WorkerPool(Daemon):
             grp_sect = "%s_%s" % (PREFIX_GROUP, wtype)
             grp_opts = dict(self.config.items(grp_sect, defaults=defaults))
 
+            if grp_opts.get(OPT_PRELOAD, '').lower() in TRUE_VALUES:
+                self.preload_worker(wtype)
+
             if OPT_SUBGROUPS in grp_opts:
-                subgrp_sects = ['%s_%s' % (grp_sect, sgrp.strip())
-                                for sgrp in grp_opts[OPT_SUBGROUPS].split(',')]
-                for subgrp_sect in subgrp_sects:
-                    subgrp_opts = self.config.items(subgrp_sect,
-                                                    defaults=grp_opts)
-                    self.create_workers(wtype, dict(subgrp_opts))
+                subgrps = ['%s_%s' % (wtype, sgrp.strip())
+                           for sgrp in grp_opts[OPT_SUBGROUPS].split(',')]
+                for subgrp in subgrps:
+                    subgrp_opts = self.config.items(
+                        '%s_%s' % (PREFIX_GROUP, subgrp), defaults=grp_opts)
+                    self.create_workers(wtype, dict(subgrp_opts), subgrp)
             else:
                 self.create_workers(wtype, grp_opts)
 
         self.monitor()
 
+    def kill_hung_worker(self, worker_type, proc, props):
+        """Kill worker process running task longer than `task_timeout`.
+
+        Workers interrupt timed out tasks themselves, this is the last resort
+        for tasks blocked in code which can't be interrupted. The tasks of the
+        process are marked as killed, so workers receiving them again report
+        them with an error instead of hanging too.
+        """
+
+        timeout = float(props.get(OPT_TASK_TIMEOUT, 0))
+        busy_since = getattr(proc, 'busy_since', None)
+        if timeout <= 0 or busy_since is None or not busy_since.value:
+            return
+        if time() - busy_since.value > timeout + KILL_GRACE:
+            LOG.error("kill process %r of type %r running task for more than "
+                      "%g seconds" % (proc, worker_type, timeout))
+            self.mark_killed(worker_type, proc)
+            try:
+                os.kill(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def mark_killed(self, worker_type, proc):
+        """Remember digests of tasks run by process about to be killed."""
+
+        in_flight = getattr(proc, 'in_flight', None)
+        killed = self.killed_tasks.get(worker_type)
+        if in_flight is None or killed is None or not in_flight.value:
+            return
+        digests = killed.value.split() + in_flight.value.split()
+        killed.value = " ".join(digests[-KILLED_TASKS:])
+
+    def watch_exits(self):
+        """Make SIGCHLD wake up the monitor through a pipe."""
+
+        self._wakeup = os.pipe()
+        for fd in self._wakeup:
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        signal.signal(signal.SIGCHLD, self._on_sigchld)
+
+    def _on_sigchld(self, signum, frame):
+        """Wake up monitor."""
+
+        try:
+            os.write(self._wakeup[1], "\0")
+        except OSError as err:
+            # the pipe is full, the monitor is going to wake up anyway
+            if err.errno != errno.EAGAIN:
+                raise
+
+    def wait_events(self, timeout):
+        """Wait for exits of worker processes up to given number of
+        seconds."""
+
+        try:
+            select.select([self._wakeup[0]], [], [], timeout)
+        except select.error as err:
+            if err.args[0] != errno.EINTR:
+                raise
+        try:
+            while os.read(self._wakeup[0], 4096):
+                pass
+        except OSError as err:
+            if err.errno != errno.EAGAIN:
+                raise
+
+    def get_breaker(self, worker_type, props):
+        """Return circuit breaker of worker type."""
+
+        try:
+            return self.breakers[worker_type]
+        except KeyError:
+            breaker = get_breaker(worker_type, props)
+            self.breakers[worker_type] = breaker
+            return breaker
+
+    def restart_workers(self):
+        """Schedule restarts of exited worker processes and start the ones
+        which are due.
+
+        Workers crashing within `min_uptime` seconds are restarted after
+        delays growing exponentially while their replacements keep crashing
+        too, and may get parked by the circuit breaker of their type. Probes
+        of parked types exiting within `min_uptime` seconds count as crashed
+        whatever their exit code.
+
+        :returns: number of started processes
+        :rtype: integer
+        """
+
+        now = time()
+        for pid, (worker_type, proc, props) in self.processes.items():
+            uptime = now - proc.started
+            min_uptime = float(props.get(OPT_MIN_UPTIME, DEFAULT_MIN_UPTIME))
+            if proc.is_alive():
+                if uptime >= min_uptime:
+                    self.on_worker_up(worker_type, proc)
+                continue
+            proc.join()
+            del self.processes[pid]
+            breaker = self.get_breaker(worker_type, props)
+            # a probe exiting for any reason before it's up doesn't prove
+            # the type works, so the breaker doesn't stay half-open
+            probe_failed = proc.probe and uptime < min_uptime
+            if pid in self.retiring:
+                # stopped by the scaler or replaced
+                self.retiring.discard(pid)
+                if probe_failed:
+                    LOG.warning("probe process %r of type %r stopped after "
+                                "%.1f s" % (proc, worker_type, uptime))
+                    breaker.record_crash(now)
+                continue
+            self.exit_codes[proc.exitcode] = \
+                    self.exit_codes.get(proc.exitcode, 0) + 1
+            if (proc.exitcode != 0 or probe_failed) and uptime < min_uptime:
+                breaker.record_crash(now)
+                backoff = proc.backoff
+                delay = backoff.next_delay()
+                LOG.error("process %r of type %r crashed after %.1f s with "
+                          "exit code %s, restart in %.1f s" %
+                          (proc, worker_type, uptime, proc.exitcode, delay))
+            else:
+                backoff = None
+                delay = 0
+                if proc.exitcode == 0:
+                    log = LOG.warning
+                else:
+                    log = LOG.error
+                log("process %r of type %r exited with code %s" %
+                    (proc, worker_type, proc.exitcode))
+            heapq.heappush(self.pending, (now + delay, now, worker_type,
+                                          props, backoff))
+        return self.start_pending(now)
+
+    def on_worker_up(self, worker_type, proc):
+        """Handle worker process which survived startup."""
+
+        proc.backoff.reset()
+        if not proc.probe:
+            return
+        proc.probe = False
+        breaker = self.breakers[worker_type]
+        breaker.record_success()
+        parked = self.parked.pop(worker_type, [])
+        if parked:
+            LOG.info("restart %d parked processes of type %r" %
+                     (len(parked), worker_type))
+        for props in parked:
+            heapq.heappush(self.pending, (0, time(), worker_type, props,
+                                          None))
+
+    def start_pending(self, now):
+        """Start due restarts and probes of parked worker types."""
+
+        started = 0
+        while self.pending and self.pending[0][0] <= now:
+            _, exited, worker_type, props, backoff = \
+                    heapq.heappop(self.pending)
+            if not self.breakers[worker_type].allow(now):
+                self.parked.setdefault(worker_type, []).append(props)
+                continue
+            self.create_worker(worker_type, props, backoff)
+            started += 1
+            latency = time() - exited
+            self.restarts += 1
+            self.restart_time += latency
+            LOG.info("restarted process of type %r in %.1f ms (%d restarts, "
+                     "exit codes %r)" % (worker_type, latency * 1000,
+                                         self.restarts, self.exit_codes))
+        for worker_type, parked in self.parked.items():
+            if parked and self.breakers[worker_type].allow(now):
+                LOG.info("start probe process of type %r" % worker_type)
+                self.create_worker(worker_type, parked.pop())
+                started += 1
+        return started
+
+    def get_channel(self):
+        """Return channel used to sample depths of worker queues."""
+
+        if self.channel is None or not self.channel.is_open:
+            if self.connection is None or not self.connection.is_open:
+                self.connection = pika.BlockingConnection(self.amqp_params)
+            self.channel = self.connection.channel()
+        return self.channel
+
+    def get_queues(self, worker_type, props):
+        """Return names of queues of worker type."""
+
+        queue = "worker_%s" % worker_type
+        return [get_lane_queue(queue, lane)
+                for lane in range(int(props.get(OPT_PRIORITY_LANES, 1)))]
+
+    def scale_workers(self, now):
+        """Sample load of autoscaled worker groups and scale them.
+
+        :returns: number of started processes minus number of stopped ones
+        :rtype: integer
+        """
+
+        scaled = 0
+        for worker_type, props, scaler in self.scalers:
+            if not scaler.is_due(now):
+                continue
+            try:
+                ready = get_queue_depth(self.get_channel(),
+                                        self.get_queues(worker_type, props))
+            except CONNECTION_ERRORS as err:
+                LOG.warning("can't sample queue of type %r: %s" %
+                            (worker_type, err))
+                self.connection = self.channel = None
+                scaler.sampled = now
+                continue
+            except pika.exceptions.AMQPChannelError as err:
+                # the queue is not declared by workers yet
+                LOG.debug("can't sample queue of type %r: %s" %
+                          (worker_type, err))
+                self.channel = None
+                ready = 0
+            procs = [proc for pid, (_, proc, prps) in self.processes.items()
+                     if prps is props and pid not in self.retiring]
+            waiting = len([item for item in self.pending
+                           if item[3] is props]) + \
+                    len([prps for prps in self.parked.get(worker_type, [])
+                         if prps is props])
+            running = len(procs) + waiting
+            idle = [proc for proc in reversed(procs) if not is_busy(proc)]
+            busy = len(procs) - len(idle)
+            target = scaler.get_target(now, running, busy, ready)
+            if target == running:
+                continue
+            LOG.info("scale %r from %d to %d processes (%d busy, %d tasks "
+                     "waiting)" % (scaler.name, running, target, busy, ready))
+            for _ in range(target - running):
+                self.create_worker(worker_type, props)
+                scaled += 1
+            # tasks started after the sample are finished before exit
+            for proc in idle[:running - target]:
+                self.drain_worker(proc)
+                scaled -= 1
+        return scaled
+
+    def replace_worker(self, worker_type, proc, props):
+        """Start replacement of worker process and drain the process.
+
+        The process stops consuming, finishes its running tasks and exits
+        without being restarted.
+        """
+
+        self.create_worker(worker_type, props)
+        self.drain_worker(proc)
+
+    def drain_worker(self, proc):
+        """Make worker process finish its running tasks and exit without
+        being restarted."""
+
+        self.retiring.add(proc.pid)
+        try:
+            os.kill(proc.pid, signal.SIGUSR2)
+        except OSError:
+            pass
+
+    def recycle_workers(self):
+        """Replace worker processes asking for replacements.
+
+        :returns: number of replaced processes
+        :rtype: integer
+        """
+
+        recycled = 0
+        for pid, (worker_type, proc, props) in self.processes.items():
+            recycling = getattr(proc, 'recycling', None)
+            if pid in self.retiring or recycling is None or \
+               not recycling.value:
+                continue
+            LOG.info("recycle process %r of type %r" % (proc, worker_type))
+            self.replace_worker(worker_type, proc, props)
+            recycled += 1
+        return recycled
+
+    def rolling_restart(self, worker_type=None):
+        """Schedule replacement of all worker processes one at a time per
+        worker type.
+
+        :param worker_type: type of replaced workers, all types if None
+        :type worker_type: string
+        """
+
+        for pid, (wtype, _, _) in self.processes.items():
+            if worker_type in (None, wtype) and pid not in self.retiring:
+                self.rolling.setdefault(wtype, []).append(pid)
+        LOG.info("rolling restart of %d processes" %
+                 sum(len(pids) for pids in self.rolling.values()))
+
+    def _on_sigusr2(self, signum, frame):
+        """Restart all worker processes."""
+        self.rolling_restart()
+
+    def roll_workers(self):
+        """Replace next worker process of every worker type under rolling
+        restart once the previous one has exited."""
+
+        draining = set(self.processes[pid][0] for pid in self.retiring
+                       if pid in self.processes)
+        for worker_type, pids in self.rolling.items():
+            if worker_type in draining:
+                continue
+            if not pids:
+                LOG.info("rolling restart of type %r is done" % worker_type)
+                del self.rolling[worker_type]
+                continue
+            while pids:
+                pid = pids.pop(0)
+                if pid in self.processes and pid not in self.retiring:
+                    self.replace_worker(worker_type, *self.processes[pid][1:])
+                    break
+
+    def dump_state(self, signum, frame):
+        """Log state of worker types."""
+
+        now = time()
+        running = {}
+        for worker_type, _, _ in self.processes.values():
+            running[worker_type] = running.get(worker_type, 0) + 1
+        for worker_type in sorted(set(running) | set(self.breakers)):
+            breaker = self.breakers.get(worker_type)
+            LOG.info("worker type %r: %d running, %d parked, %d waiting "
+                     "for restart, breaker %s" %
+                     (worker_type, running.get(worker_type, 0),
+                      len(self.parked.get(worker_type, [])),
+                      len([item for item in self.pending
+                           if item[2] == worker_type]),
+                      breaker.describe(now) if breaker else "unused"))
+        for _, _, scaler in self.scalers:
+            LOG.info("group %r: %d-%d processes, scaled up %d and down %d "
+                     "times" % (scaler.name, scaler.min_instances,
+                                scaler.max_instances, scaler.ups,
+                                scaler.downs))
+        LOG.info("%d restarts in %.1f ms on average, exit codes %r" %
+                 (self.restarts,
+                  self.restart_time * 1000 / max(self.restarts, 1),
+                  self.exit_codes))
+
     def monitor(self):
-        """Monitor created worker processes."""
+        """Monitor created worker processes.
+
+        Exited workers are handled as soon as SIGCHLD is received, hung
+        workers are checked every `MONITOR_INTERVAL` seconds along with the
+        load of autoscaled worker groups. SIGUSR1 makes the pool log the
+        state of worker types, SIGUSR2 restarts all worker processes one at
+        a time per type.
+        """
 
+        self.watch_exits()
+        signal.signal(signal.SIGUSR1, self.dump_state)
+        signal.signal(signal.SIGUSR2, self._on_sigusr2)
+        checked = time()
         while True:
-            sleep(2)
-            for process in self.processes:
-                worker_type, proc, props = process
-                if not proc.is_alive():
-                    LOG.error("process %r of type %r crashed unexpectedly" %
-                              (proc, worker_type))
-                    proc.join()
-                    self.processes.remove(process)
-                    self.create_worker(worker_type, props)
+            self.restart_workers()
+            now = time()
+            if now - checked >= MONITOR_INTERVAL:
+                checked = now
+                for worker_type, proc, props in self.processes.values():
+                    self.kill_hung_worker(worker_type, proc, props)
+            self.recycle_workers()
+            self.roll_workers()
+            self.scale_workers(now)
+            timeout = checked + MONITOR_INTERVAL - now
+            if self.pending:
+                timeout = min(timeout, self.pending[0][0] - now)
+            self.wait_events(max(0, timeout))
 
     def cleanup(self, signum, frame):
         """Handler for termination signals."""
 
         LOG.debug("cleanup")
-        for _, proc, _ in self.processes:
+        for _, proc, _ in self.processes.values():
             LOG.debug("terminating %r" % proc.name)
             proc.terminate()
         sys.exit(0)
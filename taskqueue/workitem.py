@@ -20,6 +20,8 @@ The requirements for a Workitem class are:
        - `set_trace(trace::string)` to set traceback,
        - property `worker_type` to let the dispatcher know where to
          dispatch the workitem to;
+       - optionally `peek_worker_type(blob::Blob)::string` to extract
+         the worker type from a message body without parsing all of it;
 
        For your convience there is an abstract class :class:`Workitem` exposing
        all these methods. You just need to override its abstracts methods in the
@@ -37,11 +39,17 @@ The requirements for a Workitem class are:
             )
 """
 
+import re
 import logging
-import json
 
+from json.decoder import scanstring
 from pkg_resources import iter_entry_points
 
+from taskqueue import jsoncodec
+from taskqueue.compression import decompress, CompressionError
+from taskqueue.blobstore import BlobStoreError
+from taskqueue.amqputils import get_header, HEADER_BLOB_REF
+
 LOG = logging.getLogger(__name__)
 
 #: Default content type
@@ -56,8 +64,129 @@ DEFAULT_CONTENT_TYPE_MAP = {
 class WorkitemError(Exception):
     pass
 
+class WorkitemRegistry(object):
+    """Registry of workitem classes.
+
+    The registry looks up entry points registered under the group `workitems`
+    once per content type and keeps the loaded classes for the lifetime of
+    the process. Content type maps given as strings are parsed once as well.
+    """
+
+    def __init__(self, group='workitems'):
+        self.group = group
+        self._classes = {}
+        self._ctype_maps = {}
+
+    def get_classes(self, ctype):
+        """Return list of workitem classes registered for content type.
+
+        :param ctype: workitem content type
+        :type ctype: string
+        :returns: list of (module_name, class) pairs
+        :rtype: list
+        """
+
+        try:
+            return self._classes[ctype]
+        except KeyError:
+            pass
+
+        classes = []
+        for entry in iter_entry_points(group=self.group, name=ctype):
+            LOG.debug("found %r" % entry)
+            try:
+                classes.append((entry.module_name, entry.load()))
+            except ImportError:
+                LOG.info("plugin '%s' is not installed. skipping..." %
+                         entry.module_name)
+        self._classes[ctype] = classes
+        return classes
+
+    def get_ctype_map(self, ctype_map):
+        """Return content type map as dictionary.
+
+        :param ctype_map: workitem type mapping
+        :type ctype_map: dictionary|string|None
+        :rtype: dictionary
+        """
+
+        if ctype_map is None:
+            return DEFAULT_CONTENT_TYPE_MAP
+
+        if not isinstance(ctype_map, basestring):
+            return ctype_map
+
+        try:
+            return self._ctype_maps[ctype_map]
+        except KeyError:
+            pass
+
+        try:
+            parsed = dict([[token.strip() for token in pair.split('=', 1)]
+                           for pair in ctype_map.split(',')])
+        except ValueError:
+            raise WorkitemError("can't parse content type map '%s'" %
+                                ctype_map)
+        LOG.debug("default content type got overridden with %r" % parsed)
+        self._ctype_maps[ctype_map] = parsed
+        return parsed
+
+    def get_ctype(self, amqp_header, ctype_map=None,
+                  default_ctype=DEFAULT_CONTENT_TYPE):
+        """Return workitem type for AMQP message.
+
+        :param amqp_header: AMQP message header
+        :type amqp_header: pika.frame.Header
+        :param ctype_map: workitem type mapping
+        :type ctype_map: dictionary|string
+        :param default_ctype: default workitem type
+        :type default_ctype: string
+        :rtype: string
+        """
+
+        if amqp_header.content_type:
+            ctype = amqp_header.content_type
+        else:
+            LOG.warning("header doesn't have Content-type. Assume default "
+                        "'%s'" % default_ctype)
+            ctype = default_ctype
+
+        return self.get_ctype_map(ctype_map).get(ctype, ctype)
+
+#: Registry used by :func:`get_workitem`
+REGISTRY = WorkitemRegistry()
+
+def read_body(amqp_header, amqp_body, blobstore=None):
+    """Return AMQP message body fetched from blob store and decompressed
+    according to its content encoding.
+
+    :param amqp_header: AMQP message header
+    :type amqp_header: pika.frame.Header
+    :param amqp_body: AMQP message body
+    :type amqp_body: blob
+    :param blobstore: store of offloaded message bodies
+    :type blobstore: taskqueue.blobstore.BlobStore
+    :rtype: blob
+    """
+
+    ref = get_header(amqp_header, HEADER_BLOB_REF)
+    if ref is not None:
+        if blobstore is None:
+            raise WorkitemError("Message body is offloaded to blob %s, but "
+                                "blob store is not configured" % ref)
+        try:
+            amqp_body = blobstore.get(ref)
+        except BlobStoreError as err:
+            raise WorkitemError("%s" % err)
+
+    try:
+        return decompress(amqp_body,
+                          getattr(amqp_header, 'content_encoding', None))
+    except CompressionError as err:
+        raise WorkitemError("%s" % err)
+
 def get_workitem(amqp_header, amqp_body, ctype_map=None,
-                 default_ctype=DEFAULT_CONTENT_TYPE):
+                 default_ctype=DEFAULT_CONTENT_TYPE, blobstore=None):
     """Constructs workitems of a certain type.
 
     :param amqp_header: AMQP message header
@@ -68,53 +197,76 @@ def get_workitem(amqp_header, amqp_body, ctype_map=None,
     :type ctype_map: dictionary|string
     :param default_ctype: default workitem type
     :type default_ctype: string
+    :param blobstore: store of offloaded message bodies
+    :type blobstore: taskqueue.blobstore.BlobStore
     """
-    LOG.debug("get_workitem(%s, '%s')" % (amqp_header, amqp_body))
-
-    if amqp_header.content_type:
-        ctype = amqp_header.content_type
-    else:
-        LOG.warning("header doesn't have Content-type. Assume default '%s'" %
-                    default_ctype)
-        ctype = default_ctype
+    LOG.debug("get_workitem(%s, <%d bytes>)", amqp_header, len(amqp_body))
 
-    if ctype_map is None:
-        ctype_map = DEFAULT_CONTENT_TYPE_MAP
+    ctype = REGISTRY.get_ctype(amqp_header, ctype_map, default_ctype)
+    amqp_body = read_body(amqp_header, amqp_body, blobstore)
 
-    if isinstance(ctype_map, basestring):
+    # look for a Workitem class
+    for module_name, cls in REGISTRY.get_classes(ctype):
+        workitem = cls(ctype)
         try:
-            ctype_map = dict([[token.strip() for token in pair.split('=', 1)]
-                                for pair in ctype_map.split(',')])
-        except ValueError:
-            raise WorkitemError("can't parse content type map '%s'" %
-                                ctype_map)
-        LOG.debug("default content type got overridden with %r" % ctype_map)
+            workitem.loads(amqp_body)
+            return workitem
+        except WorkitemError:
+            LOG.warning("Can't parse workitem with the plugin '%s.%s'" %
+                        (module_name, cls.__name__))
 
-    ctype = ctype_map.get(ctype, ctype)
+    raise WorkitemError("No suitable plugin found for workitem of "
+                        "the type '%s'" % ctype)
 
-    workitem = None
-    # look for a Workitem class
-    for entry in iter_entry_points(group='workitems', name=ctype):
-        LOG.debug("found %r" % entry)
+def get_field(workitem, path):
+    """Return value of nested field of workitem.
+
+    :param workitem: workflow work item
+    :type workitem: Workitem
+    :param path: names of nested fields, e.g. ['params', 'priority']
+    :type path: list
+    :returns: field value or None if the workitem has no such field
+    """
+
+    value = getattr(workitem, 'fields', None)
+    for name in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(name)
+    return value
+
+def peek_worker_type(amqp_header, amqp_body, ctype_map=None,
+                     default_ctype=DEFAULT_CONTENT_TYPE, blobstore=None):
+    """Extract worker type from AMQP message.
+
+    Unlike :func:`get_workitem` this function lets workitem classes avoid
+    parsing the whole message body.
+
+    :param amqp_header: AMQP message header
+    :type amqp_header: pika.frame.Header
+    :param amqp_body: AMQP message body
+    :type amqp_body: blob
+    :param ctype_map: workitem type mapping
+    :type ctype_map: dictionary|string
+    :param default_ctype: default workitem type
+    :type default_ctype: string
+    :param blobstore: store of offloaded message bodies
+    :type blobstore: taskqueue.blobstore.BlobStore
+    :rtype: string
+    """
+
+    ctype = REGISTRY.get_ctype(amqp_header, ctype_map, default_ctype)
+    amqp_body = read_body(amqp_header, amqp_body, blobstore)
+
+    for module_name, cls in REGISTRY.get_classes(ctype):
         try:
-            cls = entry.load()
-            workitem = cls(entry.name)
-            workitem.loads(amqp_body)
-            break
-        except ImportError:
-            LOG.info("plugin '%s' is not installed. skipping..." %
-                     entry.module_name)
-            continue
+            return cls(ctype).peek_worker_type(amqp_body)
         except WorkitemError:
             LOG.warning("Can't parse workitem with the plugin '%s.%s'" %
-                        (entry.module_name, cls.__name__))
-            workitem = None
-            continue
+                        (module_name, cls.__name__))
 
-    if workitem is None:
-        raise WorkitemError("No suitable plugin found for workitem of "
-                            "the type '%s'" % ctype)
-    return workitem
+    raise WorkitemError("No suitable plugin found for workitem of "
+                        "the type '%s'" % ctype)
 
 class Workitem(object):
     """Base abstract class for workitems."""
@@ -136,6 +288,15 @@ class Workitem(object):
         """
         raise NotImplementedError
 
+    def peek_worker_type(self, blob):
+        """Return type of worker the workitem in given blob is sent to.
+
+        By default the blob is loaded completely. Override the method if
+        the worker type can be extracted cheaper.
+        """
+        self.loads(blob)
+        return self.worker_type
+
     def dumps(self):
         """Serialize workitem.
 
@@ -186,6 +347,12 @@ class BasicWorkitem(Workitem):
         except (ValueError, TypeError):
             raise BasicWorkitemError("Can't parse workitem body")
 
+    def peek_worker_type(self, blob):
+        try:
+            return blob.split(" ", 1)[0]
+        except (ValueError, TypeError, AttributeError):
+            raise BasicWorkitemError("Can't parse workitem body")
+
     def dumps(self):
         if self._body is None:
             raise BasicWorkitemError("Workitem hasn't been loaded")
@@ -206,6 +373,43 @@ class BasicWorkitem(Workitem):
 class RuoteWorkitemError(WorkitemError):
     pass
 
+JSON_WHITESPACE = ' \t\n\r'
+
+#: Quotes starting strings and characters delimiting JSON values
+JSON_STRUCTURE = re.compile(r'[{}\[\]":]')
+
+#: Start of JSON object
+JSON_OBJECT = re.compile(r'\s*\{')
+
+#: Keys of objects enclosing the worker type of Ruote workitems
+FIELDS_KEY = re.compile(r'"fields"\s*:\s*\{')
+PARAMS_KEY = re.compile(r'"params"\s*:\s*\{')
+
+#: Maximum number of JSON tokens scanned in Python to peek worker type
+SCAN_TOKENS = 1024
+
+#: Minimum size of blobs scanned for worker type, smaller ones are parsed
+#: faster than scanned
+SCAN_SIZE = 32 * 1024
+
+def _json_tokens(blob, pos):
+    """Yield structural characters of JSON text starting at given position.
+
+    Strings are decoded, at most :const:`SCAN_TOKENS` tokens are yielded.
+
+    :returns: tuples (start, end, character, decoded string or None)
+    """
+    for _ in xrange(SCAN_TOKENS):
+        match = JSON_STRUCTURE.search(blob, pos)
+        if match is None:
+            return
+        char = match.group()
+        pos = match.end()
+        string = None
+        if char == '"':
+            string, pos = scanstring(blob, pos)
+        yield match.start(), pos, char, string
+
 class RuoteWorkitem(Workitem):
     """Ruote workitem.
 
@@ -244,17 +448,193 @@ class RuoteWorkitem(Workitem):
         }
     """
 
+    def __init__(self, mime_type):
+        super(RuoteWorkitem, self).__init__(mime_type)
+        self._blob = None
+        self._exposed = False
+        self._updates = {}
+
     def loads(self, blob):
+        """Load workitem from given blob.
+
+        Blobs of :const:`SCAN_SIZE` bytes or more are searched for the key
+        `fields.params.worker_type`, the rest of the blob gets decoded when
+        :attr:`fields` or :attr:`fei` are accessed for the first time. If the
+        blob is smaller, the key can't be told apart from other keys without
+        parsing or its value is not a string the blob is decoded at once.
+
+        The blob is kept, so that it can be passed through if the workitem
+        isn't modified.
+        """
+
+        self._blob = None
+        self._body = None
+        self._exposed = False
+        self._updates = {}
+        worker_type = None
         try:
-            self._body = json.loads(blob)
-            self._worker_type = self._body["fields"]["params"]["worker_type"]
+            if len(blob) >= SCAN_SIZE:
+                worker_type = self._scan_worker_type(blob)
+        except (ValueError, TypeError, AttributeError):
+            pass
+        if worker_type is None:
+            self._body, worker_type = self._decode(blob)
+        self._worker_type = worker_type
+        self._blob = blob
+
+    @staticmethod
+    def _decode(blob):
+        """Decode blob.
+
+        :returns: tuple of workitem body and worker type
+        """
+
+        try:
+            body = jsoncodec.loads(blob)
+            return body, body["fields"]["params"]["worker_type"]
         except (ValueError, KeyError, TypeError):
             raise RuoteWorkitemError("Can't parse workitem body")
 
-    def dumps(self):
-        if self._body is None:
+    def _load(self):
+        """Decode the loaded blob if not done yet."""
+
+        if self._body is not None:
+            return
+        if self._blob is None:
             raise RuoteWorkitemError("Workitem hasn't been loaded")
-        return json.dumps(self._body)
+        body = self._decode(self._blob)[0]
+        body.update(self._updates)
+        self._body = body
+
+    @staticmethod
+    def _scan_worker_type(blob):
+        """Scan blob for the value of `fields.params.worker_type`.
+
+        The keys `fields` and `params` are looked up with searches running
+        at C speed, so large fields preceding `params` aren't scanned in
+        Python. The scan gives up unless it can tell that `params` is the
+        last member of that name in `fields`, so the value of a valid
+        workitem is always the one found by full parsing.
+
+        :returns: worker type or None if it's not found
+        """
+
+        top = JSON_OBJECT.match(blob)
+        start = blob.find('"fields"')
+        end = blob.rfind('"params"')
+        if top is None or start < top.end() or end < start:
+            return None
+        fields = FIELDS_KEY.match(blob, start)
+        params = PARAMS_KEY.match(blob, end)
+        if fields is None or params is None or \
+           params.start() < fields.end():
+            return None
+        # fields stays open up to params, so unless params is nested deeper
+        # the text in between doesn't need to be scanned
+        if blob.find('}', fields.end(), params.start()) >= 0:
+            return None
+
+        # fields must be a member of the workitem
+        depth = 0
+        for start, pos, char, string in _json_tokens(blob, top.end()):
+            if start >= fields.start():
+                if start > fields.start() or depth != 0:
+                    return None
+                break
+            if char in '{[':
+                depth += 1
+            elif char in '}]':
+                depth -= 1
+                if depth < 0:
+                    return None
+        else:
+            return None
+
+        # the rest must close params, fields and the workitem in this order,
+        # keys are decoded, so duplicates spelled with escapes are noticed
+        worker_type = None
+        depth = 0
+        key = value = None
+        for start, pos, char, string in _json_tokens(blob, params.end()):
+            if value is not None:
+                # later members override earlier ones, only strings count
+                space = blob[value:start].strip(JSON_WHITESPACE)
+                worker_type = string if char == '"' and not space else None
+                value = None
+            if char == '"':
+                key = string
+            elif char == ':':
+                if depth == 0 and key == "worker_type":
+                    value = pos
+                elif (depth, key) in ((-1, "params"), (-2, "fields")):
+                    return None
+            elif char in '{[':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == -3:
+                    if blob[pos:].strip(JSON_WHITESPACE):
+                        return None
+                    return worker_type
+        return None
+
+    def dumps(self):
+        """Serialize workitem.
+
+        Unless the workitem has been modified the loaded blob is returned as
+        is or with error and trace added to it.
+        """
+
+        if self._blob is not None:
+            if self._updates:
+                # splice only into blobs known to be valid
+                self._load()
+            if not self._modified():
+                body = self._splice()
+                if body is not None:
+                    return body
+        self._load()
+        return jsoncodec.dumps(self._body)
+
+    def _modified(self):
+        """Check whether :attr:`fields` have been changed since loading.
+
+        The fields are compared with the ones decoded from the loaded blob
+        again, so reading them doesn't prevent passing the blob through.
+        """
+
+        if not self._exposed:
+            return False
+        body = jsoncodec.loads(self._blob)
+        body.update(self._updates)
+        return body != self._body
+
+    def _splice(self):
+        """Add updated keys to the end of the loaded blob.
+
+        Return None if the blob can't be updated without encoding the whole
+        workitem.
+        """
+
+        if not self._updates:
+            return self._blob
+
+        end = self._blob.rfind('}')
+        if end < 0 or self._blob[end + 1:].strip():
+            return None
+        for key in self._updates:
+            if '"%s"' % key in self._blob:
+                # the key may be set already
+                return None
+        before = end - 1
+        while before >= 0 and self._blob[before] in JSON_WHITESPACE:
+            before -= 1
+        separator = "" if self._blob[before:before + 1] == "{" else ", "
+        return "%s%s%s}" % (self._blob[:end], separator,
+                            ", ".join(["%s: %s" % (jsoncodec.dumps(key),
+                                                   jsoncodec.dumps(value))
+                                       for key, value in
+                                       sorted(self._updates.items())]))
 
     @property
     def worker_type(self):
@@ -263,16 +643,27 @@ class RuoteWorkitem(Workitem):
         return self._worker_type
 
     def set_error(self, error):
-        self._body["error"] = error
+        self._set("error", error)
 
     def set_trace(self, trace):
-        self._body["trace"] = trace
+        self._set("trace", trace)
+
+    def _set(self, key, value):
+        """Set top-level key of workitem."""
+
+        self._updates[key] = value
+        if self._body is not None:
+            self._body[key] = value
 
     @property
     def fei(self):
         # fei is a read-only attribute
+        self._load()
         return self._body["fei"].copy()
 
     @property
     def fields(self):
+        # fields are mutable so check them for changes when dumping
+        self._load()
+        self._exposed = True
         return self._body["fields"]
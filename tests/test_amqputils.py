@@ -0,0 +1,87 @@
+import unittest
+
+from time import time
+from mock import Mock
+
+from taskqueue.amqputils import Backoff, get_backoff, get_header, \
+                                get_deadline, get_digest, is_expired
+
+class TestModule(unittest.TestCase):
+
+    def test_get_header(self):
+        """Test get_header()."""
+
+        properties = Mock()
+        properties.headers = {"x-test": "value"}
+        self.assertEqual(get_header(properties, "x-test"), "value")
+        self.assertEqual(get_header(properties, "x-none", 1), 1)
+        properties.headers = None
+        self.assertEqual(get_header(properties, "x-test"), None)
+
+    def test_get_digest(self):
+        """Test get_digest()."""
+
+        properties = Mock(headers=None)
+        self.assertEqual(len(get_digest(properties, "body")), 16)
+        self.assertNotEqual(get_digest(properties, "body"),
+                            get_digest(properties, "other body"))
+        properties.headers = {"x-blob-ref": "ref"}
+        self.assertEqual(get_digest(properties, ""),
+                         get_digest(Mock(headers=None), "ref"))
+
+    def test_get_deadline(self):
+        """Test get_deadline() and is_expired()."""
+
+        properties = Mock()
+        properties.headers = None
+        properties.timestamp = None
+        properties.expiration = "60000"
+        self.assertEqual(get_deadline(properties), None)
+        self.assertFalse(is_expired(properties))
+
+        properties.timestamp = 1000
+        self.assertEqual(get_deadline(properties), 1060)
+        self.assertTrue(is_expired(properties))
+
+        properties.headers = {"x-deadline": long((time() + 60) * 1000)}
+        self.assertFalse(is_expired(properties))
+        properties.headers = {"x-deadline": "invalid"}
+        self.assertEqual(get_deadline(properties), None)
+
+    def test_get_backoff(self):
+        """Test get_backoff()."""
+
+        backoff = get_backoff({"reconnect_delay": "2",
+                               "reconnect_max_delay": "10"})
+        self.assertEqual(backoff.delay, 2)
+        self.assertEqual(backoff.max_delay, 10)
+
+class TestBackoff(unittest.TestCase):
+    """Tests for Backoff."""
+
+    def test_next_delay(self):
+        """Test Backoff.next_delay()."""
+
+        backoff = Backoff(1, 5)
+        for cap in (1, 2, 4, 5, 5):
+            delay = backoff.next_delay()
+            self.assertTrue(0 <= delay <= cap)
+        self.assertEqual(backoff.attempts, 5)
+
+        # long failures don't overflow delays
+        backoff = Backoff(1.0, 5)
+        backoff.attempts = 2000
+        self.assertTrue(0 <= backoff.next_delay() <= 5)
+        self.assertEqual(backoff.attempts, 2001)
+
+    def test_reset(self):
+        """Test Backoff.reset()."""
+
+        backoff = Backoff()
+        self.assertEqual(backoff.reset(), (0, 0.0))
+        backoff.next_delay()
+        backoff.next_delay()
+        attempts, elapsed = backoff.reset()
+        self.assertEqual(attempts, 2)
+        self.assertTrue(elapsed >= 0)
+        self.assertEqual(backoff.attempts, 0)
@@ -0,0 +1,137 @@
+import unittest
+
+from multiprocessing import Value
+from mock import Mock
+
+import taskqueue.asyncworker
+
+from taskqueue.asyncworker import AsyncBaseWorker
+
+class Worker(AsyncBaseWorker):
+    """Worker finishing tasks on demand."""
+
+    def __init__(self):
+        super(Worker, self).__init__()
+        self.callbacks = []
+
+    def handle_task(self, workitem, done):
+        if workitem.dumps().endswith("fail"):
+            raise Exception("test error")
+        self.callbacks.append(done)
+
+class TestAsyncBaseWorker(unittest.TestCase):
+    """Tests for AsyncBaseWorker."""
+
+    def setUp(self):
+        taskqueue.asyncworker.pika = Mock()
+        self.worker = Worker.factory()
+        self.worker({'prefetch': '2'}, {}, 'fakequeue')
+        self.assertTrue(self.worker.connection.ioloop.start.called)
+        self.worker.on_connected(self.worker.connection)
+        self.channel = Mock()
+        self.worker.on_channel_open(self.channel)
+        self.worker.on_queue_declared(Mock())
+        self.channel.basic_qos.assert_called_with(prefetch_count=2)
+        self.header = Mock()
+        self.header.content_type = 'application/x-basic-workitem'
+        self.header.headers = None
+
+    def deliver(self, tag, body="worker_type_name body"):
+        method = Mock()
+        method.delivery_tag = tag
+        return self.worker.handle_delivery(self.channel, method,
+                                           self.header, body)
+
+    def test_handle_task(self):
+        """Test AsyncBaseWorker.handle_task()."""
+        self.assertRaises(NotImplementedError,
+                          AsyncBaseWorker().handle_task, Mock(), Mock())
+
+    def test_handle_delivery(self):
+        """Test AsyncBaseWorker.handle_delivery()."""
+
+        self.worker.active_tasks = Value('i', 0, lock=False)
+        self.assertFalse(self.deliver(0, ""))
+        self.channel.basic_ack.assert_called_with(0)
+        self.assertTrue(self.deliver(1))
+        self.assertTrue(self.deliver(2))
+        self.assertTrue(self.deliver(3))
+        self.assertEqual(len(self.worker.tasks), 2)
+        self.assertEqual(len(self.worker.waiting), 1)
+        self.assertEqual(self.worker.active_tasks.value, 2)
+
+        # failing tasks get reported immediately
+        self.worker.callbacks[1](Exception("task error"))
+        self.channel.basic_ack.assert_called_with(2)
+        self.assertEqual(len(self.worker.waiting), 0)
+        self.worker.callbacks[0](self.worker.tasks[1])
+        self.channel.basic_ack.assert_called_with(1)
+        self.assertEqual(self.worker.active_tasks.value, 1)
+        # tasks done twice are reported once
+        self.worker.callbacks[0](None)
+        self.assertEqual(self.channel.basic_ack.call_count, 3)
+
+        self.assertTrue(self.deliver(4, "worker_type_name fail"))
+        self.channel.basic_ack.assert_called_with(4)
+        self.assertEqual(self.channel.basic_publish.call_count, 3)
+
+        self.worker.ACCEPT = ['application/x-incompatible']
+        self.assertTrue(self.deliver(5))
+        self.channel.basic_ack.assert_called_with(5)
+
+    def test_priority_lanes(self):
+        """Test consuming every priority lane."""
+
+        worker = Worker.factory()
+        worker({'priority_lanes': '3'}, {}, 'fakequeue')
+        channel = Mock()
+        worker.on_channel_open(channel)
+        self.assertEqual([call[1]['queue'] for call in
+                          channel.queue_declare.call_args_list],
+                         ['fakequeue', 'fakequeue_p1', 'fakequeue_p2'])
+        for name in ('fakequeue', 'fakequeue_p1', 'fakequeue_p2'):
+            frame = Mock()
+            frame.method.queue = name
+            worker.on_queue_declared(frame)
+            channel.basic_consume.assert_called_with(worker.handle_delivery,
+                                                     queue=name)
+        worker.cleanup(None, None)
+        self.assertEqual(channel.basic_cancel.call_count, 3)
+
+    def test_early_drain(self):
+        """Test draining worker asked to drain before setting the handler."""
+
+        taskqueue.asyncworker.pika = Mock()
+        worker = Worker.factory()
+        worker.drain_requested = True
+        worker({}, {}, 'fakequeue')
+        self.assertFalse(worker.connection.ioloop.start.called)
+
+    def test_cleanup(self):
+        """Test AsyncBaseWorker.cleanup()."""
+
+        self.deliver(1)
+        self.deliver(2)
+        self.deliver(3)
+        self.worker.cleanup(None, None)
+        self.assertTrue(self.channel.basic_cancel.called)
+        self.assertFalse(self.worker.connection.close.called)
+        self.assertEqual(len(self.worker.waiting), 0)
+        self.worker.callbacks[0](Exception("error"))
+        self.assertFalse(self.worker.connection.close.called)
+        self.worker.callbacks[1](Exception("error"))
+        self.assertTrue(self.worker.connection.close.called)
+        self.assertEqual(self.channel.basic_ack.call_count, 2)
+
+    def test_recycle(self):
+        """Test draining worker process after max_tasks_per_child tasks."""
+
+        self.worker.max_tasks = 2
+        self.deliver(1)
+        self.deliver(2)
+        self.worker.callbacks[0](Exception("error"))
+        self.assertFalse(self.worker.draining)
+        self.worker.callbacks[1](Exception("error"))
+        self.assertTrue(self.worker.draining)
+        self.assertTrue(self.channel.basic_cancel.called)
+        self.assertEqual(self.worker.connection.close.call_count, 1)
@@ -0,0 +1,73 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from taskqueue.blobstore import BlobStore, BlobStoreError, get_blobstore
+
+class TestBlobStore(unittest.TestCase):
+    """Tests for BlobStore."""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = BlobStore(self.path, 10)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_put_get(self):
+        """Test BlobStore.put() and BlobStore.get()."""
+
+        ref1 = self.store.put("test body")
+        ref2 = self.store.put("test body")
+        self.assertNotEqual(ref1, ref2)
+        self.assertEqual(self.store.get(ref1), "test body")
+        self.assertEqual(self.store.get(ref2), "test body")
+        self.assertEqual(len(os.listdir(self.store.objects_dir)), 1)
+        self.assertEqual(self.store.get(self.store.put("")), "")
+        self.assertRaises(BlobStoreError, self.store.get, "../../etc/passwd")
+        self.assertRaises(BlobStoreError, self.store.get, "0" * 40 + "." +
+                          "0" * 32)
+
+    def test_release(self):
+        """Test BlobStore.release()."""
+
+        ref1 = self.store.put("test body")
+        ref2 = self.store.put("test body")
+        self.store.release(ref1)
+        self.assertEqual(self.store.get(ref2), "test body")
+        self.store.release(ref2)
+        self.assertEqual(os.listdir(self.store.objects_dir), [])
+        self.assertEqual(os.listdir(self.store.refs_dir), [])
+        # released references are ignored
+        self.store.release(ref2)
+        # objects are restored if referenced again
+        ref3 = self.store.put("test body")
+        self.assertEqual(self.store.get(ref3), "test body")
+
+    def test_collect(self):
+        """Test BlobStore.collect()."""
+
+        ref = self.store.put("test body")
+        self.assertEqual(self.store.collect(3600), 0)
+        self.assertEqual(self.store.get(ref), "test body")
+        self.assertEqual(self.store.collect(-1), 1)
+        self.assertEqual(os.listdir(self.store.objects_dir), [])
+        self.assertEqual(os.listdir(self.store.refs_dir), [])
+
+    def test_offload(self):
+        """Test BlobStore.offload()."""
+
+        self.assertEqual(self.store.offload("small"), ("small", None))
+        body, ref = self.store.offload("big" * 10)
+        self.assertEqual(body, "")
+        self.assertEqual(self.store.get(ref), "big" * 10)
+
+    def test_get_blobstore(self):
+        """Test get_blobstore()."""
+
+        self.assertEqual(get_blobstore({}), None)
+        store = get_blobstore({"blob_store": self.path,
+                               "blob_threshold": "100"})
+        self.assertEqual(store.path, self.path)
+        self.assertEqual(store.threshold, 100)
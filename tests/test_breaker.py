@@ -0,0 +1,64 @@
+import unittest
+
+from taskqueue.breaker import CircuitBreaker, get_breaker
+
+class TestCircuitBreaker(unittest.TestCase):
+    """Tests for CircuitBreaker."""
+
+    def test_record_crash(self):
+        """Test opening breaker."""
+
+        breaker = CircuitBreaker("test", threshold=3, window=10, timeout=5)
+        for now in (0, 1, 12, 13):
+            breaker.record_crash(now)
+            self.assertEqual(breaker.state, "closed")
+            self.assertTrue(breaker.allow(now))
+        breaker.record_crash(14)
+        self.assertEqual(breaker.state, "open")
+        self.assertEqual(breaker.trips, 1)
+        self.assertFalse(breaker.allow(18))
+        self.assertTrue("probe in 4 s" in breaker.describe(15))
+
+    def test_probe(self):
+        """Test half-open breaker."""
+
+        breaker = CircuitBreaker("test", threshold=1, timeout=5,
+                                 max_timeout=15)
+        breaker.record_crash(0)
+        self.assertTrue(breaker.allow(5))
+        self.assertEqual(breaker.state, "half-open")
+        self.assertFalse(breaker.allow(5))
+
+        # failed probes double the open period
+        breaker.record_crash(6)
+        self.assertEqual(breaker.state, "open")
+        self.assertFalse(breaker.allow(15))
+        self.assertTrue(breaker.allow(16))
+        breaker.record_crash(16)
+        self.assertEqual(breaker.open_timeout, 15)
+
+        self.assertTrue(breaker.allow(31))
+        breaker.record_success()
+        self.assertEqual(breaker.state, "closed")
+        self.assertEqual(breaker.open_timeout, 5)
+
+    def test_disabled(self):
+        """Test breaker with zero threshold."""
+
+        breaker = CircuitBreaker("test", threshold=0)
+        for now in range(100):
+            breaker.record_crash(now)
+        self.assertEqual(breaker.state, "closed")
+
+    def test_get_breaker(self):
+        """Test get_breaker()."""
+
+        breaker = get_breaker("test", {'breaker_threshold': '2',
+                                       'breaker_window': '30',
+                                       'breaker_timeout': '10',
+                                       'breaker_max_timeout': '20'})
+        self.assertEqual((breaker.threshold, breaker.window, breaker.timeout,
+                          breaker.max_timeout), (2, 30, 10, 20))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+import unittest
+import shutil
+import tempfile
+import threading
+
+from mock import Mock
+
+from taskqueue.workitem import RuoteWorkitem, BasicWorkitem
+from taskqueue.coalescer import Coalescer, get_coalescer
+
+BODY = '{"fields": {"pkg": "foo", "params": {"worker_type": "test", ' \
+       '"ref": "%s"}}, "fei": {}}'
+
+def ruote_workitem(ref):
+    workitem = RuoteWorkitem('application/x-ruote-workitem')
+    workitem.loads(BODY % ref)
+    return workitem
+
+class TestCoalescer(unittest.TestCase):
+    """Tests for Coalescer."""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.coalescer = Coalescer(self.path, ["pkg"])
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_get_key(self):
+        """Test Coalescer.get_key()."""
+
+        self.assertEqual(self.coalescer.get_key(ruote_workitem("1")),
+                         self.coalescer.get_key(ruote_workitem("2")))
+        basic_wi = BasicWorkitem('application/x-basic-workitem')
+        basic_wi.loads("test body")
+        self.assertEqual(self.coalescer.get_key(basic_wi), None)
+
+    def test_run(self):
+        """Test coalescing of running duplicates."""
+
+        started = threading.Event()
+        release = threading.Event()
+        def handle_task(workitem):
+            started.set()
+            release.wait()
+            workitem.fields["status"] = "done"
+            return workitem
+        handler = Mock(side_effect=handle_task)
+
+        workitem = ruote_workitem("1")
+        key = self.coalescer.get_key(workitem)
+        leader = threading.Thread(target=self.coalescer.run,
+                                  args=(key, workitem, handler))
+        leader.start()
+        started.wait()
+
+        results = []
+        duplicate = ruote_workitem("2")
+        follower = threading.Thread(target=lambda: results.append(
+            self.coalescer.run(key, duplicate, handler)))
+        follower.start()
+        release.wait(0.1)
+        release.set()
+        leader.join()
+        follower.join()
+
+        self.assertEqual(handler.call_count, 1)
+        self.assertEqual(results[0].fields["status"], "done")
+        self.assertEqual(results[0].fields["params"]["ref"], "2")
+        self.assertEqual(self.coalescer.coalesced, 1)
+
+        # tasks are not coalesced with finished ones
+        self.coalescer.run(key, ruote_workitem("3"), handler)
+        self.assertEqual(handler.call_count, 2)
+
+    def test_missing_key_fields(self):
+        """Test distinct tasks lacking key fields are not coalesced."""
+
+        coalescer = Coalescer(self.path, ["pkg", "params.arch"])
+        workitems = [ruote_workitem("1"), ruote_workitem("2")]
+        keys = [coalescer.get_key(workitem) for workitem in workitems]
+        self.assertEqual(keys, [None, None])
+
+        started = threading.Event()
+        release = threading.Event()
+        def handle_task(workitem):
+            ref = workitem.fields["params"]["ref"]
+            if ref == "1":
+                started.set()
+                release.wait()
+            workitem.fields["status"] = ref
+            return workitem
+        handler = Mock(side_effect=handle_task)
+
+        results = []
+        first = threading.Thread(target=lambda: results.append(
+            coalescer.run(keys[0], workitems[0], handler)))
+        first.start()
+        started.wait()
+        # the second task doesn't wait for the first one
+        self.assertEqual(coalescer.run(keys[1], workitems[1],
+                                       handler).fields["status"], "2")
+        release.set()
+        first.join()
+        self.assertEqual(results[0].fields["status"], "1")
+        self.assertEqual(handler.call_count, 2)
+        self.assertEqual(coalescer.coalesced, 0)
+
+    def test_run_failed(self):
+        """Test duplicates of failed tasks are handled again."""
+
+        workitem = ruote_workitem("1")
+        key = self.coalescer.get_key(workitem)
+        handler = Mock(side_effect=Exception("failed"))
+        self.assertRaises(Exception, self.coalescer.run, key, workitem,
+                          handler)
+        self.assertEqual(self.coalescer._read_result(key, 0), None)
+
+    def test_get_coalescer(self):
+        """Test get_coalescer()."""
+
+        self.assertEqual(get_coalescer({}), None)
+        self.assertEqual(get_coalescer({'coalesce_dir': self.path}), None)
+        coalescer = get_coalescer({'coalesce_dir': self.path,
+                                   'coalesce_key': 'pkg, params.arch'})
+        self.assertEqual(coalescer.key_fields, [["pkg"], ["params", "arch"]])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+
+from mock import Mock
+
+from taskqueue.compression import Compressor, CompressionError, \
+                                  decompress, get_compressor, CODECS
+
+class TestModule(unittest.TestCase):
+
+    def test_decompress(self):
+        """Test decompress()."""
+
+        body = "test body" * 100
+        for encoding, codec in CODECS.items():
+            self.assertEqual(decompress(codec[0](body), encoding), body)
+        self.assertEqual(decompress(body, None), body)
+        self.assertEqual(decompress(body, "utf-8"), body)
+        self.assertEqual(decompress(body, Mock()), body)
+        self.assertEqual(decompress(body, {}), body)
+        self.assertRaises(CompressionError, decompress, body, "zlib")
+
+    def test_get_compressor(self):
+        """Test get_compressor()."""
+
+        compressor = get_compressor({"compression": "gzip",
+                                     "compression_threshold": "10"})
+        self.assertEqual(compressor.encoding, "gzip")
+        self.assertEqual(compressor.threshold, 10)
+        self.assertEqual(get_compressor({}).encoding, None)
+
+class TestCompressor(unittest.TestCase):
+    """Tests for Compressor."""
+
+    def test_compress(self):
+        """Test Compressor.compress()."""
+
+        compressor = Compressor("zlib", 100)
+        self.assertEqual(compressor.compress("small"), ("small", None))
+        body, encoding = compressor.compress("big" * 100)
+        self.assertEqual(encoding, "zlib")
+        self.assertEqual(decompress(body, encoding), "big" * 100)
+
+        compressor = Compressor("fake", 0)
+        self.assertEqual(compressor.compress("body"), ("body", None))
@@ -1,10 +1,133 @@
 import unittest
+import zlib
+import shutil
+import tempfile
 
-from mock import Mock
+from time import time
+from mock import Mock, patch
+from pika.exceptions import AMQPConnectionError
+from Queue import Empty
 from ConfigParser import SafeConfigParser as ConfigParser
 
 import taskqueue.dispatcher
 
+class TestError(Exception):
+    pass
+
+class FakeMethod(object):
+    """AMQP method stand-in."""
+
+    def __init__(self, name, delivery_tag, multiple=False):
+        self.NAME = name
+        self.delivery_tag = delivery_tag
+        self.multiple = multiple
+
+class FakeFrame(object):
+    """AMQP frame stand-in."""
+
+    def __init__(self, method):
+        self.method = method
+
+class FakeChannel(object):
+    """Channel to FakeBroker."""
+
+    def __init__(self, broker, channel_number):
+        self.broker = broker
+        self.channel_number = channel_number
+        self.prefetch_count = 0
+        self.consumer = None
+        self.on_confirm = None
+        self.unacked = {}
+        self.unconfirmed = []
+        self.delivery_tag = 0
+        self.publish_seq = 0
+
+    def queue_declare(self, callback, queue, **kwargs):
+        self.broker.queues.setdefault(queue, [])
+        callback(FakeFrame(None))
+
+    def basic_qos(self, prefetch_count):
+        self.prefetch_count = prefetch_count
+
+    def confirm_delivery(self, callback):
+        self.on_confirm = callback
+
+    def basic_consume(self, callback, queue):
+        self.consumer = (callback, queue)
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        self.publish_seq += 1
+        self.unconfirmed.append((self.publish_seq, routing_key, body))
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        for tag in self.unacked.keys():
+            if tag == delivery_tag or (multiple and tag < delivery_tag):
+                del self.unacked[tag]
+
+    def basic_nack(self, delivery_tag, requeue=True):
+        body = self.unacked.pop(delivery_tag)
+        self.broker.queues[self.consumer[1]].append(body)
+
+class FakeBroker(object):
+    """In-process stand-in for AMQP broker and SelectConnection."""
+
+    def __init__(self, messages, reject=()):
+        self.queues = {"taskqueue": list(messages)}
+        self.reject = set(reject)
+        self.channels = []
+        self.on_open = None
+        self.on_close = None
+        self.ioloop = self
+
+    def __call__(self, params, on_open):
+        self.on_open = on_open
+        return self
+
+    def add_on_close_callback(self, callback):
+        self.on_close = callback
+
+    def channel(self, callback):
+        channel = FakeChannel(self, len(self.channels) + 1)
+        self.channels.append(channel)
+        callback(channel)
+
+    def start(self):
+        self.on_open(self)
+        busy = True
+        while busy:
+            busy = False
+            # deliver messages over channels in round robin
+            for channel in self.channels:
+                callback, queue = channel.consumer
+                if not self.queues[queue] or \
+                   len(channel.unacked) >= channel.prefetch_count:
+                    continue
+                busy = True
+                body = self.queues[queue].pop(0)
+                channel.delivery_tag += 1
+                channel.unacked[channel.delivery_tag] = body
+                header = Mock()
+                header.content_type = "application/x-ruote-workitem"
+                header.headers = None
+                method = Mock()
+                method.delivery_tag = channel.delivery_tag
+                callback(channel, method, header, body)
+            # confirm everything published so far
+            for channel in self.channels:
+                if not channel.unconfirmed:
+                    continue
+                busy = True
+                for seq, routing_key, body in channel.unconfirmed:
+                    if seq in self.reject:
+                        self.reject.remove(seq)
+                        channel.on_confirm(FakeFrame(
+                            FakeMethod("Basic.Nack", seq)))
+                    else:
+                        self.queues.setdefault(routing_key, []).append(body)
+                channel.on_confirm(FakeFrame(FakeMethod(
+                    "Basic.Ack", channel.unconfirmed[-1][0], True)))
+                channel.unconfirmed = []
+
 class TestDispatcher(unittest.TestCase):
     """Tests for dispatcher."""
 
@@ -13,7 +136,9 @@ class TestDispatcher(unittest.TestCase):
         self.disp = taskqueue.dispatcher.Dispatcher(config)
         self.disp.channel = Mock()
         self.disp.connection = Mock()
-        taskqueue.dispatcher.pika = Mock()
+        patcher = patch('taskqueue.dispatcher.pika')
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     def test_handle_delivery(self):
         """Test handle_delivery()."""
@@ -25,10 +150,248 @@ class TestDispatcher(unittest.TestCase):
         self.disp.handle_delivery(Mock(), Mock(), header,
             '{"fields": {"params": {"worker_type": "first"}}}')
 
+    def test_compression(self):
+        """Test forwarding compressed bodies."""
+        config = ConfigParser()
+        config.add_section('taskqueue')
+        config.set('taskqueue', 'compression', 'zlib')
+        config.set('taskqueue', 'compression_threshold', '10')
+        disp = taskqueue.dispatcher.Dispatcher(config)
+        disp.get_properties = Mock()
+        channel = Mock()
+        header = Mock()
+        header.content_type = "application/x-ruote-workitem"
+        header.content_encoding = None
+        header.headers = None
+        body = '{"fields": {"params": {"worker_type": "first"}}}'
+        disp.handle_delivery(channel, Mock(), header, body)
+        self.assertEqual(
+            zlib.decompress(channel.basic_publish.call_args[1]["body"]), body)
+        disp.get_properties.assert_called_with(header.content_type, "zlib",
+                                               None)
+
+        header.content_encoding = "gzip"
+        body = taskqueue.dispatcher.CODECS["gzip"][0](body)
+        disp.handle_delivery(channel, Mock(), header, body)
+        self.assertEqual(channel.basic_publish.call_args[1]["body"], body)
+        disp.get_properties.assert_called_with(header.content_type, "gzip",
+                                               None)
+
+    def test_deadline(self):
+        """Test dropping expired tasks and forwarding deadlines."""
+        channel = Mock()
+        header = Mock()
+        header.content_type = "application/x-ruote-workitem"
+        header.content_encoding = None
+        header.headers = None
+        header.timestamp = 1000
+        header.expiration = "60000"
+        body = '{"fields": {"params": {"worker_type": "first"}}}'
+        self.disp.handle_delivery(channel, Mock(), header, body)
+        self.assertFalse(channel.basic_publish.called)
+        self.assertTrue(channel.basic_ack.called)
+        self.assertEqual(self.disp.expired, 1)
+
+        header.timestamp = int(time())
+        self.disp.handle_delivery(channel, Mock(), header, body)
+        kwargs = taskqueue.dispatcher.pika.BasicProperties.call_args[1]
+        self.assertEqual(kwargs["headers"]["x-deadline"],
+                         (header.timestamp + 60) * 1000)
+        self.assertEqual(channel.basic_publish.call_args[1]["routing_key"],
+                         "worker_first")
+
+    def test_priority(self):
+        """Test forwarding tasks with priorities."""
+        config = ConfigParser()
+        config.add_section('taskqueue')
+        config.set('taskqueue', 'max_priority', '5')
+        config.set('taskqueue', 'priority_field', 'params.priority')
+        disp = taskqueue.dispatcher.Dispatcher(config)
+        disp.get_properties = Mock()
+        channel = Mock()
+        header = Mock()
+        header.content_type = "application/x-ruote-workitem"
+        header.content_encoding = None
+        header.headers = None
+        header.priority = None
+        body = '{"fields": {"params": {"worker_type": "first", ' \
+               '"priority": 9}}, "fei": {}}'
+        disp.handle_delivery(channel, Mock(), header, body)
+        disp.get_properties.assert_called_with(header.content_type, None, 5)
+        self.assertEqual(channel.basic_publish.call_args[1]["routing_key"],
+                         "worker_first")
+
+        # lanes replace native priorities
+        config.set('taskqueue', 'priority_lanes', '3')
+        disp = taskqueue.dispatcher.Dispatcher(config)
+        header.headers = {"x-priority": 1}
+        disp.handle_delivery(channel, Mock(), header, body)
+        self.assertEqual(channel.basic_publish.call_args[1]["routing_key"],
+                         "worker_first_p1")
+
+    def test_blobstore(self):
+        """Test offloading bodies to blob store."""
+        path = tempfile.mkdtemp()
+        try:
+            config = ConfigParser()
+            config.add_section('taskqueue')
+            config.set('taskqueue', 'blob_store', path)
+            config.set('taskqueue', 'blob_threshold', '10')
+            disp = taskqueue.dispatcher.Dispatcher(config)
+            channel = Mock()
+            header = Mock()
+            header.content_type = "application/x-ruote-workitem"
+            header.content_encoding = None
+            header.headers = None
+            body = '{"fields": {"params": {"worker_type": "first"}}}'
+            disp.handle_delivery(channel, Mock(), header, body)
+            self.assertEqual(channel.basic_publish.call_args[1]["body"], "")
+            kwargs = taskqueue.dispatcher.pika.BasicProperties.call_args[1]
+            self.assertEqual(kwargs["headers"]["x-worker-type"], "first")
+            ref = kwargs["headers"]["x-blob-ref"]
+            self.assertEqual(disp.blobstore.get(ref), body)
+
+            # offloaded bodies are forwarded as is
+            header.headers = {"x-blob-ref": ref}
+            disp.handle_delivery(channel, Mock(), header, "")
+            self.assertEqual(channel.basic_publish.call_args[1]["routing_key"],
+                             "worker_first")
+            kwargs = taskqueue.dispatcher.pika.BasicProperties.call_args[1]
+            self.assertEqual(kwargs["headers"]["x-blob-ref"], ref)
+
+            disp.connection = Mock()
+            disp.collect_blobs()
+            self.assertEqual(disp.blobstore.get(ref), body)
+        finally:
+            shutil.rmtree(path)
+
+    def test_get_worker_type(self):
+        """Test Dispatcher.get_worker_type()."""
+        header = Mock()
+        header.content_type = "application/x-ruote-workitem"
+        header.headers = {"x-worker-type": "second"}
+        self.assertEqual(self.disp.get_worker_type(header, "invalid"),
+                         "second")
+        header.headers = None
+        self.assertEqual(self.disp.get_worker_type(header,
+            '{"fields": {"params": {"worker_type": "first"}}}'), "first")
+
+    def test_batching(self):
+        """Test batched forwarding."""
+        config = ConfigParser()
+        config.add_section('taskqueue')
+        config.set('taskqueue', 'batch_size', '2')
+        config.set('taskqueue', 'prefetch_count', '10')
+        disp = taskqueue.dispatcher.Dispatcher(config)
+        channel = Mock()
+        header = Mock()
+        header.content_type = "application/x-ruote-workitem"
+        header.headers = {"x-worker-type": "first"}
+        disp.handle_delivery(channel, Mock(), header, "body")
+        self.assertFalse(channel.tx_commit.called)
+        disp.handle_delivery(channel, Mock(), header, "body")
+        self.assertTrue(channel.tx_commit.called)
+
+        disp.connection = Mock()
+        disp.run()
+        disp.channel.basic_qos.assert_called_once_with(prefetch_count=10)
+
+    def test_run_select(self):
+        """Test Dispatcher.run() with select engine."""
+        config = ConfigParser()
+        config.add_section('taskqueue')
+        config.set('taskqueue', 'engine', 'select')
+        config.set('taskqueue', 'channels', '3')
+        config.set('taskqueue', 'prefetch_count', '4')
+        disp = taskqueue.dispatcher.Dispatcher(config)
+
+        body = '{"fields": {"params": {"worker_type": "%s"}}}'
+        messages = [body % "first", body % "second"] * 20 + ["invalid"]
+        broker = FakeBroker(messages, reject=[2])
+        with patch('taskqueue.dispatcher.pika.SelectConnection', broker):
+            disp.run()
+
+        self.assertEqual(len(broker.channels), 3)
+        self.assertEqual(broker.queues["taskqueue"], [])
+        self.assertEqual(len(broker.queues["worker_first"]), 20)
+        self.assertEqual(len(broker.queues["worker_second"]), 20)
+        for channel in broker.channels:
+            self.assertTrue(channel.delivery_tag > 0)
+            self.assertEqual(channel.unacked, {})
+
+        config.set('taskqueue', 'engine', 'fake')
+        self.assertRaises(SystemExit, taskqueue.dispatcher.Dispatcher, config)
+
+    def test_reconnect(self):
+        """Test reconnecting to broker."""
+        config = ConfigParser()
+        config.add_section('taskqueue')
+        config.set('taskqueue', 'engine', 'select')
+        config.set('taskqueue', 'reconnect_delay', '0.01')
+        config.set('taskqueue', 'prefetch_count', '2')
+        disp = taskqueue.dispatcher.Dispatcher(config)
+
+        body = '{"fields": {"params": {"worker_type": "first"}}}'
+        broker = FakeBroker([body] * 3)
+        lost = FakeBroker([])
+        def start():
+            lost.on_open(lost)
+            lost.on_close(lost, 320, "broker restarted")
+        lost.start = start
+        connections = [AMQPConnectionError(1), lost, broker]
+        def connect(params, on_open):
+            connection = connections.pop(0)
+            if isinstance(connection, Exception):
+                raise connection
+            return connection(params, on_open)
+        with patch('taskqueue.dispatcher.pika.SelectConnection', connect):
+            disp.run()
+
+        self.assertEqual(len(broker.queues["worker_first"]), 3)
+        self.assertEqual(disp.reconnects, 2)
+        self.assertTrue(disp.reconnect_time > 0)
+        self.assertEqual(disp.backoff.attempts, 0)
+
     def test_cleanup(self):
         """Test Dispatcher.cleanup()."""
         self.assertRaises(SystemExit, self.disp.cleanup, None, None)
 
+        proc = Mock()
+        self.disp.consumers = {0: proc}
+        self.disp.connection = None
+        self.assertRaises(SystemExit, self.disp.cleanup, None, None)
+        proc.terminate.assert_called_once_with()
+
+    @patch('taskqueue.dispatcher.Queue')
+    @patch('taskqueue.dispatcher.Process')
+    def test_supervise(self, process, queue):
+        """Test Dispatcher.run() with several processes."""
+        config = ConfigParser()
+        config.add_section('taskqueue')
+        config.set('taskqueue', 'processes', '2')
+        disp = taskqueue.dispatcher.Dispatcher(config)
+
+        proc = Mock()
+        proc.is_alive = Mock(side_effect=[True, False, True, True])
+        process.return_value = proc
+        stats_queue = Mock()
+        stats_queue.get = Mock(side_effect=[(0, 1234, 10), Empty, TestError])
+        queue.return_value = stats_queue
+
+        self.assertRaises(TestError, disp.run)
+        self.assertEqual(process.call_count, 3)
+        self.assertEqual(disp.stats[0][:3], (0, 1234, 10))
+
+    def test_run_consumer(self):
+        """Test Dispatcher.run_consumer()."""
+        self.disp.consumers = {0: Mock()}
+        self.disp.stats_queue = Mock()
+        self.disp.run_consumer(1)
+        self.assertEqual(self.disp.consumers, {})
+        self.disp.report_stats()
+        self.disp.stats_queue.put.assert_called_once_with(
+            (1, taskqueue.dispatcher.os.getpid(), 0, 0, 0.0))
+
     def test_run(self):
         """Test Dispatcher.run()."""
         self.disp.run()
@@ -0,0 +1,49 @@
+import unittest
+import json
+
+from mock import Mock
+
+import taskqueue.jsoncodec
+
+from taskqueue.jsoncodec import get_codec, set_codec
+
+class TestModule(unittest.TestCase):
+
+    def tearDown(self):
+        set_codec('auto')
+
+    def test_get_codec(self):
+        """Test get_codec()."""
+
+        self.assertEqual(get_codec('json').name, 'json')
+        self.assertEqual(get_codec('fake').name, 'json')
+        self.assertTrue(get_codec('auto').name in
+                        taskqueue.jsoncodec.AUTO_ORDER)
+
+        factory = taskqueue.jsoncodec.CODECS['simplejson']
+        taskqueue.jsoncodec.CODECS['simplejson'] = \
+                Mock(side_effect=ImportError)
+        try:
+            self.assertEqual(get_codec('simplejson').name, 'json')
+            self.assertEqual(get_codec('auto').name, 'json')
+        finally:
+            taskqueue.jsoncodec.CODECS['simplejson'] = factory
+
+    def test_codecs(self):
+        """Test all available codecs produce same documents."""
+
+        body = {"fields": {"params": {"worker_type": "test"},
+                           "list": [1, 2.5, None, True, u"\u0444"]},
+                "fei": {}}
+        for name in taskqueue.jsoncodec.CODECS:
+            codec = get_codec(name)
+            self.assertEqual(codec.loads(json.dumps(body)), body)
+            if codec.name != 'ujson':
+                self.assertEqual(codec.dumps(body), json.dumps(body))
+
+    def test_set_codec(self):
+        """Test set_codec()."""
+
+        set_codec('json')
+        self.assertEqual(taskqueue.jsoncodec.dumps({"a": 1}), '{"a": 1}')
+        self.assertEqual(taskqueue.jsoncodec.loads('{"a": 1}'), {"a": 1})
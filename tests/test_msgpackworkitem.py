@@ -0,0 +1,71 @@
+import unittest
+
+from mock import patch
+
+try:
+    import msgpack
+    from taskqueue.msgpackworkitem import MsgpackWorkitem
+except ImportError:
+    msgpack = None
+
+from taskqueue.workitem import RuoteWorkitem, RuoteWorkitemError
+
+BODY = {"fields": {"params": {"worker_type": "test"}, "pkgname": "pkg"},
+        "fei": {"wfid": "20120304-bejeruwodi"}}
+
+@unittest.skipIf(msgpack is None, "msgpack is not installed")
+class TestMsgpackWorkitem(unittest.TestCase):
+    """Tests for MsgpackWorkitem."""
+
+    def setUp(self):
+        self.wi = MsgpackWorkitem('application/x-msgpack-workitem')
+
+    def test_loads(self):
+        """Test MsgpackWorkitem.loads()."""
+
+        self.wi.loads(msgpack.packb(BODY))
+        self.assertEqual(self.wi.worker_type, "test")
+        self.assertEqual(self.wi.fields["pkgname"], "pkg")
+        self.assertEqual(self.wi.fei["wfid"], "20120304-bejeruwodi")
+
+        self.assertRaises(RuoteWorkitemError, self.wi.loads, "")
+        self.assertRaises(RuoteWorkitemError, self.wi.loads,
+                          msgpack.packb({}))
+
+    @patch('taskqueue.workitem.SCAN_SIZE', 0)
+    def test_peek_worker_type(self):
+        """Test MsgpackWorkitem.peek_worker_type() unpacks the blob."""
+
+        body = {"fields": {"params": {"worker_type": "good"},
+                           "log": '{"fields": {"params": '
+                                  '{"worker_type": "evil"}}}'}}
+        self.assertEqual(self.wi.peek_worker_type(msgpack.packb(body)),
+                         "good")
+        self.assertRaises(RuoteWorkitemError, self.wi.peek_worker_type, "")
+
+    def test_dumps(self):
+        """Test MsgpackWorkitem.dumps()."""
+
+        self.assertRaises(RuoteWorkitemError, self.wi.dumps)
+        self.wi.loads(msgpack.packb(BODY))
+        self.wi.set_error("error")
+        body = msgpack.unpackb(self.wi.dumps(), raw=False)
+        self.assertEqual(body["error"], "error")
+        self.assertEqual(body["fields"], BODY["fields"])
+
+    def test_ruote(self):
+        """Test conversions to and from RuoteWorkitem."""
+
+        ruote_wi = RuoteWorkitem('application/x-ruote-workitem')
+        ruote_wi.loads('{"fields": {"params": {"worker_type": "test"}}, '
+                       '"fei": {"wfid": "wfid"}}')
+        wi = MsgpackWorkitem.from_ruote(ruote_wi)
+        self.assertEqual(wi.mime_type, 'application/x-msgpack-workitem')
+        self.assertEqual(wi.worker_type, "test")
+        self.assertEqual(wi.fei, {"wfid": "wfid"})
+
+        wi.fields["pkgname"] = "pkg"
+        ruote_wi = wi.to_ruote()
+        self.assertEqual(ruote_wi.mime_type, 'application/x-ruote-workitem')
+        self.assertEqual(ruote_wi.fields["pkgname"], "pkg")
+        self.assertEqual(ruote_wi.fei, {"wfid": "wfid"})
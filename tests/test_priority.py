@@ -0,0 +1,98 @@
+import unittest
+
+from mock import Mock
+
+from taskqueue.workitem import RuoteWorkitem
+from taskqueue.priority import PriorityResolver, LaneScheduler, \
+                               get_priority_resolver, get_lane_scheduler, \
+                               get_queue_arguments, get_lane_queue
+
+class TestModule(unittest.TestCase):
+
+    def test_get_queue_arguments(self):
+        """Test get_queue_arguments()."""
+
+        self.assertEqual(get_queue_arguments({}), None)
+        self.assertEqual(get_queue_arguments({'max_priority': '5'}),
+                         {'x-max-priority': 5})
+        self.assertEqual(get_queue_arguments({'max_priority': '5',
+                                              'priority_lanes': '3'}), None)
+
+    def test_get_lane_queue(self):
+        """Test get_lane_queue()."""
+
+        self.assertEqual(get_lane_queue("worker_first", 0), "worker_first")
+        self.assertEqual(get_lane_queue("worker_first", 2),
+                         "worker_first_p2")
+
+    def test_get_priority_resolver(self):
+        """Test get_priority_resolver()."""
+
+        self.assertEqual(get_priority_resolver({}), None)
+        resolver = get_priority_resolver({'max_priority': '5',
+                                          'priority_field': 'params.prio'})
+        self.assertEqual(resolver.max_priority, 5)
+        self.assertEqual(resolver.field, ['params', 'prio'])
+        resolver = get_priority_resolver({'max_priority': '5',
+                                          'priority_lanes': '3'})
+        self.assertEqual(resolver.max_priority, 2)
+
+    def test_get_lane_scheduler(self):
+        """Test get_lane_scheduler()."""
+
+        self.assertEqual(get_lane_scheduler({'priority_lanes': '1'}), None)
+        lanes = get_lane_scheduler({'priority_lanes': '3',
+                                    'lane_mode': 'weighted',
+                                    'lane_weights': '1, 2, 3'})
+        self.assertEqual(lanes.weights, [1, 2, 3])
+        self.assertEqual(lanes.mode, 'weighted')
+
+class TestPriorityResolver(unittest.TestCase):
+    """Tests for PriorityResolver."""
+
+    def test_get_priority(self):
+        """Test PriorityResolver.get_priority()."""
+
+        resolver = PriorityResolver(5, 'params.prio')
+        header = Mock()
+        header.headers = {'x-priority': '3'}
+        load_workitem = Mock()
+        self.assertEqual(resolver.get_priority(header, load_workitem), 3)
+        header.headers = {'x-priority': 10}
+        self.assertEqual(resolver.get_priority(header, load_workitem), 5)
+        header.headers = {'x-priority': 'high'}
+        self.assertEqual(resolver.get_priority(header, load_workitem), None)
+        self.assertFalse(load_workitem.called)
+
+        header.headers = None
+        header.priority = None
+        workitem = RuoteWorkitem('application/x-ruote-workitem')
+        workitem.loads('{"fields": {"params": {"worker_type": "test", '
+                       '"prio": 1}}, "fei": {}}')
+        load_workitem.return_value = workitem
+        self.assertEqual(resolver.get_priority(header, load_workitem), 1)
+        load_workitem.return_value = None
+        self.assertEqual(resolver.get_priority(header, load_workitem), None)
+
+class TestLaneScheduler(unittest.TestCase):
+    """Tests for LaneScheduler."""
+
+    def test_strict(self):
+        """Test polling lanes strictly by priority."""
+
+        lanes = LaneScheduler(3)
+        self.assertEqual(lanes.order(), [2, 1, 0])
+        self.assertEqual(lanes.order(), [2, 1, 0])
+        self.assertEqual(LaneScheduler(3, 'unknown').mode, 'strict')
+
+    def test_weighted(self):
+        """Test polling lanes by weights."""
+
+        lanes = LaneScheduler(3, 'weighted', [1, 2, 5])
+        first = [lanes.order()[0] for _ in range(16)]
+        self.assertEqual([first.count(lane) for lane in range(3)], [2, 4, 10])
+        self.assertEqual(lanes.order()[1:], [1, 0])
+        self.assertEqual(LaneScheduler(2, 'weighted', [1]).weights, [1, 2])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import unittest
+
+from mock import Mock
+
+from taskqueue.publisher import BatchPublisher, ConfirmPublisher
+
+class TestBatchPublisher(unittest.TestCase):
+    """Tests for BatchPublisher."""
+
+    def setUp(self):
+        self.channel = Mock()
+        self.channel.connection.add_timeout = Mock(return_value="timeout")
+
+    def test_unbatched(self):
+        """Test BatchPublisher with batch size 1."""
+
+        publisher = BatchPublisher(self.channel)
+        self.channel.tx_select.assert_called_once_with()
+        publisher.publish(1, "worker_first", "body", None)
+        self.channel.basic_ack.assert_called_once_with(delivery_tag=1,
+                                                       multiple=True)
+        self.channel.tx_commit.assert_called_once_with()
+
+    def test_on_commit(self):
+        """Test BatchPublisher with commit callback."""
+
+        on_commit = Mock()
+        publisher = BatchPublisher(self.channel, 2, on_commit=on_commit)
+        publisher.ack(1)
+        self.assertFalse(on_commit.called)
+        publisher.ack(2)
+        on_commit.assert_called_once_with([1, 2])
+        publisher.flush()
+        self.assertEqual(on_commit.call_count, 1)
+
+    def test_publish(self):
+        """Test BatchPublisher.publish()."""
+
+        publisher = BatchPublisher(self.channel, 3, 0.1)
+        self.assertTrue(self.channel.tx_select.called)
+        publisher.publish(1, "worker_first", "body", None)
+        publisher.ack(2)
+        self.assertFalse(self.channel.basic_ack.called)
+        self.assertEqual(self.channel.connection.add_timeout.call_count, 1)
+        publisher.publish(3, "worker_first", "body", None)
+        self.channel.basic_ack.assert_called_once_with(delivery_tag=3,
+                                                       multiple=True)
+        self.channel.tx_commit.assert_called_once_with()
+        self.channel.connection.remove_timeout.assert_called_once_with(
+            "timeout")
+        self.assertEqual(self.channel.basic_publish.call_count, 2)
+
+    def test_timeout(self):
+        """Test committing batch upon timeout."""
+
+        publisher = BatchPublisher(self.channel, 3, 0.1, multiple=False)
+        publisher.ack(1)
+        publisher.ack(2)
+        callback = self.channel.connection.add_timeout.call_args[0][1]
+        callback()
+        self.assertEqual(self.channel.basic_ack.call_count, 2)
+        self.channel.tx_commit.assert_called_once_with()
+        self.assertFalse(self.channel.connection.remove_timeout.called)
+
+        publisher.flush()
+        self.channel.tx_commit.assert_called_once_with()
+
+class TestConfirmPublisher(unittest.TestCase):
+    """Tests for ConfirmPublisher."""
+
+    def setUp(self):
+        self.channel = Mock()
+        self.publisher = ConfirmPublisher(self.channel)
+
+    def confirm(self, name, delivery_tag, multiple=False):
+        frame = Mock()
+        frame.method.NAME = name
+        frame.method.delivery_tag = delivery_tag
+        frame.method.multiple = multiple
+        self.publisher.on_confirm(frame)
+
+    def test_on_confirm(self):
+        """Test ConfirmPublisher.on_confirm()."""
+
+        self.channel.confirm_delivery.assert_called_once_with(
+            self.publisher.on_confirm)
+        for tag in (11, 12, 13):
+            self.publisher.publish(tag, "worker_first", "body", None)
+        self.publisher.ack(14)
+        self.assertEqual(self.publisher.in_flight, 4)
+        self.assertFalse(self.channel.basic_ack.called)
+
+        self.confirm("Basic.Ack", 2)
+        self.assertFalse(self.channel.basic_ack.called)
+        self.confirm("Basic.Nack", 1)
+        self.channel.basic_nack.assert_called_once_with(delivery_tag=11,
+                                                        requeue=True)
+        self.channel.basic_ack.assert_called_once_with(delivery_tag=12,
+                                                       multiple=True)
+        self.confirm("Basic.Ack", 3, True)
+        self.channel.basic_ack.assert_called_with(delivery_tag=14,
+                                                  multiple=True)
+        self.assertEqual(self.publisher.in_flight, 0)
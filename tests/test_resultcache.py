@@ -0,0 +1,134 @@
+import unittest
+import shutil
+import tempfile
+import sqlite3
+import os
+
+from mock import Mock
+
+from taskqueue.workitem import RuoteWorkitem, BasicWorkitem
+from taskqueue.resultcache import ResultCache, get_result_cache
+
+def ruote_workitem(body):
+    workitem = RuoteWorkitem('application/x-ruote-workitem')
+    workitem.loads(body)
+    return workitem
+
+class TestResultCache(unittest.TestCase):
+    """Tests for ResultCache."""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = ResultCache(os.path.join(self.path, "cache.db"),
+                                 ["pkg", "params.arch"], size=2)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.path)
+
+    def test_get_key(self):
+        """Test ResultCache.get_key()."""
+
+        wi1 = ruote_workitem('{"fields": {"pkg": "foo", "extra": 1, '
+                             '"params": {"worker_type": "test", '
+                             '"arch": "i586"}}, "fei": {"wfid": "1"}}')
+        wi2 = ruote_workitem('{"fields": {"pkg": "foo", "extra": 2, '
+                             '"params": {"worker_type": "test", '
+                             '"arch": "i586"}}, "fei": {"wfid": "2"}}')
+        wi3 = ruote_workitem('{"fields": {"pkg": "foo", '
+                             '"params": {"worker_type": "other", '
+                             '"arch": "i586"}}, "fei": {}}')
+        self.assertEqual(self.cache.get_key(wi1), self.cache.get_key(wi2))
+        self.assertNotEqual(self.cache.get_key(wi1), self.cache.get_key(wi3))
+
+        basic_wi = BasicWorkitem('application/x-basic-workitem')
+        basic_wi.loads("test body")
+        self.assertEqual(self.cache.get_key(basic_wi), None)
+
+        # workitems lacking key fields are not cached
+        wi4 = ruote_workitem('{"fields": {"pkg": "foo", '
+                             '"params": {"worker_type": "test"}}, "fei": {}}')
+        self.assertEqual(self.cache.get_key(wi4), None)
+
+    def test_store_restore(self):
+        """Test ResultCache.store() and ResultCache.restore()."""
+
+        body = '{"fields": {"pkg": "%s", "params": {"worker_type": "test", ' \
+               '"arch": "i586", "ref": "%s"}}, "fei": {}}'
+        workitem = ruote_workitem(body % ("foo", "1"))
+        key = self.cache.get_key(workitem)
+        self.assertFalse(self.cache.restore(key, workitem))
+        workitem.fields["status"] = "done"
+        self.cache.store(key, workitem)
+
+        workitem = ruote_workitem(body % ("foo", "2"))
+        self.assertTrue(self.cache.restore(key, workitem))
+        self.assertEqual(workitem.fields["status"], "done")
+        self.assertEqual(workitem.fields["params"]["ref"], "2")
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertEqual(self.cache.hit_ratio, 0.5)
+
+        # the cache is shared by processes
+        other = ResultCache(self.cache.path, ["pkg", "params.arch"])
+        self.assertTrue(other.restore(key, workitem))
+        other.close()
+
+        # expired results are not restored
+        self.cache.ttl = -1
+        self.assertFalse(self.cache.restore(key, workitem))
+
+    def test_eviction(self):
+        """Test eviction of least recently used results."""
+
+        body = '{"fields": {"pkg": "%s", ' \
+               '"params": {"worker_type": "test", "arch": "i586"}}, ' \
+               '"fei": {}}'
+        keys = {}
+        for pkg in ("foo", "bar"):
+            workitem = ruote_workitem(body % pkg)
+            keys[pkg] = self.cache.get_key(workitem)
+            self.cache.store(keys[pkg], workitem)
+        self.assertTrue(self.cache.restore(keys["foo"],
+                                           ruote_workitem(body % "foo")))
+        workitem = ruote_workitem(body % "baz")
+        keys["baz"] = self.cache.get_key(workitem)
+        self.cache.store(keys["baz"], workitem)
+
+        self.assertFalse(self.cache.restore(keys["bar"],
+                                            ruote_workitem(body % "bar")))
+        self.assertTrue(self.cache.restore(keys["foo"],
+                                           ruote_workitem(body % "foo")))
+        self.assertTrue(self.cache.restore(keys["baz"],
+                                           ruote_workitem(body % "baz")))
+
+    def test_database_error(self):
+        """Test handling tasks when database is not accessible."""
+
+        workitem = ruote_workitem('{"fields": {"pkg": "foo", "params": '
+                                  '{"worker_type": "test", "arch": "i586"}}, '
+                                  '"fei": {}}')
+        key = self.cache.get_key(workitem)
+        self.cache.store(key, workitem)
+        self.cache.close()
+        self.cache._db = Mock()
+        self.cache._db.execute.side_effect = sqlite3.OperationalError(
+            "database is locked")
+        self.assertFalse(self.cache.restore(key, workitem))
+        self.assertEqual(self.cache.misses, 1)
+        self.cache.store(key, workitem)
+
+    def test_get_result_cache(self):
+        """Test get_result_cache()."""
+
+        self.assertEqual(get_result_cache({}), None)
+        path = os.path.join(self.path, "other.db")
+        self.assertEqual(get_result_cache({'result_cache': path}), None)
+        cache = get_result_cache({'result_cache': path,
+                                  'result_cache_key': 'pkg, params.arch',
+                                  'result_cache_ttl': '60'})
+        self.assertEqual(cache.key_fields, [["pkg"], ["params", "arch"]])
+        self.assertEqual(cache.ttl, 60)
+        cache.close()
+
+if __name__ == "__main__":
+    unittest.main()
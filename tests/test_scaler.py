@@ -0,0 +1,90 @@
+import unittest
+
+from mock import Mock
+
+from taskqueue.scaler import Scaler, get_scaler, get_queue_depth
+
+class FakeChannel(object):
+    """Stand-in for channel to AMQP broker with given queue depths."""
+
+    def __init__(self, depths):
+        self.depths = depths
+
+    def queue_declare(self, queue, passive=False):
+        assert passive
+        return Mock(method=Mock(message_count=self.depths[queue]))
+
+class TestScaler(unittest.TestCase):
+    """Tests for Scaler."""
+
+    def test_scale_up(self):
+        """Test scaling up."""
+
+        scaler = Scaler("test", 1, 10, up_ratio=0.75)
+        self.assertEqual(scaler.get_target(0, 1, 1, 100), 2)
+        self.assertEqual(scaler.get_target(1, 2, 2, 100), 4)
+        self.assertEqual(scaler.get_target(2, 4, 3, 1), 5)
+        # not enough busy processes
+        self.assertEqual(scaler.get_target(3, 5, 3, 100), 5)
+        self.assertEqual(scaler.get_target(4, 8, 8, 100), 10)
+        self.assertEqual(scaler.get_target(5, 10, 10, 100), 10)
+        self.assertEqual(scaler.ups, 4)
+
+    def test_scale_down(self):
+        """Test scaling down with hysteresis."""
+
+        scaler = Scaler("test", 2, 10, down_ratio=0.25, down_delay=60)
+        self.assertEqual(scaler.get_target(0, 10, 0, 0), 10)
+        self.assertEqual(scaler.get_target(30, 10, 2, 0), 10)
+        self.assertEqual(scaler.get_target(60, 10, 2, 0), 6)
+        self.assertEqual(scaler.get_target(90, 6, 0, 0), 6)
+        # load in between the ratios restarts the delay
+        self.assertEqual(scaler.get_target(100, 6, 3, 0), 6)
+        self.assertEqual(scaler.get_target(110, 6, 0, 0), 6)
+        self.assertEqual(scaler.get_target(169, 6, 0, 0), 6)
+        self.assertEqual(scaler.get_target(170, 6, 0, 0), 3)
+        self.assertEqual(scaler.get_target(230, 3, 0, 0), 2)
+        self.assertEqual(scaler.get_target(290, 2, 0, 0), 2)
+        self.assertEqual(scaler.downs, 3)
+
+    def test_limits(self):
+        """Test keeping number of processes within limits."""
+
+        scaler = Scaler("test", 2, 4)
+        self.assertEqual(scaler.get_target(0, 0, 0, 0), 2)
+        self.assertEqual(scaler.get_target(0, 6, 6, 0), 4)
+
+    def test_is_due(self):
+        """Test Scaler.is_due()."""
+
+        scaler = Scaler("test", 1, 2, interval=10)
+        self.assertTrue(scaler.is_due(0))
+        scaler.get_target(0, 1, 0, 0)
+        self.assertFalse(scaler.is_due(5))
+        self.assertTrue(scaler.is_due(10))
+
+class TestModule(unittest.TestCase):
+
+    def test_get_queue_depth(self):
+        """Test get_queue_depth()."""
+
+        channel = FakeChannel({"worker_a": 3, "worker_a_p1": 4})
+        self.assertEqual(get_queue_depth(channel, ["worker_a"]), 3)
+        self.assertEqual(get_queue_depth(channel, ["worker_a",
+                                                   "worker_a_p1"]), 7)
+
+    def test_get_scaler(self):
+        """Test get_scaler()."""
+
+        self.assertEqual(get_scaler("test", {'instances': '2'}), None)
+        scaler = get_scaler("test", {'instances': '2',
+                                     'max_instances': '8'})
+        self.assertEqual((scaler.min_instances, scaler.max_instances),
+                         (2, 8))
+        scaler = get_scaler("test", {'min_instances': '1',
+                                     'max_instances': '8',
+                                     'scale_down_delay': '5'})
+        self.assertEqual((scaler.min_instances, scaler.down_delay), (1, 5))
+
+if __name__ == "__main__":
+    unittest.main()
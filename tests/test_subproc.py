@@ -0,0 +1,75 @@
+import unittest
+
+from time import time
+from StringIO import StringIO
+
+from taskqueue.subproc import RingBuffer, CommandError, run_command
+
+class TestRingBuffer(unittest.TestCase):
+    """Tests for RingBuffer."""
+
+    def test_write(self):
+        """Test RingBuffer.write() and RingBuffer.getvalue()."""
+
+        tail = RingBuffer(5)
+        self.assertEqual(tail.getvalue(), "")
+        tail.write("abc")
+        self.assertEqual(tail.getvalue(), "abc")
+        tail.write("defg")
+        self.assertEqual(tail.getvalue(), "cdefg")
+        for _ in range(10):
+            tail.write("xy")
+        self.assertEqual(tail.getvalue(), "yxyxy")
+        self.assertTrue(tail.length < 10)
+
+class TestModule(unittest.TestCase):
+
+    def test_run_command(self):
+        """Test run_command()."""
+
+        output = StringIO()
+        tail = run_command(["sh", "-c", "seq 1 10000; echo error >&2"],
+                           tail_size=20, log_interval=0,
+                           output_file=output)
+        self.assertEqual(tail, "9998\n9999\n10000\nerror\n"[-20:])
+        self.assertTrue(output.getvalue().startswith("1\n2\n"))
+        self.assertTrue(output.getvalue().endswith("10000\nerror\n"))
+        self.assertEqual(run_command(["pwd"], cwd="/"), "/\n")
+
+    def test_failure(self):
+        """Test failing commands."""
+
+        try:
+            run_command(["sh", "-c", "echo failed; exit 3"])
+        except CommandError as err:
+            self.assertEqual(err.returncode, 3)
+            self.assertEqual(err.output, "failed\n")
+            self.assertTrue(str(err).endswith("Last output:\nfailed\n"))
+        else:
+            self.fail("CommandError is not raised")
+
+        self.assertRaises(CommandError, run_command, ["/nonexistent"])
+
+    def test_timeout(self):
+        """Test killing timed out commands along with their children."""
+
+        started = time()
+        try:
+            run_command(["sh", "-c", "echo started; sleep 10 & wait"],
+                        timeout=0.2)
+        except CommandError as err:
+            self.assertTrue("timed out" in str(err))
+            self.assertEqual(err.output, "started\n")
+        else:
+            self.fail("CommandError is not raised")
+        self.assertTrue(time() - started < 5)
+
+        # commands closing their output are limited as well
+        started = time()
+        self.assertRaises(CommandError, run_command,
+                          ["sh", "-c", "exec >&- 2>&-; sleep 10"],
+                          timeout=0.2)
+        self.assertTrue(time() - started < 5)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,10 +1,19 @@
 import unittest
+import zlib
+import os
+import shutil
+import tempfile
+import socket
+import signal
 
+from time import sleep
+from multiprocessing import Array, Value
 from mock import Mock
+from pika.exceptions import AMQPConnectionError
 
 import taskqueue.worker
 
-from taskqueue.workitem import BasicWorkitem
+from taskqueue.workitem import BasicWorkitem, RuoteWorkitem
 
 class TestBaseWorker(unittest.TestCase):
     """Tests for BaseWorker."""
@@ -51,6 +60,32 @@ class TestBaseWorker(unittest.TestCase):
         taskqueue.worker.os.geteuid = Mock(return_value=1000)
         self.worker({"user": "fakeuser"}, {}, 'fakequeue')
 
+    def test_early_drain(self):
+        """Test draining worker asked to drain before setting the handler."""
+
+        self.worker.drain_requested = True
+        self.worker({}, {}, 'fakequeue')
+        self.assertTrue(self.worker.draining)
+        self.assertFalse(taskqueue.worker.pika.BlockingConnection.called)
+
+    def test_reconnect(self):
+        """Test reconnecting to broker."""
+
+        connection = Mock()
+        taskqueue.worker.pika.BlockingConnection = Mock(
+            side_effect=[socket.error("refused"), connection, connection])
+        connection.channel.return_value.start_consuming.side_effect = [
+            AMQPConnectionError("lost"), None]
+        self.worker({'reconnect_delay': '0.01'}, {}, 'fakequeue')
+        self.assertEqual(connection.channel.call_count, 2)
+        self.assertEqual(self.worker.reconnects, 2)
+        self.assertEqual(self.worker.connections, 2)
+
+        # workers stop reconnecting upon SIGTERM
+        self.worker.cleanup(None, None)
+        self.worker({}, {}, 'fakequeue')
+        self.assertEqual(connection.channel.call_count, 2)
+
     def test_handle_delivery(self):
         """Test BaseWorker.handle_delivery()."""
 
@@ -66,17 +101,441 @@ class TestBaseWorker(unittest.TestCase):
         self.assertTrue(self.worker.handle_delivery(Mock(), Mock(), header,
                                     "worker_type_name body"))
 
+    def test_concurrency(self):
+        """Test handling tasks in thread pool."""
+
+        channel = Mock()
+        header = Mock()
+        header.content_type = 'application/x-basic-workitem'
+        header.headers = None
+        handled = []
+        active = []
+        def handle_task(workitem):
+            handled.append(workitem)
+            active.append(self.worker.active_tasks.value)
+            if len(handled) == 2:
+                raise Exception("test error")
+            return workitem
+        def deliver():
+            taskqueue.worker.pika.BlockingConnection.return_value.\
+                    process_data_events.side_effect = None
+            for tag in range(3):
+                method = Mock()
+                method.delivery_tag = tag
+                self.worker.handle_delivery(channel, method, header,
+                                            "worker_type_name body")
+            self.worker.cleanup(None, None)
+        self.worker.handle_task = handle_task
+        self.worker.active_tasks = Value('i', 0, lock=False)
+        taskqueue.worker.pika.BlockingConnection.return_value.\
+                process_data_events.side_effect = deliver
+        self.worker({'concurrency': '2'}, {}, 'fakequeue')
+
+        self.assertEqual(self.worker.prefetch, 2)
+        self.worker.channel.basic_qos.assert_called_with(prefetch_count=2)
+        self.assertEqual(len(handled), 3)
+        self.assertEqual(self.worker.pending, 0)
+        # the worker pool sees the process busy while tasks are running
+        self.assertTrue(min(active) > 0)
+        self.assertEqual(self.worker.active_tasks.value, 0)
+        self.assertEqual(sorted(call[0][0] for call in
+                                channel.basic_ack.call_args_list), [0, 1, 2])
+        self.assertEqual(channel.basic_publish.call_count, 3)
+        self.assertTrue(self.worker.connection.close.called)
+
+    def test_run_pooled_task(self):
+        """Test BaseWorker.run_pooled_task()."""
+
+        workitem = Mock()
+        self.worker.run_task = Mock(side_effect=Exception("cache error"))
+        self.assertEqual(self.worker.run_pooled_task(workitem), workitem)
+        workitem.set_error.assert_called_once_with("cache error")
+
+        # the workitem is handed back even if it can't take the error
+        workitem.set_error.side_effect = Exception("foreign workitem")
+        self.assertEqual(self.worker.run_pooled_task(workitem), workitem)
+
+    def test_handle_batch(self):
+        """Test handling tasks in batches."""
+
+        class BatchWorker(taskqueue.worker.BaseWorker):
+            def handle_batch(self, workitems):
+                if len(workitems) == 1:
+                    raise Exception("batch error")
+                return [workitems[0], Exception("item error")] + \
+                        workitems[2:]
+
+        self.assertFalse(self.worker.is_batching())
+        worker = BatchWorker()
+        self.assertTrue(worker.is_batching())
+        worker({'task_batch_size': '3', 'concurrency': '2'}, {}, 'fakequeue')
+        self.assertEqual(worker.concurrency, 1)
+        worker.channel.basic_qos.assert_called_with(prefetch_count=3)
+
+        channel = Mock()
+        header = Mock()
+        header.content_type = 'application/x-basic-workitem'
+        header.headers = None
+        for tag in range(4):
+            method = Mock()
+            method.delivery_tag = tag
+            worker.handle_delivery(channel, method, header,
+                                   "worker_type_name body%d" % tag)
+        channel.basic_ack.assert_called_once_with(delivery_tag=2,
+                                                  multiple=True)
+        bodies = [call[1]["body"] for call in
+                  channel.basic_publish.call_args_list]
+        self.assertEqual(bodies[0], "worker_type_name body0")
+        self.assertEqual(len(bodies), 3)
+        self.assertEqual(len(worker.batch), 1)
+        worker.connection.add_timeout.assert_called_with(
+            0.1, worker._on_batch_timeout)
+
+        worker.batch[0][3].set_error = Mock()
+        worker.batch[0][3].set_trace = Mock()
+        batch = worker.batch
+        worker._on_batch_timeout()
+        batch[0][3].set_error.assert_called_with("batch error")
+        channel.basic_ack.assert_called_with(delivery_tag=3, multiple=True)
+        self.assertEqual(worker.batch, [])
+
+        # batches of one task are handled by handle_batch() as well
+        worker = BatchWorker()
+        worker({'task_batch_size': '1'}, {}, 'fakequeue')
+        channel = Mock()
+        worker.handle_delivery(channel, Mock(), header,
+                               "worker_type_name body")
+        self.assertTrue("batch error" in
+                        channel.basic_publish.call_args[1]["body"])
+        self.assertEqual(worker.batch, [])
+
+    def test_run_batch(self):
+        """Test BaseWorker.run_batch()."""
+
+        workitems = [Mock(), Mock()]
+        self.worker.handle_batch = Mock(return_value=[Mock(),
+                                                      Exception("error")])
+        self.worker.is_acceptable = Mock(return_value=True)
+        results = self.worker.run_batch(workitems)
+        self.assertEqual(results[0],
+                         self.worker.handle_batch.return_value[0])
+        self.assertEqual(results[1], workitems[1])
+        workitems[1].set_error.assert_called_with("error")
+        self.assertTrue("error" in workitems[1].set_trace.call_args[0][0])
+
+        # results of wrong length fail all the workitems
+        self.worker.handle_batch = Mock(return_value=[])
+        self.assertEqual(self.worker.run_batch(workitems), workitems)
+        self.assertTrue(workitems[0].set_error.called)
+
+        self.worker.is_acceptable = Mock(return_value=False)
+        self.assertEqual(self.worker.run_batch(workitems), workitems)
+
+    def test_results_batch(self):
+        """Test committing results in batches."""
+
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.worker({'results_batch_size': '2', 'prefetch': '2',
+                     'blob_store': path}, {}, 'fakequeue')
+        channel = self.worker.channel
+        self.assertTrue(channel.tx_select.called)
+        header = Mock()
+        header.content_type = 'application/x-basic-workitem'
+        header.content_encoding = None
+        header.headers = {"x-blob-ref": self.worker.blobstore.put(
+            "worker_type_name body")}
+        self.worker.handle_task = Mock(side_effect=lambda wi: wi)
+        method = Mock()
+        method.delivery_tag = 1
+        self.worker.handle_delivery(channel, method, header, "")
+        self.assertEqual(channel.basic_publish.call_count, 1)
+        self.assertFalse(channel.basic_ack.called)
+        # bodies are released after commit only
+        self.assertEqual(len(os.listdir(os.path.join(path, "refs"))), 1)
+
+        method = Mock()
+        method.delivery_tag = 2
+        self.worker.handle_delivery(channel, method, Mock(headers=None,
+                                    content_encoding=None,
+                                    content_type=header.content_type),
+                                    "worker_type_name body")
+        channel.basic_ack.assert_called_once_with(delivery_tag=2,
+                                                  multiple=True)
+        self.assertTrue(channel.tx_commit.called)
+        self.assertEqual(os.listdir(os.path.join(path, "refs")), [])
+        # properties are reused
+        properties = [call[1]["properties"] for call in
+                      channel.basic_publish.call_args_list]
+        self.assertTrue(properties[0] is properties[1])
+
+        # batches never wait for more tasks than prefetched
+        self.worker({'results_batch_size': '5', 'prefetch': '2'}, {},
+                    'fakequeue')
+        self.assertEqual(self.worker.publisher.size, 2)
+
     def test_report_results(self):
         """Test BaseWorker.report_results()."""
 
         self.worker.report_results(Mock(), Mock())
 
+        self.worker({'compression': 'zlib', 'compression_threshold': '10'},
+                    {}, 'fakequeue')
+        channel = Mock()
+        workitem = Mock()
+        workitem.dumps = Mock(return_value="worker_type body" * 10)
+        self.worker.report_results(channel, workitem)
+        kwargs = taskqueue.worker.pika.BasicProperties.call_args[1]
+        self.assertEqual(kwargs["content_encoding"], "zlib")
+        self.assertEqual(zlib.decompress(
+            channel.basic_publish.call_args[1]["body"]),
+            "worker_type body" * 10)
+
+    def test_blobstore(self):
+        """Test offloading bodies to blob store."""
+
+        path = tempfile.mkdtemp()
+        try:
+            self.worker({'blob_store': path, 'blob_threshold': '10'},
+                        {}, 'fakequeue')
+            channel = Mock()
+            workitem = Mock()
+            workitem.dumps = Mock(return_value="worker_type body" * 10)
+            self.worker.report_results(channel, workitem)
+            kwargs = taskqueue.worker.pika.BasicProperties.call_args[1]
+            ref = kwargs["headers"]["x-blob-ref"]
+            self.assertEqual(channel.basic_publish.call_args[1]["body"], "")
+            self.assertEqual(self.worker.blobstore.get(ref),
+                             "worker_type body" * 10)
+
+            header = Mock()
+            header.content_type = "application/x-basic-workitem"
+            header.content_encoding = None
+            header.headers = {"x-blob-ref": ref}
+            self.worker.handle_task = Mock(side_effect=lambda wi: wi)
+            self.assertTrue(self.worker.handle_delivery(channel, Mock(),
+                                                        header, ""))
+            self.assertEqual(self.worker.handle_task.call_args[0][0].dumps(),
+                             "worker_type body" * 10)
+            # the result is offloaded and the task is released
+            self.assertEqual(len(os.listdir(os.path.join(path, "refs"))), 1)
+
+            # bodies are reported inline if the store fails
+            self.worker.blobstore.put = Mock(
+                side_effect=taskqueue.worker.BlobStoreError("disk full"))
+            self.worker.report_results(channel, workitem)
+            self.assertEqual(channel.basic_publish.call_args[1]["body"],
+                             "worker_type body" * 10)
+            kwargs = taskqueue.worker.pika.BasicProperties.call_args[1]
+            self.assertFalse("headers" in kwargs)
+        finally:
+            shutil.rmtree(path)
+
+    def test_result_cache(self):
+        """Test skipping tasks with cached results."""
+
+        path = tempfile.mkdtemp()
+        try:
+            self.worker({'result_cache': os.path.join(path, "cache.db"),
+                         'result_cache_key': 'pkg'}, {}, 'fakequeue')
+            body = '{"fields": {"pkg": "foo", "params": ' \
+                   '{"worker_type": "test"}}, "fei": {}}'
+
+            def handle_task(workitem):
+                workitem.fields["status"] = "done"
+                return workitem
+            self.worker.handle_task = Mock(side_effect=handle_task)
+            for _ in range(2):
+                workitem = RuoteWorkitem('application/x-ruote-workitem')
+                workitem.loads(body)
+                result = self.worker.run_task(workitem)
+                self.assertEqual(result.fields["status"], "done")
+            self.assertEqual(self.worker.handle_task.call_count, 1)
+            self.assertEqual((self.worker.result_cache.hits,
+                              self.worker.result_cache.misses), (1, 1))
+
+            # failed tasks are not cached
+            self.worker.handle_task = Mock(side_effect=Exception("failed"))
+            for _ in range(2):
+                workitem = RuoteWorkitem('application/x-ruote-workitem')
+                workitem.loads(body.replace("foo", "bar"))
+                self.worker.run_task(workitem)
+            self.assertEqual(self.worker.handle_task.call_count, 2)
+            self.worker.result_cache.close()
+        finally:
+            shutil.rmtree(path)
+
+    def test_coalesce_task(self):
+        """Test BaseWorker.coalesce_task()."""
+
+        workitem = Mock()
+        self.worker.handle_task = Mock()
+        self.assertEqual(self.worker.coalesce_task(workitem),
+                         self.worker.handle_task.return_value)
+
+        self.worker.coalescer = Mock()
+        self.worker.coalescer.get_key.return_value = "key"
+        self.assertEqual(self.worker.coalesce_task(workitem),
+                         self.worker.coalescer.run.return_value)
+        self.worker.coalescer.run.assert_called_with(
+            "key", workitem, self.worker.handle_task)
+
+    def test_task_timeout(self):
+        """Test interrupting timed out tasks."""
+
+        self.addCleanup(signal.signal, signal.SIGALRM, signal.SIG_DFL)
+        self.worker({'task_timeout': '0.05'}, {}, 'fakequeue')
+        self.worker.busy_since = Mock()
+        self.worker.handle_task = Mock(side_effect=lambda wi: sleep(5))
+        channel = Mock()
+        header = Mock()
+        header.content_type = 'application/x-basic-workitem'
+        header.headers = None
+        self.assertTrue(self.worker.handle_delivery(channel, Mock(), header,
+                                                    "worker_type_name body"))
+        self.assertTrue("Task timed out after 0.05 seconds" in
+                        channel.basic_publish.call_args[1]["body"])
+        self.assertTrue(channel.basic_ack.called)
+        self.assertEqual(self.worker.busy_since.value, 0)
+        # the worker process is replaced
+        self.assertTrue(self.worker.stopping)
+        self.assertTrue(self.worker.connection.close.called)
+
+    def test_fail_killed(self):
+        """Test failing tasks redelivered after killing hung worker."""
+
+        self.worker({'task_timeout': '5'}, {}, 'fakequeue')
+        self.worker.in_flight = Array('c', 64, lock=False)
+        self.worker.killed_tasks = Array('c', 64, lock=False)
+        digests = []
+        def handle_task(workitem):
+            digests.append(self.worker.in_flight.value)
+            return workitem
+        self.worker.handle_task = Mock(side_effect=handle_task)
+        channel = Mock()
+        header = Mock()
+        header.content_type = 'application/x-basic-workitem'
+        header.headers = None
+        method = Mock(redelivered=False)
+        self.worker.handle_delivery(channel, method, header,
+                                    "worker_type_name body")
+        self.assertEqual(len(digests[0]), 16)
+        self.assertEqual(self.worker.in_flight.value, "")
+
+        # the pool has killed a process hung on the task
+        self.worker.killed_tasks.value = "0123456789abcdef " + digests[0]
+        self.worker.handle_delivery(channel, method, header,
+                                    "worker_type_name body")
+        self.assertEqual(self.worker.handle_task.call_count, 2)
+        method = Mock(redelivered=True)
+        self.worker.handle_delivery(channel, method, header,
+                                    "worker_type_name other")
+        self.assertEqual(self.worker.handle_task.call_count, 3)
+        self.worker.handle_delivery(channel, method, header,
+                                    "worker_type_name body")
+        self.assertEqual(self.worker.handle_task.call_count, 3)
+        self.assertTrue("worker process killed" in
+                        channel.basic_publish.call_args[1]["body"])
+        channel.basic_ack.assert_called_with(method.delivery_tag)
+
+    def test_drop_expired(self):
+        """Test dropping tasks past their deadline."""
+
+        channel = Mock()
+        header = Mock()
+        header.content_type = 'application/x-basic-workitem'
+        header.headers = {'x-deadline': 1000}
+        self.worker.handle_task = Mock()
+        self.assertFalse(self.worker.handle_delivery(channel, Mock(), header,
+                                                     "worker_type_name body"))
+        self.assertFalse(self.worker.handle_task.called)
+        self.assertTrue(channel.basic_ack.called)
+        self.assertEqual(self.worker.expired, 1)
+
+    def test_priority_lanes(self):
+        """Test polling priority lanes."""
+
+        channel = taskqueue.worker.pika.BlockingConnection.return_value.\
+                channel.return_value
+        header = Mock()
+        header.content_type = 'application/x-basic-workitem'
+        header.headers = None
+        method = Mock()
+        deliveries = {'fakequeue_p1': [(method, header, "worker_type_name "
+                                        "high")],
+                      'fakequeue': [(method, header, "worker_type_name low")]}
+        def basic_get(queue):
+            if deliveries[queue]:
+                return deliveries[queue].pop()
+            return None, None, None
+        channel.basic_get.side_effect = basic_get
+        taskqueue.worker.pika.BlockingConnection.return_value.\
+                process_data_events.side_effect = lambda: \
+                self.worker.cleanup(None, None)
+        self.worker.handle_task = Mock(side_effect=lambda wi: wi)
+        self.worker({'priority_lanes': '2', 'max_priority': '5'}, {},
+                    'fakequeue')
+
+        self.assertEqual([call[1]["queue"] for call in
+                          channel.queue_declare.call_args_list],
+                         ['fakequeue', 'fakequeue_p1'])
+        self.assertEqual(channel.queue_declare.call_args[1]["arguments"],
+                         None)
+        self.assertFalse(channel.basic_consume.called)
+        bodies = [call[1]["body"] for call in
+                  channel.basic_publish.call_args_list]
+        self.assertEqual(bodies, ["worker_type_name high",
+                                  "worker_type_name low"])
+
+    def test_recycle(self):
+        """Test recycling worker processes."""
+
+        self.addCleanup(signal.signal, signal.SIGUSR2, signal.SIG_DFL)
+        self.worker({'max_tasks_per_child': '2'}, {}, 'fakequeue')
+        self.worker.handle_task = Mock(side_effect=lambda wi: wi)
+        channel = Mock()
+        header = Mock()
+        header.content_type = 'application/x-basic-workitem'
+        header.headers = None
+        self.worker.handle_delivery(channel, Mock(), header,
+                                    "worker_type_name body")
+        self.assertFalse(self.worker.draining)
+        self.worker.handle_delivery(channel, Mock(), header,
+                                    "worker_type_name body")
+        self.assertEqual(self.worker.tasks_done, 2)
+        # the consumer is cancelled from the I/O loop
+        self.assertTrue(self.worker.draining)
+        self.worker.connection.add_timeout.assert_called_once_with(
+            0, self.worker.channel.stop_consuming)
+        self.worker.consume()
+        self.assertTrue(self.worker.connection.close.called)
+
+        # workers started by the pool ask for replacements
+        self.assertTrue(taskqueue.worker.get_rss() > 0)
+        get_rss = taskqueue.worker.get_rss
+        self.addCleanup(setattr, taskqueue.worker, 'get_rss', get_rss)
+        taskqueue.worker.get_rss = Mock(return_value=200.0)
+        worker = taskqueue.worker.BaseWorker.factory()
+        worker({'max_rss_mb': '100'}, {}, 'fakequeue')
+        worker.recycling = Mock(value=0)
+        worker.handle_task = Mock(side_effect=lambda wi: wi)
+        worker.handle_delivery(channel, Mock(), header,
+                               "worker_type_name body")
+        self.assertEqual(worker.recycling.value, 1)
+        self.assertFalse(worker.draining)
+        worker.drain(signal.SIGUSR2, None)
+        self.assertTrue(worker.draining)
+        self.assertTrue(worker.stopping)
+
     def test_cleanup(self):
         """Test BaseWorker.cleanup()."""
 
         self.worker.channel = Mock()
         self.worker.connection = Mock()
+        self.worker.publisher = Mock()
         self.worker.cleanup("fake_signum", "fake_frame")
+        self.worker.publisher.flush.assert_called_once_with()
+        self.worker.connection.close.assert_called_once_with()
 
 if __name__ == "__main__":
     unittest.main()
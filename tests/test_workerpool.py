@@ -1,4 +1,10 @@
 import unittest
+import sys
+import os
+import signal
+
+from time import time
+from multiprocessing import Process
 
 from taskqueue.confparser import ConfigParser
 from mock import Mock
@@ -8,6 +14,9 @@ import taskqueue.workerpool
 class TestError(Exception):
     pass
 
+def exit_worker(props, amqp_params, queue):
+    sys.exit(3)
+
 class TestWorkerPool(unittest.TestCase):
     """Tests for worker pool."""
 
@@ -23,6 +32,8 @@ class TestWorkerPool(unittest.TestCase):
             self.is_alive_counter = self.is_alive_counter + 1
             return False
 
+        self.addCleanup(signal.signal, signal.SIGCHLD,
+                        signal.getsignal(signal.SIGCHLD))
         mockproc = Mock()
         mockproc.is_alive = fake_is_alive
         config = ConfigParser()
@@ -54,6 +65,311 @@ class TestWorkerPool(unittest.TestCase):
         self.assertRaises(TestError, self.wpool.monitor)
         self.assertTrue(self.is_alive_counter == 1)
 
+    def test_kill_hung_worker(self):
+        """Test WorkerPool.kill_hung_worker()."""
+
+        os_kill = taskqueue.workerpool.os.kill
+        self.addCleanup(setattr, taskqueue.workerpool.os, 'kill', os_kill)
+        taskqueue.workerpool.os.kill = Mock()
+        _, proc, _ = self.wpool.processes.values()[0]
+        self.assertEqual(proc.busy_since.value, 0)
+        self.wpool.kill_hung_worker('first', proc, {'task_timeout': '5'})
+
+        proc.busy_since.value = time() - 10
+        self.wpool.kill_hung_worker('first', proc, {})
+        self.wpool.kill_hung_worker('first', proc, {'task_timeout': '5'})
+        self.assertFalse(taskqueue.workerpool.os.kill.called)
+
+        proc.busy_since.value = time() - 20
+        proc.in_flight.value = "0123456789abcdef"
+        self.wpool.kill_hung_worker('first', proc, {'task_timeout': '5'})
+        taskqueue.workerpool.os.kill.assert_called_once_with(
+            proc.pid, signal.SIGKILL)
+        # the tasks of the process are marked for workers of the type
+        self.assertEqual(self.wpool.killed_tasks['first'].value,
+                         "0123456789abcdef")
+        proc.in_flight.value = "fedcba9876543210"
+        self.wpool.kill_hung_worker('first', proc, {'task_timeout': '5'})
+        self.assertEqual(self.wpool.killed_tasks['first'].value,
+                         "0123456789abcdef fedcba9876543210")
+
+    def test_restart_workers(self):
+        """Test restarting exited worker processes."""
+
+        self.addCleanup(setattr, taskqueue.workerpool, 'Process',
+                        taskqueue.workerpool.Process)
+        taskqueue.workerpool.Process = Process
+        self.wpool.processes = {}
+        self.wpool.plugins['exiting'] = lambda: exit_worker
+        self.wpool.watch_exits()
+        self.wpool.create_worker('exiting', {'restart_delay': '0'})
+
+        started = time()
+        self.wpool.wait_events(10)
+        self.assertTrue(time() - started < 5)
+        self.wpool.processes.values()[0][1].join()
+        self.assertEqual(self.wpool.restart_workers(), 1)
+        self.assertEqual(self.wpool.exit_codes, {3: 1})
+        self.assertEqual(self.wpool.restarts, 1)
+        self.assertEqual(len(self.wpool.processes), 1)
+        for _, proc, _ in self.wpool.processes.values():
+            proc.join()
+
+    def test_crash_loop(self):
+        """Test parking crashing worker types."""
+
+        proc = Mock()
+        proc.is_alive.return_value = False
+        proc.exitcode = 1
+        taskqueue.workerpool.Process = Mock(return_value=proc)
+        self.wpool.processes = {}
+        self.wpool.plugins['crashing'] = Mock()
+        props = {'restart_delay': '0', 'breaker_threshold': '2',
+                 'breaker_timeout': '0'}
+        self.wpool.create_worker('crashing', props)
+        self.assertEqual(self.wpool.restart_workers(), 1)
+        self.assertEqual(self.wpool.breakers['crashing'].state, 'closed')
+        # the breaker opens and lets a probe start immediately
+        self.assertEqual(self.wpool.restart_workers(), 1)
+        self.assertEqual(self.wpool.breakers['crashing'].state, 'half-open')
+        self.assertTrue(proc.probe)
+
+        # a crashed probe parks the type
+        self.wpool.breakers['crashing'].timeout = 60
+        self.wpool.breakers['crashing'].open_timeout = 30
+        self.assertEqual(self.wpool.restart_workers(), 0)
+        self.assertEqual(self.wpool.breakers['crashing'].state, 'open')
+        self.assertEqual(self.wpool.parked, {'crashing': [props]})
+        self.assertEqual(self.wpool.processes, {})
+        self.wpool.dump_state(None, None)
+
+        # a probe surviving startup restarts parked processes
+        self.wpool.breakers['crashing'].opened_at -= 60
+        self.wpool.parked['crashing'].append(props)
+        self.assertEqual(self.wpool.restart_workers(), 1)
+        proc.is_alive.return_value = True
+        proc.started -= 60
+        self.assertEqual(self.wpool.restart_workers(), 1)
+        self.assertEqual(self.wpool.breakers['crashing'].state, 'closed')
+        self.assertEqual(self.wpool.parked, {})
+
+    def test_crash_backoff(self):
+        """Test healthy processes don't reset backoff of crashing ones."""
+
+        healthy = Mock(pid=1)
+        healthy.is_alive.return_value = True
+        crashing = Mock(pid=2, exitcode=1)
+        crashing.is_alive.return_value = False
+        taskqueue.workerpool.Process = Mock(side_effect=[healthy] +
+                                            [crashing] * 4)
+        self.wpool.processes = {}
+        self.wpool.plugins['mixed'] = Mock()
+        props = {'breaker_threshold': '100'}
+        self.wpool.create_worker('mixed', props)
+        self.wpool.create_worker('mixed', props)
+        healthy.started -= 60
+        backoff = crashing.backoff
+        self.assertFalse(backoff is healthy.backoff)
+
+        for attempts in range(1, 4):
+            self.assertEqual(self.wpool.restart_workers(), 0)
+            self.assertEqual(backoff.attempts, attempts)
+            self.assertEqual(self.wpool.start_pending(time() + 3600), 1)
+            self.assertTrue(crashing.backoff is backoff)
+
+        # the backoff is reset once the restarted process is up
+        crashing.is_alive.return_value = True
+        crashing.started -= 60
+        self.wpool.restart_workers()
+        self.assertEqual(backoff.attempts, 0)
+
+    def test_probe_exit(self):
+        """Test probes exiting early in any way reopen the breaker."""
+
+        proc = Mock(pid=1)
+        proc.is_alive.return_value = False
+        taskqueue.workerpool.Process = Mock(return_value=proc)
+        self.wpool.processes = {}
+        self.wpool.plugins['probed'] = Mock()
+        props = {'restart_delay': '0', 'breaker_threshold': '1',
+                 'breaker_timeout': '0'}
+        self.wpool.create_worker('probed', props)
+        proc.exitcode = 1
+        self.assertEqual(self.wpool.restart_workers(), 1)
+        breaker = self.wpool.breakers['probed']
+        self.assertEqual(breaker.state, 'half-open')
+        self.assertTrue(proc.probe)
+
+        # the probe exits normally before min_uptime
+        proc.exitcode = 0
+        breaker.timeout = breaker.open_timeout = 60
+        self.assertEqual(self.wpool.restart_workers(), 0)
+        self.assertEqual(breaker.state, 'open')
+        self.assertEqual(self.wpool.parked, {'probed': [props]})
+
+        # the probe is stopped by the pool
+        breaker.opened_at -= 120
+        self.assertEqual(self.wpool.restart_workers(), 1)
+        self.assertEqual(breaker.state, 'half-open')
+        self.wpool.retiring.add(proc.pid)
+        self.assertEqual(self.wpool.restart_workers(), 0)
+        self.assertEqual(breaker.state, 'open')
+        self.assertEqual(self.wpool.retiring, set())
+
+    def test_scale_workers(self):
+        """Test autoscaling worker processes by queue depth."""
+
+        procs = []
+        def create_proc(**kwargs):
+            proc = Mock(pid=len(procs) + 1)
+            proc.is_alive.return_value = True
+            procs.append(proc)
+            return proc
+
+        depths = {'worker_scaled': 0, 'worker_scaled_p1': 5}
+        channel = Mock()
+        channel.queue_declare = lambda queue, passive: Mock(
+            method=Mock(message_count=depths[queue]))
+        os_kill = taskqueue.workerpool.os.kill
+        self.addCleanup(setattr, taskqueue.workerpool.os, 'kill', os_kill)
+        taskqueue.workerpool.os.kill = Mock()
+        taskqueue.workerpool.Process = Mock(side_effect=create_proc)
+        self.wpool.processes = {}
+        self.wpool.channel = channel
+        self.wpool.plugins['scaled'] = Mock()
+        props = {'instances': '1', 'max_instances': '3',
+                 'priority_lanes': '2', 'scale_down_ratio': '0.5',
+                 'scale_down_delay': '0'}
+        self.wpool.create_workers('scaled', props)
+        self.assertEqual(len(procs), 1)
+
+        procs[0].busy_since.value = time()
+        self.assertEqual(self.wpool.scale_workers(0), 1)
+        for proc in procs:
+            proc.busy_since.value = time()
+        self.assertEqual(self.wpool.scale_workers(5), 0)
+        self.assertEqual(self.wpool.scale_workers(10), 1)
+        self.assertEqual(self.wpool.scale_workers(20), 0)
+        self.assertEqual(len(self.wpool.processes), 3)
+
+        # idle processes are drained and not restarted
+        depths['worker_scaled_p1'] = 0
+        for proc in procs[1:]:
+            proc.busy_since.value = 0
+        self.assertEqual(self.wpool.scale_workers(30), 0)
+        self.assertEqual(self.wpool.scale_workers(40), -1)
+        taskqueue.workerpool.os.kill.assert_called_once_with(
+            3, signal.SIGUSR2)
+        procs[2].is_alive.return_value = False
+        procs[2].exitcode = 0
+        self.assertEqual(self.wpool.restart_workers(), 0)
+        self.assertEqual(len(self.wpool.processes), 2)
+        self.assertFalse(procs[2].terminate.called)
+
+    def test_scale_thread_pools(self):
+        """Test scaling down workers running tasks in thread pools."""
+
+        procs = []
+        def create_proc(**kwargs):
+            proc = Mock(pid=len(procs) + 1)
+            proc.is_alive.return_value = True
+            procs.append(proc)
+            return proc
+
+        os_kill = taskqueue.workerpool.os.kill
+        self.addCleanup(setattr, taskqueue.workerpool.os, 'kill', os_kill)
+        taskqueue.workerpool.os.kill = Mock()
+        taskqueue.workerpool.Process = Mock(side_effect=create_proc)
+        self.wpool.processes = {}
+        self.wpool.channel = Mock()
+        self.wpool.channel.queue_declare.return_value = Mock(
+            method=Mock(message_count=0))
+        self.wpool.plugins['threaded'] = Mock()
+        self.wpool.create_workers('threaded', {'instances': '3',
+                                               'min_instances': '1',
+                                               'max_instances': '3',
+                                               'concurrency': '4',
+                                               'scale_down_ratio': '0.5',
+                                               'scale_down_delay': '0'})
+
+        procs[0].active_tasks.value = 3
+        procs[2].active_tasks.value = 1
+        self.assertEqual(self.wpool.scale_workers(0), 0)
+        self.assertEqual(self.wpool.scale_workers(10), 0)
+        procs[2].active_tasks.value = 0
+        self.assertEqual(self.wpool.scale_workers(20), 0)
+        self.assertEqual(self.wpool.scale_workers(30), -1)
+        taskqueue.workerpool.os.kill.assert_called_once_with(
+            3, signal.SIGUSR2)
+
+    def test_recycle_workers(self):
+        """Test replacing worker processes one by one."""
+
+        procs = []
+        def create_proc(**kwargs):
+            proc = Mock(pid=len(procs) + 1)
+            proc.is_alive.return_value = True
+            procs.append(proc)
+            return proc
+
+        os_kill = taskqueue.workerpool.os.kill
+        self.addCleanup(setattr, taskqueue.workerpool.os, 'kill', os_kill)
+        taskqueue.workerpool.os.kill = Mock()
+        taskqueue.workerpool.Process = Mock(side_effect=create_proc)
+        self.wpool.processes = {}
+        self.wpool.plugins['recycled'] = Mock()
+        self.wpool.create_workers('recycled', {'instances': '2'})
+
+        # the replacement is started before the worker is drained
+        procs[0].recycling.value = 1
+        self.assertEqual(self.wpool.recycle_workers(), 1)
+        self.assertEqual(len(self.wpool.processes), 3)
+        taskqueue.workerpool.os.kill.assert_called_once_with(
+            1, signal.SIGUSR2)
+        self.assertEqual(self.wpool.recycle_workers(), 0)
+        procs[0].is_alive.return_value = False
+        procs[0].exitcode = 0
+        self.assertEqual(self.wpool.restart_workers(), 0)
+        self.assertEqual(sorted(self.wpool.processes), [2, 3])
+
+        self.wpool.rolling_restart('recycled')
+        self.wpool.roll_workers()
+        self.assertEqual(len(self.wpool.processes), 3)
+        taskqueue.workerpool.os.kill.assert_called_with(2, signal.SIGUSR2)
+        # the next process waits for the drained one to exit
+        self.wpool.roll_workers()
+        self.assertEqual(len(self.wpool.processes), 3)
+        procs[1].is_alive.return_value = False
+        self.wpool.restart_workers()
+        self.wpool.roll_workers()
+        taskqueue.workerpool.os.kill.assert_called_with(3, signal.SIGUSR2)
+        procs[2].is_alive.return_value = False
+        self.wpool.restart_workers()
+        self.wpool.roll_workers()
+        self.assertEqual(self.wpool.rolling, {})
+        self.assertEqual(sorted(self.wpool.processes), [4, 5])
+
+    def test_run_worker(self):
+        """Test resetting signal handlers in worker processes."""
+
+        for signum in (signal.SIGUSR1, signal.SIGUSR2):
+            self.addCleanup(signal.signal, signum, signal.getsignal(signum))
+            signal.signal(signum, Mock())
+        handlers = {}
+        def target(*args):
+            for signum in (signal.SIGUSR1, signal.SIGUSR2):
+                handlers[signum] = signal.getsignal(signum)
+        taskqueue.workerpool.run_worker(target, {})
+        self.assertEqual(handlers, {signal.SIGUSR1: signal.SIG_DFL,
+                                    signal.SIGUSR2: signal.SIG_IGN})
+
+        # drain requests are kept until workers set their handler
+        worker = Mock(drain_requested=False)
+        worker.side_effect = lambda *args: os.kill(os.getpid(),
+                                                   signal.SIGUSR2)
+        taskqueue.workerpool.run_worker(worker, {})
+        self.assertTrue(worker.drain_requested)
+
     def test_run(self):
         """Test WorkerPool.run()."""
 
@@ -70,3 +386,28 @@ class TestWorkerPool(unittest.TestCase):
         self.wpool.config.set('worker_first', 'subgroups', 'subgroup1')
         self.assertRaises(TestError, self.wpool.run)
         self.assertTrue(self.is_alive_counter == 1)
+
+    def test_preload(self):
+        """Test WorkerPool.run() with preloaded workers."""
+
+        template = Mock()
+        factory = Mock(return_value=template)
+        entrypoint = Mock()
+        entrypoint.name = 'first'
+        entrypoint.load = Mock(return_value=factory)
+        pkg_resources = taskqueue.workerpool.pkg_resources
+        self.addCleanup(setattr, pkg_resources, 'iter_entry_points',
+                        pkg_resources.iter_entry_points)
+        pkg_resources.iter_entry_points = Mock(return_value=[entrypoint])
+        self.wpool.config.add_section('worker_first')
+        self.wpool.config.set('worker_first', 'preload', 'yes')
+        self.wpool.config.set('worker_first', 'instances', '3')
+        self.assertRaises(TestError, self.wpool.run)
+        factory.assert_called_once_with()
+        template.preload.assert_called_once_with()
+        self.assertEqual(taskqueue.workerpool.Process.call_args[1]["args"][0],
+                         template)
+
+        # crashed workers are forked from the template as well
+        self.wpool.create_worker('first', {})
+        factory.assert_called_once_with()
@@ -1,14 +1,31 @@
 import unittest
+import json
+import zlib
 
-from mock import Mock
+from mock import Mock, patch
+
+import taskqueue.workitem
+
+from taskqueue.blobstore import BlobStoreError
 
 from taskqueue.workitem import Workitem, BasicWorkitem, RuoteWorkitem, \
-                               get_workitem
+                               WorkitemRegistry, get_workitem, \
+                               peek_worker_type, get_field, SCAN_TOKENS
 from taskqueue.workitem import BasicWorkitemError, RuoteWorkitemError, \
                                WorkitemError
 
 class TestModule(unittest.TestCase):
 
+    def setUp(self):
+        self.iter_entry_points = taskqueue.workitem.iter_entry_points
+        # classes cached by other tests are not reused
+        patcher = patch('taskqueue.workitem.REGISTRY', WorkitemRegistry())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        taskqueue.workitem.iter_entry_points = self.iter_entry_points
+
     def test_get_workitem(self):
         """Test get_workitem()."""
 
@@ -21,12 +38,83 @@ class TestModule(unittest.TestCase):
         self.assertRaises(WorkitemError, get_workitem, header, "", "")
         self.assertRaises(WorkitemError, get_workitem, header, "", "key=value")
 
-        import taskqueue.workitem
         entry = Mock()
         entry.load = Mock(side_effect=ImportError)
         taskqueue.workitem.iter_entry_points = Mock(return_value=[entry])
+        taskqueue.workitem.REGISTRY = WorkitemRegistry()
         self.assertRaises(WorkitemError, get_workitem, header, "")
 
+    def test_compressed_body(self):
+        """Test get_workitem() with compressed body."""
+
+        header = Mock()
+        header.content_type = "application/x-ruote-workitem"
+        header.content_encoding = "zlib"
+        body = zlib.compress('{"fields": {"params": {"worker_type": "t"}}}')
+        self.assertEqual(get_workitem(header, body).worker_type, "t")
+        self.assertEqual(peek_worker_type(header, body), "t")
+        self.assertRaises(WorkitemError, get_workitem, header, "invalid")
+
+    def test_offloaded_body(self):
+        """Test get_workitem() with body offloaded to blob store."""
+
+        header = Mock()
+        header.content_type = "application/x-ruote-workitem"
+        header.content_encoding = None
+        header.headers = {"x-blob-ref": "ref"}
+        blobstore = Mock()
+        blobstore.get = Mock(
+            return_value='{"fields": {"params": {"worker_type": "t"}}}')
+        self.assertEqual(get_workitem(header, "", None, "application/json",
+                                      blobstore).worker_type, "t")
+        self.assertEqual(peek_worker_type(header, "", None,
+                                          "application/json", blobstore), "t")
+        blobstore.get.assert_called_with("ref")
+        self.assertRaises(WorkitemError, get_workitem, header, "")
+        blobstore.get.side_effect = BlobStoreError("missing blob")
+        self.assertRaises(WorkitemError, get_workitem, header, "", None,
+                          "application/json", blobstore)
+
+    def test_peek_worker_type(self):
+        """Test peek_worker_type()."""
+
+        header = Mock()
+        header.content_type = "application/x-ruote-workitem"
+        self.assertEqual(peek_worker_type(header,
+            '{"fields": {"params": {"worker_type": "test"}}}'), "test")
+        self.assertRaises(WorkitemError, peek_worker_type, header, "{}")
+        header.content_type = "test/fake"
+        self.assertRaises(WorkitemError, peek_worker_type, header, "")
+
+class TestWorkitemRegistry(unittest.TestCase):
+    """Tests for WorkitemRegistry."""
+
+    def setUp(self):
+        self.iter_entry_points = taskqueue.workitem.iter_entry_points
+        entry = Mock()
+        entry.module_name = "fakemodule"
+        entry.load = Mock(return_value=BasicWorkitem)
+        taskqueue.workitem.iter_entry_points = Mock(return_value=[entry])
+        self.registry = WorkitemRegistry()
+
+    def tearDown(self):
+        taskqueue.workitem.iter_entry_points = self.iter_entry_points
+
+    def test_get_classes(self):
+        """Test WorkitemRegistry.get_classes()."""
+        classes = self.registry.get_classes("fake/type")
+        self.assertEqual(classes, [("fakemodule", BasicWorkitem)])
+        self.registry.get_classes("fake/type")
+        self.assertEqual(taskqueue.workitem.iter_entry_points.call_count, 1)
+
+    def test_get_ctype_map(self):
+        """Test WorkitemRegistry.get_ctype_map()."""
+        ctype_map = self.registry.get_ctype_map("a/b = c/d, e/f=g/h")
+        self.assertEqual(ctype_map, {"a/b": "c/d", "e/f": "g/h"})
+        self.assertTrue(ctype_map is
+                        self.registry.get_ctype_map("a/b = c/d, e/f=g/h"))
+        self.assertRaises(WorkitemError, self.registry.get_ctype_map, "a/b")
+
 class TestWorkitem(unittest.TestCase):
     """Tests for abstract class Workitem."""
 
@@ -113,6 +201,83 @@ class TestRuoteWorkitem(TestMixinWorkitem, unittest.TestCase):
 
         self.assertRaises(RuoteWorkitemError, self.wi.loads, "{}")
 
+    @patch('taskqueue.workitem.SCAN_SIZE', 0)
+    def test_peek_worker_type(self):
+        """Test RuoteWorkitem.peek_worker_type()."""
+
+        self.assertEqual(self.wi.peek_worker_type(
+            '{"fields": {"params": {"worker_type": "test"}}}'), "test")
+        self.assertEqual(self.wi._body, None)
+
+        self.assertEqual(self.wi.peek_worker_type(
+            '{"fields": {"log": "\\"worker_type\\": \\"fake\\"", '
+            '"params" : { "worker_type" :\n"test"}}}'), "test")
+        self.assertEqual(self.wi._body, None)
+
+        # members of params are scanned only
+        self.assertEqual(self.wi.peek_worker_type(
+            '{"fei": {}, "fields": {"log": [%s], "params": '
+            '{"options": {"queue": "q"}, "worker_type": "test"}}}' %
+            ", ".join(['"line"'] * 100)), "test")
+        self.assertEqual(self.wi._body, None)
+
+        # long tails aren't scanned in Python
+        self.assertEqual(self.wi.peek_worker_type(
+            '{"fields": {"params": {"worker_type": "test"}, "log": [%s]}}' %
+            ", ".join(['"line"'] * SCAN_TOKENS)), "test")
+        self.assertNotEqual(self.wi._body, None)
+        self.wi._body = None
+
+        # ambiguous keys make the blob be parsed completely
+        self.assertEqual(self.wi.peek_worker_type(
+            '{"worker_type": "fake", "fields": {"worker_type": "fake", '
+            '"list": [{"params": {"worker_type": "fake"}}], '
+            '"params": {"worker_type": "test"}}}'), "test")
+        self.assertNotEqual(self.wi._body, None)
+        self.wi._body = None
+        self.assertEqual(self.wi.peek_worker_type(
+            '{"fields": {"params": {"worker_type": "fake"}, '
+            '"p\\u0061rams": {"worker_type": "test"}}}'), "test")
+        self.assertNotEqual(self.wi._body, None)
+        self.wi._body = None
+        self.assertEqual(self.wi.peek_worker_type(
+            '{"fields": {"params": {"worker_type": "fake"}}, '
+            '"f\\u0069elds": {"params": {"worker_type": "test"}}}'), "test")
+        self.assertNotEqual(self.wi._body, None)
+        self.wi._body = None
+
+        # keys in params are decoded, the last one wins
+        self.assertEqual(self.wi.peek_worker_type(
+            '{"fields": {"params": {"worker_type": "fake", '
+            '"worker\\u005ftype": "test"}}}'), "test")
+        self.assertEqual(self.wi._body, None)
+
+        # params must be a member of fields
+        self.assertRaises(RuoteWorkitemError, self.wi.peek_worker_type,
+                          '{"fields": {"log": []}, '
+                          '"other": {"params": {"worker_type": "fake"}}}')
+        self.assertRaises(RuoteWorkitemError, self.wi.peek_worker_type,
+                          '{"fields": {"log": [], '
+                          '"other": {"params": {"worker_type": "fake"}}}}')
+        self.assertRaises(RuoteWorkitemError, self.wi.peek_worker_type,
+                          '{"fei": {"fields": {"params": '
+                          '{"worker_type": "fake"}}}}')
+        self.assertRaises(RuoteWorkitemError, self.wi.peek_worker_type,
+                          '{"fields": {"worker_type": "fake", "params": {}}}')
+        self.assertRaises(RuoteWorkitemError, self.wi.peek_worker_type,
+                          '[{"fields": {"params": {"worker_type": "t"}}}]')
+
+        self.assertRaises(RuoteWorkitemError, self.wi.peek_worker_type,
+                          '{"worker_type": 1}')
+        self.assertRaises(RuoteWorkitemError, self.wi.peek_worker_type, None)
+
+    def test_peek_worker_type_small(self):
+        """Test RuoteWorkitem.peek_worker_type() parses small blobs."""
+
+        self.assertEqual(self.wi.peek_worker_type(
+            '{"fields": {"params": {"worker_type": "test"}}}'), "test")
+        self.assertNotEqual(self.wi._body, None)
+
     def test_dumps(self):
         """Test RuoteWorkitem.dumps()."""
 
@@ -120,6 +285,79 @@ class TestRuoteWorkitem(TestMixinWorkitem, unittest.TestCase):
         self.wi._body = {}
         self.assertEqual("{}", self.wi.dumps())
 
+    def test_pass_through(self):
+        """Test RuoteWorkitem passes unmodified blob through."""
+
+        blob = '{"fields": {"params": {"worker_type": "test"}}, "fei": {}}'
+        self.wi.loads(blob)
+        self.assertEqual(self.wi.worker_type, "test")
+        self.assertTrue(self.wi.dumps() is blob)
+        self.assertEqual(self.wi.fei, {})
+        self.assertTrue(self.wi.dumps() is blob)
+
+        # reading fields keeps the blob
+        self.assertTrue(hasattr(self.wi, "fields"))
+        self.assertEqual(self.wi.fields["params"]["worker_type"], "test")
+        self.assertEqual(get_field(self.wi, ["params", "priority"]), None)
+        self.assertTrue(self.wi.dumps() is blob)
+
+        self.wi.fields["params"]["test"] = 1
+        self.assertEqual(
+            json.loads(self.wi.dumps())["fields"]["params"]["test"], 1)
+        self.wi.loads(blob)
+        self.wi.fields["test"] = 1
+        self.assertEqual(json.loads(self.wi.dumps())["fields"]["test"], 1)
+
+        # malformed blobs are rejected rather than spliced into
+        for blob in ('{"fields": {"params": {"worker_type": "test"}}',
+                     'garbage "x": 1, "worker_type": "t" }',
+                     '{"fields": {"worker_type": "test"}}'):
+            self.assertRaises(RuoteWorkitemError, self.wi.loads, blob)
+            self.assertRaises(RuoteWorkitemError, self.wi.dumps)
+
+    @patch('taskqueue.workitem.SCAN_SIZE', 0)
+    def test_lazy_loads(self):
+        """Test RuoteWorkitem decodes scanned blob on demand."""
+
+        blob = '{"fields": {"params": {"worker_type": "test"}}, "fei": {}}'
+        self.wi.loads(blob)
+        self.assertEqual(self.wi._body, None)
+        self.assertEqual(self.wi.worker_type, "test")
+        self.assertTrue(self.wi.dumps() is blob)
+        self.assertEqual(self.wi._body, None)
+        self.assertEqual(self.wi.fei, {})
+        self.assertNotEqual(self.wi._body, None)
+        self.assertTrue(self.wi.dumps() is blob)
+
+        # malformed blobs are rejected when decoded
+        blob = '{"fields": {"log": [,], "params": {"worker_type": "test"}}}'
+        self.wi.loads(blob)
+        self.assertEqual(self.wi.worker_type, "test")
+        self.assertRaises(RuoteWorkitemError, getattr, self.wi, "fields")
+        self.wi.set_error("error")
+        self.assertRaises(RuoteWorkitemError, self.wi.dumps)
+
+    def test_splice(self):
+        """Test adding error and trace to loaded blob."""
+
+        blob = '{"fields": {"params": {"worker_type": "test"}}} \n'
+        self.wi.loads(blob)
+        self.wi.set_error("error")
+        self.wi.set_trace("trace")
+        self.assertEqual(self.wi.dumps(),
+            '{"fields": {"params": {"worker_type": "test"}}, '
+            '"error": "error", "trace": "trace"}')
+
+        self.wi.loads('{"fields": {"params": {"worker_type": "test"}}, '
+                      '"error": "old"}')
+        self.wi.set_error("new")
+        self.assertEqual(json.loads(self.wi.dumps())["error"], "new")
+
+        self.wi.loads('{"fields": {"params": {"worker_type": "test"}}}')
+        self.wi.fields
+        self.wi.set_error("error")
+        self.assertEqual(json.loads(self.wi.dumps())["error"], "error")
+
     def test_fei(self):
         """Test RuoteWorkitem.fei."""
         fei = self.loaded_wi.fei
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+"""Compare JSON codecs on Ruote workitems of different sizes."""
+
+import timeit
+
+from optparse import OptionParser
+
+from taskqueue.jsoncodec import CODECS, get_codec
+
+from bench_workitem import ruote_body
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-s", "--sizes", dest="sizes",
+                      default="1024,10240,102400,1048576,5242880",
+                      help="comma-separated list of body sizes")
+    parser.add_option("-t", "--time", dest="time", type="float",
+                      default=0.5, help="seconds spent per measurement")
+    options, _ = parser.parse_args()
+
+    codecs = []
+    for name in sorted(CODECS):
+        codec = get_codec(name)
+        if codec.name == name:
+            codecs.append(codec)
+
+    print "%10s %12s %14s %14s" % ("size", "codec", "loads, ms", "dumps, ms")
+    for size in [int(size) for size in options.sizes.split(",")]:
+        blob = ruote_body(size)
+        for codec in codecs:
+            body = codec.loads(blob)
+            results = []
+            for fun, arg in ((codec.loads, blob), (codec.dumps, body)):
+                number = max(1, int(options.time / max(
+                    timeit.timeit(lambda: fun(arg), number=1), 1e-6)))
+                elapsed = min(timeit.repeat(lambda: fun(arg), repeat=3,
+                                            number=number))
+                results.append(elapsed / number * 1000)
+            print "%10d %12s %14.3f %14.3f" % (len(blob), codec.name,
+                                               results[0], results[1])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""Compare sizes and processing times of JSON and binary Ruote workitems.
+
+Every workitem is loaded, its fields are modified and it's dumped back
+as a worker does.
+"""
+
+import timeit
+
+from optparse import OptionParser
+
+from taskqueue.workitem import RuoteWorkitem
+from taskqueue.msgpackworkitem import MsgpackWorkitem
+
+from bench_workitem import ruote_body
+
+def process(cls, mime_type, blob):
+    """Load, modify and dump workitem."""
+
+    workitem = cls(mime_type)
+    workitem.loads(blob)
+    workitem.fields["status"] = "done"
+    return workitem.dumps()
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-s", "--sizes", dest="sizes",
+                      default="1024,10240,102400,1048576,5242880",
+                      help="comma-separated list of JSON body sizes")
+    parser.add_option("-p", "--payload", dest="payload", default="files",
+                      help="workitem payload: log or files")
+    parser.add_option("-t", "--time", dest="time", type="float",
+                      default=0.5, help="seconds spent per measurement")
+    options, _ = parser.parse_args()
+
+    print "%10s %10s %8s %12s %12s" % ("json size", "msgpack", "ratio",
+                                       "json, ms", "msgpack, ms")
+    for size in [int(size) for size in options.sizes.split(",")]:
+        json_blob = ruote_body(size, options.payload)
+        ruote_wi = RuoteWorkitem('application/x-ruote-workitem')
+        ruote_wi.loads(json_blob)
+        msgpack_blob = MsgpackWorkitem.from_ruote(ruote_wi).dumps()
+        results = []
+        for args in ((RuoteWorkitem, 'application/x-ruote-workitem',
+                      json_blob),
+                     (MsgpackWorkitem, 'application/x-msgpack-workitem',
+                      msgpack_blob)):
+            number = max(1, int(options.time / max(
+                timeit.timeit(lambda: process(*args), number=1), 1e-6)))
+            elapsed = min(timeit.repeat(lambda: process(*args), repeat=3,
+                                        number=number))
+            results.append(elapsed / number * 1000)
+        print "%10d %10d %8.2f %12.3f %12.3f" % (
+            len(json_blob), len(msgpack_blob),
+            float(len(msgpack_blob)) / len(json_blob), results[0], results[1])
+
+if __name__ == "__main__":
+    main()
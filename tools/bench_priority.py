@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""Simulate waiting times of tasks with different priorities.
+
+Tasks of several priorities arrive randomly at a pool of workers loaded
+above its capacity for a while. Waiting times are compared for one FIFO
+queue and for priority lanes polled strictly or by weights. Strict lanes
+behave like queues with native priorities and prefetch 1.
+"""
+
+import random
+import heapq
+
+from collections import deque
+from optparse import OptionParser
+
+from taskqueue.priority import LaneScheduler
+
+def generate(options, mix):
+    """Return list of (arrival time, priority, service time) tuples."""
+
+    rate = options.load * options.workers / options.service
+    tasks = []
+    now = 0.0
+    while now < options.duration:
+        now += random.expovariate(rate)
+        priority = 0
+        point = random.random()
+        for priority, share in enumerate(mix):
+            point -= share
+            if point < 0:
+                break
+        tasks.append((now, priority,
+                      random.expovariate(1.0 / options.service)))
+    return tasks
+
+def simulate(tasks, lanes, scheduler, workers):
+    """Return waiting times of tasks per priority.
+
+    :param scheduler: lane scheduler or None for one FIFO queue
+    """
+
+    queues = [deque() for _ in range(lanes)]
+    fifo = deque()
+    # times when workers get free
+    free = [0.0] * workers
+    waits = [[] for _ in range(lanes)]
+    index = 0
+    while index < len(tasks) or fifo or any(queues):
+        now = heapq.heappop(free)
+        if index < len(tasks) and not fifo and not any(queues):
+            now = max(now, tasks[index][0])
+        while index < len(tasks) and tasks[index][0] <= now:
+            if scheduler is None:
+                fifo.append(tasks[index])
+            else:
+                queues[tasks[index][1]].append(tasks[index])
+            index += 1
+        if scheduler is None:
+            task = fifo.popleft()
+        else:
+            for lane in scheduler.order():
+                if queues[lane]:
+                    task = queues[lane].popleft()
+                    break
+        arrival, priority, service = task
+        waits[priority].append(now - arrival)
+        heapq.heappush(free, now + service)
+    return waits
+
+def percentile(values, fraction):
+    """Return percentile of values."""
+
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-w", "--workers", dest="workers", type="int",
+                      default=4, help="number of worker processes")
+    parser.add_option("-l", "--load", dest="load", type="float",
+                      default=1.1, help="offered load relative to capacity")
+    parser.add_option("-s", "--service", dest="service", type="float",
+                      default=10, help="mean service time in seconds")
+    parser.add_option("-d", "--duration", dest="duration", type="float",
+                      default=7200, help="simulated seconds of arrivals")
+    parser.add_option("-m", "--mix", dest="mix", default="0.8,0.2",
+                      help="shares of priorities starting from the lowest")
+    parser.add_option("-W", "--weights", dest="weights", default=None,
+                      help="lane weights for weighted mode")
+    parser.add_option("-r", "--seed", dest="seed", type="int", default=1,
+                      help="random seed")
+    options, _ = parser.parse_args()
+
+    random.seed(options.seed)
+    mix = [float(share) for share in options.mix.split(",")]
+    weights = options.weights and \
+            [int(weight) for weight in options.weights.split(",")]
+    tasks = generate(options, mix)
+
+    print "%10s %8s %8s %10s %10s %10s" % ("mode", "priority", "tasks",
+                                           "p50, s", "p95, s", "p99, s")
+    for mode, scheduler in (("fifo", None),
+                            ("strict", LaneScheduler(len(mix), "strict")),
+                            ("weighted", LaneScheduler(len(mix), "weighted",
+                                                       weights))):
+        waits = simulate(tasks, len(mix), scheduler, options.workers)
+        for priority in range(len(mix) - 1, -1, -1):
+            print "%10s %8d %8d %10.1f %10.1f %10.1f" % (
+                mode, priority, len(waits[priority]),
+                percentile(waits[priority], 0.5),
+                percentile(waits[priority], 0.95),
+                percentile(waits[priority], 0.99))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""Measure per-message overhead of workitem parsing.
+
+Taskqueue must be installed (e.g. with `python setup.py develop`) for
+the workitem entry points to be found.
+"""
+
+import json
+import timeit
+
+from optparse import OptionParser
+
+import taskqueue.workitem
+
+from taskqueue.workitem import WorkitemRegistry, get_workitem, \
+                               peek_worker_type
+
+TYPE_MAP = "application/json=application/x-ruote-workitem," \
+           "text/plain=application/x-basic-workitem"
+
+class Header(object):
+    """AMQP header stand-in."""
+
+    def __init__(self, content_type):
+        self.content_type = content_type
+        self.headers = None
+
+def ruote_body(size, payload="log"):
+    """Return Ruote workitem serialized into roughly `size` bytes.
+
+    The workitem is padded with lines of build log or with a list of files.
+    Keys are sorted like in workitems sent by Ruote, so `params` follows the
+    padding.
+    """
+
+    body = {
+        "re_dispatch_count": 0,
+        "participant_name": "hardworker",
+        "fields": {
+            "params": {"worker_type": "simplebuilder", "ref": "hardworker"},
+            "pkgname": "python-riak",
+            "pkgversion": "1.2.1",
+            "log": []
+        },
+        "fei": {"wfid": "20120304-bejeruwodi", "engine_id": "engine",
+                "expid": "0_1_3", "subid": "8079afecd0256e8280b355455ea3435f"}
+    }
+    if payload == "files":
+        line = {"name": "usr/share/doc/python-riak/changelog.gz",
+                "size": 10240, "mtime": 1330869622.861908, "mode": 420}
+    else:
+        line = "dpkg-buildpackage: building package in /home/user/tmp/build"
+    lines = (size - len(json.dumps(body))) / (len(json.dumps(line)) + 2)
+    body["fields"]["log"].extend([line] * max(lines, 0))
+    return json.dumps(body, sort_keys=True)
+
+def uncached(header, body):
+    """Emulate workitem lookup without registry caches."""
+    taskqueue.workitem.REGISTRY = WorkitemRegistry()
+    "get_workitem(%s, '%s')" % (header, body)
+    return get_workitem(header, body, TYPE_MAP)
+
+def cached(header, body):
+    """Workitem lookup with warm registry caches."""
+    return get_workitem(header, body, TYPE_MAP)
+
+def peek(header, body):
+    """Worker type lookup done by the dispatcher."""
+    return peek_worker_type(header, body, TYPE_MAP)
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-n", "--number", dest="number", type="int",
+                      default=2000, help="number of messages per run")
+    parser.add_option("-s", "--sizes", dest="sizes",
+                      default="1024,65536",
+                      help="comma-separated list of body sizes")
+    options, _ = parser.parse_args()
+
+    header = Header("application/json")
+    print "%10s %14s %14s %14s" % ("size", "uncached, us", "cached, us",
+                                   "peek, us")
+    for size in [int(size) for size in options.sizes.split(",")]:
+        body = ruote_body(size)
+        results = []
+        for fun in (uncached, cached, peek):
+            fun(header, body)
+            elapsed = min(timeit.repeat(lambda: fun(header, body),
+                                        repeat=3, number=options.number))
+            results.append(elapsed / options.number * 1000000)
+        print "%10d %14.1f %14.1f %14.1f" % tuple([len(body)] + results)
+
+if __name__ == "__main__":
+    main()